@@ -0,0 +1,299 @@
+import numpy as np
+from jit import njit, prange
+
+from constants import *
+
+# Bodies that still share a leaf at this depth (e.g. coincident positions) are kept
+# together in the leaf instead of subdividing forever
+MAX_TREE_DEPTH = 48
+
+
+@njit(nogil=True, cache=True)
+def build_tree(positions, boundary, children, bounds, depths, leaf_body, next_body):
+
+    # Inserts every body into a quad tree stored in flat arrays, children are always
+    # created after their parent so reversed node order is a valid bottom-up order.
+    # Returns the number of nodes used, or -1 if the node arrays are too small
+
+    n = positions.shape[0]
+    max_nodes = children.shape[0]
+
+    children[0, :] = -1
+    bounds[0, :] = boundary
+    depths[0] = 0
+    leaf_body[0] = -1
+    num_nodes = 1
+
+    for i in range(n):
+        x = positions[i, 0]
+        y = positions[i, 1]
+        next_body[i] = -1
+
+        node = 0
+        while True:
+            x_mid = (bounds[node, 0] + bounds[node, 2]) / 2
+            y_mid = (bounds[node, 1] + bounds[node, 3]) / 2
+
+            if children[node, 0] != -1:
+                node = children[node, (x > x_mid) + 2 * (y > y_mid)]
+                continue
+
+            if leaf_body[node] == -1:
+                leaf_body[node] = i
+                break
+
+            if depths[node] >= MAX_TREE_DEPTH:
+                next_body[i] = leaf_body[node]
+                leaf_body[node] = i
+                break
+
+            if num_nodes + 4 > max_nodes:
+                return -1
+
+            # Subdivide in the same quadrant order as QuadTreeNode.subdivide
+            x_min, y_min, x_max, y_max = bounds[node, 0], bounds[node, 1], bounds[node, 2], bounds[node, 3]
+            for q in range(4):
+                child = num_nodes + q
+                children[node, q] = child
+                children[child, :] = -1
+                depths[child] = depths[node] + 1
+                leaf_body[child] = -1
+                bounds[child, 0] = x_mid if q & 1 else x_min
+                bounds[child, 1] = y_mid if q & 2 else y_min
+                bounds[child, 2] = x_max if q & 1 else x_mid
+                bounds[child, 3] = y_max if q & 2 else y_mid
+            num_nodes += 4
+
+            existing = leaf_body[node]
+            leaf_body[node] = -1
+            q = (positions[existing, 0] > x_mid) + 2 * (positions[existing, 1] > y_mid)
+            leaf_body[children[node, q]] = existing
+
+    return num_nodes
+
+
+@njit(nogil=True, cache=True)
+def compute_moments(num_nodes, positions, masses, children, leaf_body, next_body, node_mass, center_of_mass):
+
+    for node in range(num_nodes - 1, -1, -1):
+        total_mass = 0.0
+        weighted_x = 0.0
+        weighted_y = 0.0
+
+        if children[node, 0] == -1:
+            b = leaf_body[node]
+            while b != -1:
+                total_mass += masses[b]
+                weighted_x += positions[b, 0] * masses[b]
+                weighted_y += positions[b, 1] * masses[b]
+                b = next_body[b]
+        else:
+            for q in range(4):
+                child = children[node, q]
+                total_mass += node_mass[child]
+                weighted_x += center_of_mass[child, 0] * node_mass[child]
+                weighted_y += center_of_mass[child, 1] * node_mass[child]
+
+        node_mass[node] = total_mass
+        if total_mass > 0:
+            center_of_mass[node, 0] = weighted_x / total_mass
+            center_of_mass[node, 1] = weighted_y / total_mass
+        else:
+            center_of_mass[node, 0] = 0.0
+            center_of_mass[node, 1] = 0.0
+
+
+@njit(nogil=True, cache=True)
+def walk_tree(x, y, mass, skip, stack, positions, masses, children, bounds, leaf_body, next_body,
+              node_mass, center_of_mass, theta):
+
+    # Force on a body of the given mass at (x, y) from every body in the tree except body
+    # number skip. Same opening criterion as QuadTreeNode.calculate_force: a node is
+    # treated as a point mass when max(width, height) / softened_distance < theta
+
+    stack[0] = 0
+    top = 0
+
+    fx = 0.0
+    fy = 0.0
+
+    while top >= 0:
+        node = stack[top]
+        top -= 1
+
+        if node_mass[node] == 0:
+            continue
+
+        if children[node, 0] == -1:
+            b = leaf_body[node]
+            while b != -1:
+                if b != skip:
+                    dx = positions[b, 0] - x
+                    dy = positions[b, 1] - y
+                    softened_distance_squared = dx * dx + dy * dy + EPSILON * EPSILON
+                    softened_distance = np.sqrt(softened_distance_squared)
+                    force = G_CONSTANT * masses[b] * mass / softened_distance_squared
+                    fx += force * dx / softened_distance
+                    fy += force * dy / softened_distance
+                b = next_body[b]
+            continue
+
+        dx = center_of_mass[node, 0] - x
+        dy = center_of_mass[node, 1] - y
+        softened_distance_squared = dx * dx + dy * dy + EPSILON * EPSILON
+        softened_distance = np.sqrt(softened_distance_squared)
+
+        size = max(bounds[node, 2] - bounds[node, 0], bounds[node, 3] - bounds[node, 1])
+
+        if size / softened_distance < theta:
+            force = G_CONSTANT * node_mass[node] * mass / softened_distance_squared
+            fx += force * dx / softened_distance
+            fy += force * dy / softened_distance
+        else:
+            for q in range(4):
+                top += 1
+                stack[top] = children[node, q]
+
+    return fx, fy
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def compute_forces_tree(positions, masses, children, bounds, leaf_body, next_body,
+                        node_mass, center_of_mass, theta):
+
+    n = positions.shape[0]
+    net_forces = np.zeros((n, 2), dtype=np.float64)
+
+    for i in prange(n):
+        stack = np.empty(3 * MAX_TREE_DEPTH + 4, dtype=np.int64)
+        fx, fy = walk_tree(positions[i, 0], positions[i, 1], masses[i], i, stack, positions, masses,
+                           children, bounds, leaf_body, next_body, node_mass, center_of_mass, theta)
+
+        net_forces[i, 0] = fx
+        net_forces[i, 1] = fy
+
+    return net_forces
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def compute_forces_tree_active(active, positions, masses, children, bounds, leaf_body, next_body,
+                               node_mass, center_of_mass, theta):
+
+    # Forces on the listed bodies only, for individual timesteps
+
+    net_forces = np.zeros((active.shape[0], 2), dtype=np.float64)
+
+    for a in prange(active.shape[0]):
+        i = active[a]
+        stack = np.empty(3 * MAX_TREE_DEPTH + 4, dtype=np.int64)
+        fx, fy = walk_tree(positions[i, 0], positions[i, 1], masses[i], i, stack, positions, masses,
+                           children, bounds, leaf_body, next_body, node_mass, center_of_mass, theta)
+
+        net_forces[a, 0] = fx
+        net_forces[a, 1] = fy
+
+    return net_forces
+
+
+@njit(nogil=True, cache=True)
+def accumulate_tree_forces(target_positions, target_masses, self_tree, net_forces, positions, masses,
+                           children, bounds, leaf_body, next_body, node_mass, center_of_mass, theta):
+
+    # Adds the force from a tree built over other bodies (or, with self_tree, over the
+    # targets themselves) to net_forces, single threaded for use inside worker processes
+
+    stack = np.empty(3 * MAX_TREE_DEPTH + 4, dtype=np.int64)
+
+    for i in range(target_positions.shape[0]):
+        fx, fy = walk_tree(target_positions[i, 0], target_positions[i, 1], target_masses[i],
+                           i if self_tree else -1, stack, positions, masses, children, bounds,
+                           leaf_body, next_body, node_mass, center_of_mass, theta)
+
+        net_forces[i, 0] += fx
+        net_forces[i, 1] += fy
+
+
+@njit(nogil=True, cache=True)
+def spread_bits(v):
+    v &= 0x1FFFFF
+    v = (v | (v << 32)) & 0x1F00000000FFFF
+    v = (v | (v << 16)) & 0x1F0000FF0000FF
+    v = (v | (v << 8)) & 0x100F00F00F00F00F
+    v = (v | (v << 4)) & 0x10C30C30C30C30C3
+    v = (v | (v << 2)) & 0x1249249249249249
+    return v
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def morton_keys(positions, boundary):
+
+    # Z-order key of every position quantized to 21 bits per axis inside boundary
+
+    n = positions.shape[0]
+    keys = np.empty(n, dtype=np.int64)
+
+    x_min, y_min, x_max, y_max = boundary[0], boundary[1], boundary[2], boundary[3]
+    x_scale = ((1 << 21) - 1) / max(x_max - x_min, 1e-300)
+    y_scale = ((1 << 21) - 1) / max(y_max - y_min, 1e-300)
+
+    for i in prange(n):
+        qx = np.int64((positions[i, 0] - x_min) * x_scale)
+        qy = np.int64((positions[i, 1] - y_min) * y_scale)
+        keys[i] = spread_bits(qx) | (spread_bits(qy) << 1)
+
+    return keys
+
+
+class BarnesHutTree:
+    def __init__(self, max_nodes=1024):
+        self.num_nodes = 0
+        self.next_body = np.empty(0, dtype=np.int64)
+        self.allocate(max_nodes)
+
+    def allocate(self, max_nodes):
+        self.max_nodes = max_nodes
+        self.children = np.empty((max_nodes, 4), dtype=np.int64)
+        self.bounds = np.empty((max_nodes, 4), dtype=np.float64)
+        self.depths = np.empty(max_nodes, dtype=np.int64)
+        self.leaf_body = np.empty(max_nodes, dtype=np.int64)
+        self.node_mass = np.empty(max_nodes, dtype=np.float64)
+        self.center_of_mass = np.empty((max_nodes, 2), dtype=np.float64)
+
+    def build(self, positions, masses, boundary):
+        n = positions.shape[0]
+        if self.next_body.shape[0] < n:
+            self.next_body = np.empty(n, dtype=np.int64)
+
+        if self.max_nodes < 4 * n + 1:
+            self.allocate(4 * n + 1)
+
+        boundary = np.asarray(boundary, dtype=np.float64)
+        while True:
+            self.num_nodes = build_tree(positions, boundary, self.children, self.bounds, self.depths,
+                                        self.leaf_body, self.next_body)
+            if self.num_nodes != -1:
+                break
+            self.allocate(2 * self.max_nodes)
+
+        compute_moments(self.num_nodes, positions, masses, self.children, self.leaf_body, self.next_body,
+                        self.node_mass, self.center_of_mass)
+
+    def refresh(self, positions, masses):
+
+        # Masses and centers of mass of the bodies after they moved, keeping the cells
+        # they were inserted into by the last build
+
+        compute_moments(self.num_nodes, positions, masses, self.children, self.leaf_body, self.next_body,
+                        self.node_mass, self.center_of_mass)
+
+    def compute_forces(self, positions, masses, theta=THETA, active=None):
+        if active is not None:
+            return compute_forces_tree_active(active, positions, masses, self.children, self.bounds, self.leaf_body,
+                                              self.next_body, self.node_mass, self.center_of_mass, theta)
+
+        return compute_forces_tree(positions, masses, self.children, self.bounds, self.leaf_body, self.next_body,
+                                   self.node_mass, self.center_of_mass, theta)
+
+    def leaf_boundaries(self):
+        nodes = np.flatnonzero(self.children[:self.num_nodes, 0] == -1)
+        return self.bounds[nodes]
@@ -0,0 +1,637 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numba
+import numpy as np
+
+from cosmos import *
+from simulation_setup import *
+from diagnostics import total_energy
+from ensemble import Ensemble
+
+# Sizes swept for each scenario, scenarios with fewer bodies only run at their own size
+DEFAULT_SIZES = (100, 300, 1000, 3000, 10000, 20000)
+
+# Largest N each engine is run at by default, the broadcasting NumPy kernel needs
+# ~64 n^2 bytes and the Python quad tree takes seconds per step beyond this
+DEFAULT_MAX_SIZES = {
+    "numpy": 3000,
+    "quadtree": 3000,
+}
+
+
+def forces_quadtree(positions, masses):
+    quad_tree = QuadTree((*positions.min(axis=0), *positions.max(axis=0)))
+    quad_tree.insert_bodies(positions, masses)
+    return quad_tree.compute_forces()
+
+
+def forces_barnes_hut(positions, masses):
+    tree = BarnesHutTree()
+    tree.build(positions, masses, (*positions.min(axis=0), *positions.max(axis=0)))
+    return tree.compute_forces(positions, masses, THETA)
+
+
+def forces_fmm(positions, masses):
+    return FastMultipole(FMM_ORDER).compute_forces(positions, masses)
+
+
+def forces_particle_mesh(positions, masses, short_range=False):
+    return ParticleMesh(short_range=short_range).compute_forces(positions, masses)
+
+
+BENCHMARK_ENGINES = {
+    "numpy": compute_forces,
+    "numpy_tiled": compute_forces_tiled,
+    "numba": compute_forces_numba,
+    "numba_deterministic": lambda positions, masses: compute_forces_numba(positions, masses,
+                                                                         DETERMINISTIC_FORCE_BLOCKS),
+    "numba_float32": lambda positions, masses: MixedPrecisionForces().compute_forces(positions, masses),
+    "quadtree": forces_quadtree,
+    "barnes_hut": forces_barnes_hut,
+    "fmm": forces_fmm,
+    "particle_mesh": forces_particle_mesh,
+    "p3m": lambda positions, masses: forces_particle_mesh(positions, masses, short_range=True),
+}
+
+
+def load_scenario(name, seed):
+    cosmos = Cosmos()
+    SCENARIOS[name](cosmos, seed)
+
+    return cosmos.positions.copy(), cosmos.masses.copy()
+
+
+def force_error(forces, reference):
+
+    # Relative error of every body's force against the direct sum of compute_forces_numba
+
+    error = np.linalg.norm(forces - reference, axis=1) / np.maximum(np.linalg.norm(reference, axis=1), 1e-300)
+    return {
+        "median": float(np.median(error)),
+        "p99": float(np.percentile(error, 99)),
+        "max": float(error.max()),
+    }
+
+
+def time_call(function, positions, masses):
+    start = time.perf_counter()
+    function(positions, masses)
+    return time.perf_counter() - start
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(engines, scenarios, sizes, repeats, max_sizes, seed, accuracy=False):
+    results = []
+
+    # JIT compilation is measured once per engine on a tiny input, apart from steady state
+    warmup_positions, warmup_masses = load_scenario("three", seed)
+    warmup = {name: time_call(BENCHMARK_ENGINES[name], warmup_positions, warmup_masses) for name in engines}
+
+    for scenario in scenarios:
+        positions, masses = load_scenario(scenario, seed)
+        total = positions.shape[0]
+
+        scenario_sizes = sorted({min(n, total) for n in sizes})
+
+        for n in scenario_sizes:
+            sample_positions = np.ascontiguousarray(positions[:n])
+            sample_masses = np.ascontiguousarray(masses[:n])
+
+            reference = compute_forces_numba(sample_positions, sample_masses) if accuracy else None
+
+            for name in engines:
+                if n > max_sizes.get(name, n):
+                    continue
+
+                function = BENCHMARK_ENGINES[name]
+                first_call = time_call(function, sample_positions, sample_masses)
+                times = [time_call(function, sample_positions, sample_masses) for _ in range(repeats)]
+
+                median = statistics.median(times)
+                result = {
+                    "engine": name,
+                    "scenario": scenario,
+                    "n": n,
+                    "first_call_s": first_call,
+                    "times_s": times,
+                    "median_s": median,
+                    "min_s": min(times),
+                    "interactions_per_s": n * (n - 1) / median if median > 0 else None,
+                }
+                line = f"{scenario:>13} {name:>20} n={n:<6} median {median:.6f} s  min {min(times):.6f} s"
+
+                if accuracy:
+                    result["force_error"] = force_error(function(sample_positions, sample_masses), reference)
+                    line += f"  error median {result['force_error']['median']:.2e}"
+
+                results.append(result)
+                print(line)
+
+    return warmup, results
+
+
+def worker_counts(max_workers):
+    counts = [1]
+    while counts[-1] * 2 < max_workers:
+        counts.append(counts[-1] * 2)
+    if max_workers > 1:
+        counts.append(max_workers)
+    return counts
+
+
+def run_strong_scaling(scenarios, n, repeats, max_workers, seed):
+
+    # Fixed problem size, increasing process count for the domain-decomposed Barnes-Hut
+
+    results = []
+
+    for scenario in scenarios:
+        positions, masses = load_scenario(scenario, seed)
+        positions = np.ascontiguousarray(positions[:n])
+        masses = np.ascontiguousarray(masses[:n])
+
+        baseline = None
+        for num_workers in worker_counts(max_workers):
+            engine = ParallelBarnesHut(positions.shape[0], num_workers)
+            first_call = time_call(lambda p, m: engine.compute_forces(p, m, THETA), positions, masses)
+            times = [time_call(lambda p, m: engine.compute_forces(p, m, THETA), positions, masses)
+                     for _ in range(repeats)]
+            engine.close()
+
+            median = statistics.median(times)
+            if baseline is None:
+                baseline = median
+
+            results.append({
+                "engine": "parallel_barnes_hut",
+                "scenario": scenario,
+                "n": positions.shape[0],
+                "workers": num_workers,
+                "first_call_s": first_call,
+                "times_s": times,
+                "median_s": median,
+                "speedup": baseline / median,
+                "efficiency": baseline / median / num_workers,
+            })
+
+            print(f"{scenario:>13} workers={num_workers:<4} n={positions.shape[0]:<8} median {median:.6f} s  "
+                  f"speedup {baseline / median:.2f}")
+
+    return results
+
+
+def run_block_timesteps(scenario, steps, max_level, tree, seed):
+
+    # Energy error and time of block timesteps over steps * dt, against global steps of
+    # dt / 2^k with the same leapfrog (a block integrator with a single level), refining k
+    # until the global run is at least as accurate
+
+    def integrate(max_level, step_dt, num_steps):
+        cosmos = Cosmos()
+        _, _, dt = SCENARIOS[scenario](cosmos, seed)
+
+        energy = total_energy(cosmos)
+        cosmos.block_timesteps = BlockTimesteps(max_level)
+        cosmos.accelerations_computed[:] = False
+
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            cosmos.update_block(step_dt(dt), tree)
+        elapsed = time.perf_counter() - start
+
+        return {
+            "max_level": max_level,
+            "steps": num_steps,
+            "time_s": elapsed,
+            "energy_error": abs(total_energy(cosmos) - energy) / abs(energy),
+            "force_evaluations": cosmos.block_timesteps.force_evaluations,
+            "level_counts": cosmos.block_timesteps.level_counts(cosmos.timestep_levels).tolist(),
+        }
+
+    # Compiles the kernels both kinds of run share, apart from the timed runs
+    integrate(max_level, lambda dt: dt, 1)
+
+    block = integrate(max_level, lambda dt: dt, steps)
+    print(f"{scenario:>13} block    levels<={max_level} {block['time_s']:.3f} s  "
+          f"energy error {block['energy_error']:.3e}  bodies per level {block['level_counts']}")
+
+    result = {
+        "engine": "block_barnes_hut" if tree else "block_numba",
+        "scenario": scenario,
+        "block": block,
+        "global": [],
+        "speedup": None,
+    }
+
+    for k in range(max_level + 1):
+        run = integrate(0, lambda dt: dt / 2 ** k, steps * 2 ** k)
+        run["dt_divisor"] = 2 ** k
+        result["global"].append(run)
+        print(f"{scenario:>13} global   dt/{2 ** k:<8} {run['time_s']:.3f} s  energy error {run['energy_error']:.3e}")
+
+        if run["energy_error"] <= block["energy_error"]:
+            result["speedup"] = run["time_s"] / block["time_s"]
+            print(f"{scenario:>13} speedup at equal energy error {result['speedup']:.2f}")
+            break
+
+    return result
+
+
+def run_integrators(scenario, steps, integrators, engine, seed):
+
+    # Energy error of each integrator over steps * dt of the scenario, at dt and at
+    # growing multiples of it, to find the largest dt each one tolerates
+
+    results = []
+
+    for integrator in integrators:
+        for multiple in (1, 2, 4, 8, 16):
+            cosmos = Cosmos(integrator=integrator)
+            _, _, dt = SCENARIOS[scenario](cosmos, seed)
+
+            energy = total_energy(cosmos)
+            num_steps = max(steps // multiple, 1)
+
+            start = time.perf_counter()
+            for _ in range(num_steps):
+                ENGINES[engine](cosmos, dt * multiple)
+            elapsed = time.perf_counter() - start
+
+            error = abs(total_energy(cosmos) - energy) / abs(energy)
+            results.append({
+                "engine": engine,
+                "integrator": integrator,
+                "scenario": scenario,
+                "dt_s": dt * multiple,
+                "steps": num_steps,
+                "time_s": elapsed,
+                "energy_error": error,
+            })
+
+            print(f"{scenario:>13} {integrator:>10} dt {dt * multiple:<10g} {elapsed:.3f} s  energy error {error:.3e}")
+
+    return results
+
+
+def run_tree_build(scenario, steps, seed):
+
+    # Per-step cost of keeping the update_qt quad tree current, rebuilt from scratch
+    # every step against maintained incrementally
+
+    results = []
+
+    for incremental in (False, True):
+        cosmos = Cosmos()
+        _, _, dt = SCENARIOS[scenario](cosmos, seed)
+        cosmos.quad_tree.incremental = incremental
+
+        build_times = []
+        moved = []
+        rebuilds = 0
+        start = time.perf_counter()
+        for _ in range(steps):
+            cosmos.update_qt(dt)
+            build_times.append(cosmos.quad_tree.build_time)
+            moved.append(cosmos.quad_tree.moved)
+            rebuilds += cosmos.quad_tree.rebuilt
+        elapsed = time.perf_counter() - start
+
+        results.append({
+            "engine": "quadtree",
+            "scenario": scenario,
+            "n": cosmos.num_bodies,
+            "incremental": incremental,
+            "steps": steps,
+            "build_times_s": build_times,
+            "median_build_s": statistics.median(build_times),
+            "rebuilds": rebuilds,
+            "moved": moved,
+            "time_s": elapsed,
+        })
+
+        label = "incremental" if incremental else "rebuild"
+        print(f"{scenario:>13} {label:>11} median build {statistics.median(build_times):.4f} s  "
+              f"rebuilds {rebuilds}  median moved {statistics.median(moved):g}  total {elapsed:.2f} s")
+
+    return results
+
+
+def run_reorder(scenarios, repeats, seed):
+
+    # Force and tree times with the bodies in creation order against sorted by Morton key
+
+    results = []
+
+    for scenario in scenarios:
+        positions, masses = load_scenario(scenario, seed)
+        boundary = np.array([*positions.min(axis=0), *positions.max(axis=0)])
+        order = np.argsort(morton_keys(positions, boundary), kind="stable")
+
+        for label, permutation in (("creation", np.arange(positions.shape[0])), ("morton", order)):
+            sample_positions = np.ascontiguousarray(positions[permutation])
+            sample_masses = np.ascontiguousarray(masses[permutation])
+
+            tree = BarnesHutTree()
+            phases = {
+                "numba": lambda: compute_forces_numba(sample_positions, sample_masses),
+                "tree_build": lambda: tree.build(sample_positions, sample_masses, boundary),
+                "tree_walk": lambda: tree.compute_forces(sample_positions, sample_masses, THETA),
+            }
+
+            result = {"scenario": scenario, "n": positions.shape[0], "order": label}
+            for phase, function in phases.items():
+                function()
+                times = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    function()
+                    times.append(time.perf_counter() - start)
+                result[phase + "_s"] = statistics.median(times)
+
+            results.append(result)
+            print(f"{scenario:>13} {label:>8} n={positions.shape[0]:<6} numba {result['numba_s']:.6f} s  "
+                  f"tree build {result['tree_build_s']:.6f} s  tree walk {result['tree_walk_s']:.6f} s")
+
+    return results
+
+
+def run_precision(scenarios, repeats, seed):
+
+    # Throughput and force error of the float32 direct sum against the float64 one, the
+    # float32 kernel evaluates every pair from both ends so interactions are counted as n^2
+
+    results = []
+
+    for scenario in scenarios:
+        positions, masses = load_scenario(scenario, seed)
+        n = positions.shape[0]
+        mixed_precision = MixedPrecisionForces()
+
+        engines = {
+            "float64": lambda: compute_forces_numba(positions, masses),
+            "float32": lambda: mixed_precision.compute_forces(positions, masses),
+        }
+
+        forces = {}
+        times = {}
+        for label, function in engines.items():
+            forces[label] = function()
+            samples = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                function()
+                samples.append(time.perf_counter() - start)
+            times[label] = statistics.median(samples)
+
+        result = {
+            "scenario": scenario,
+            "n": n,
+            "float64_s": times["float64"],
+            "float32_s": times["float32"],
+            "speedup": times["float64"] / times["float32"],
+            "float32_interactions_per_s": n * n / times["float32"],
+            "error": force_error(forces["float32"], forces["float64"]),
+        }
+        results.append(result)
+
+        print(f"{scenario:>13} n={n:<6} float64 {times['float64']:.4f} s  float32 {times['float32']:.4f} s  "
+              f"speedup {result['speedup']:.2f}  median error {result['error']['median']:.2e}  "
+              f"max error {result['error']['max']:.2e}")
+
+    return results
+
+
+def run_startup(scenarios, engines, repeats):
+
+    # Wall time of a fresh headless process running one step, first with an empty kernel
+    # cache (every kernel compiles) and then repeats times with the cache it filled
+
+    pattern = re.compile(r"imports ([\d.]+) s, setup ([\d.]+) s, warm-up [\d.]+ s, first step ([\d.]+) s")
+    results = []
+
+    for scenario in scenarios:
+        for engine in engines:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                command = [sys.executable, "headless.py", "--scenario", scenario, "--engine", engine, "--steps", "1"]
+                environment = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+
+                runs = []
+                for _ in range(repeats + 1):
+                    start = time.perf_counter()
+                    output = subprocess.run(command, env=environment, capture_output=True, text=True, check=True,
+                                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+                    imports, setup, first_step = map(float, pattern.search(output).groups())
+                    runs.append({"total_s": time.perf_counter() - start, "imports_s": imports, "setup_s": setup,
+                                 "first_step_s": first_step})
+
+            warm = {key: statistics.median(run[key] for run in runs[1:]) for key in runs[0]}
+            results.append({"scenario": scenario, "engine": engine, "cold": runs[0], "warm": warm})
+
+            print(f"{scenario:>13} {engine:>21} cold {runs[0]['total_s']:.3f} s  warm {warm['total_s']:.3f} s  "
+                  f"(imports {warm['imports_s']:.3f} s, first step {warm['first_step_s']:.3f} s)")
+
+    return results
+
+
+def run_ensemble(scenarios, num_members, num_steps, seed):
+
+    # Member steps per second of an Ensemble of num_members perturbed copies of each
+    # scenario, against stepping one Cosmos per member with the numba engine
+
+    results = []
+
+    for scenario in scenarios:
+        cosmos = Cosmos()
+        _, _, dt = SCENARIOS[scenario](cosmos, seed)
+        ensemble = Ensemble.from_cosmos(cosmos, num_members, seed, velocity_spread=0.01)
+
+        cosmos.update_numba(dt)
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            cosmos.update_numba(dt)
+        cosmos_rate = num_steps / (time.perf_counter() - start)
+
+        Ensemble.from_cosmos(cosmos, 2).run(dt, 1)
+        start = time.perf_counter()
+        ensemble.run(dt, num_steps)
+        elapsed = time.perf_counter() - start
+        ensemble_rate = ensemble.steps.sum() / elapsed
+
+        result = {
+            "scenario": scenario,
+            "n": cosmos.num_bodies,
+            "members": num_members,
+            "steps": num_steps,
+            "ensemble_s": elapsed,
+            "cosmos_member_steps_per_s": cosmos_rate,
+            "ensemble_member_steps_per_s": ensemble_rate,
+            "speedup": ensemble_rate / cosmos_rate,
+            "counts": ensemble.counts(),
+        }
+        results.append(result)
+
+        print(f"{scenario:>13} n={cosmos.num_bodies:<4} {num_members} members  cosmos {cosmos_rate:.3g} steps/s  "
+              f"ensemble {ensemble_rate:.3g} member steps/s  speedup {result['speedup']:.0f}")
+
+    return results
+
+
+def run_render(sizes, zooms, repeats, seed):
+
+    # Time of draw_bodies per frame on a multi_grid of each size, body by body against the
+    # density map, at the scenario's scale and zoomed out by each factor. Imports pygame
+    # with a dummy video driver, so it runs without a display
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    from render import draw_bodies, DensityMap
+
+    surface = pygame.Surface(DEFAULT_SCREEN_SIZE)
+    results = []
+
+    for n in sizes:
+        cosmos = Cosmos()
+        _, scale, _ = setup_multi_grid(cosmos, seed, n)
+
+        for zoom in zooms:
+            zoom_scale = float(scale * zoom)
+            view_center = get_gui_position((0, 0), zoom_scale, [DEFAULT_SCREEN_SIZE[0] // 2,
+                                                                DEFAULT_SCREEN_SIZE[1] // 2])
+            density_map = DensityMap()
+
+            times = {}
+            for label, argument in (("points", None), ("density_map", density_map)):
+                draw_bodies(surface, cosmos, zoom_scale, view_center, argument)
+                samples = []
+                for _ in range(repeats):
+                    surface.fill(SCREEN_COLOR)
+                    start = time.perf_counter()
+                    draw_bodies(surface, cosmos, zoom_scale, view_center, argument)
+                    samples.append(time.perf_counter() - start)
+                times[label] = statistics.median(samples)
+
+            result = {
+                "n": n,
+                "zoom": zoom,
+                "density_map_active": bool(density_map.active),
+                "points_s": times["points"],
+                "density_map_s": times["density_map"],
+                "speedup": times["points"] / times["density_map"],
+            }
+            results.append(result)
+
+            print(f"n={n:<8} zoom {zoom:<4} points {times['points'] * 1e3:8.2f} ms  "
+                  f"density map {times['density_map'] * 1e3:8.2f} ms ({'on' if density_map.active else 'off'})  "
+                  f"speedup {result['speedup']:.2f}")
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every force engine across scenarios and body counts")
+    parser.add_argument("--engines", nargs="+", choices=sorted(BENCHMARK_ENGINES), default=list(BENCHMARK_ENGINES))
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-size", nargs=2, action="append", metavar=("ENGINE", "N"), default=[],
+                        help="override the largest N an engine is run at")
+    parser.add_argument("--accuracy", action="store_true",
+                        help="also report each engine's force error against compute_forces_numba")
+    parser.add_argument("--strong-scaling", type=int, metavar="N",
+                        help="instead time the parallel Barnes-Hut at N bodies from 1 up to all cores")
+    parser.add_argument("--block-timesteps", type=int, metavar="STEPS",
+                        help="instead compare block timesteps with global steps over STEPS * dt of each scenario")
+    parser.add_argument("--block-tree", action="store_true",
+                        help="use the Barnes-Hut tree for forces in the block timestep comparison")
+    parser.add_argument("--integrators", type=int, metavar="STEPS",
+                        help="instead compare the energy error of every integrator over STEPS * dt, at 1 to 16 dt")
+    parser.add_argument("--integrator-engine", choices=sorted(ENGINES), default="numba")
+    parser.add_argument("--tree-build", type=int, metavar="STEPS",
+                        help="instead time building the update_qt quad tree over STEPS steps, rebuilt vs incremental")
+    parser.add_argument("--reorder", action="store_true",
+                        help="instead time direct sum and tree phases in creation against Morton order")
+    parser.add_argument("--precision", action="store_true",
+                        help="instead compare the float32 direct sum with the float64 one, speed and force error")
+    parser.add_argument("--startup", nargs="+", choices=sorted(ENGINES), metavar="ENGINE",
+                        help="instead time starting a headless run of each engine, with a cold and a warm kernel cache")
+    parser.add_argument("--render", nargs="+", type=int, metavar="N",
+                        help="instead time drawing a multi_grid of each N, body by body against the density map")
+    parser.add_argument("--render-zooms", nargs="+", type=float, default=[1, 10],
+                        help="zoom out factors the render benchmark views each grid at")
+    parser.add_argument("--ensemble", type=int, metavar="MEMBERS",
+                        help="instead time an ensemble of MEMBERS perturbed copies of each scenario against a Cosmos")
+    parser.add_argument("--ensemble-steps", type=int, default=1000)
+    parser.add_argument("--max-workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args(argv)
+
+    max_sizes = dict(DEFAULT_MAX_SIZES)
+    max_sizes.update({engine: int(n) for engine, n in args.max_size})
+
+    warmup = {}
+    if args.ensemble is not None:
+        results = run_ensemble(args.scenarios, args.ensemble, args.ensemble_steps, args.seed)
+    elif args.render is not None:
+        results = run_render(args.render, args.render_zooms, args.repeats, args.seed)
+    elif args.precision:
+        results = run_precision(args.scenarios, args.repeats, args.seed)
+    elif args.startup is not None:
+        results = run_startup(args.scenarios, args.startup, args.repeats)
+    elif args.reorder:
+        results = run_reorder(args.scenarios, args.repeats, args.seed)
+    elif args.tree_build is not None:
+        results = [result for scenario in args.scenarios
+                   for result in run_tree_build(scenario, args.tree_build, args.seed)]
+    elif args.integrators is not None:
+        results = [result for scenario in args.scenarios
+                   for result in run_integrators(scenario, args.integrators, list(INTEGRATORS),
+                                                 args.integrator_engine, args.seed)]
+    elif args.block_timesteps is not None:
+        results = [run_block_timesteps(scenario, args.block_timesteps, BLOCK_MAX_LEVEL, args.block_tree, args.seed)
+                   for scenario in args.scenarios]
+    elif args.strong_scaling is not None:
+        results = run_strong_scaling(args.scenarios, args.strong_scaling, args.repeats, args.max_workers, args.seed)
+    else:
+        warmup, results = run_benchmarks(args.engines, args.scenarios, args.sizes, args.repeats, max_sizes,
+                                         args.seed, args.accuracy)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba.__version__,
+        "machine": platform.machine(),
+        "threads": numba.get_num_threads(),
+        "seed": args.seed,
+        "repeats": args.repeats,
+        "warmup_s": warmup,
+        "results": results,
+    }
+
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import math
+import numpy as np
+from jit import njit, prange
+
+from constants import *
+
+# Hierarchical (block) timesteps for the kick-drift-kick leapfrog. A step of dt is split
+# into 2^max_level ticks and every body steps with dt / 2^level, so the steps nest and
+# bodies on the same level are always kicked together:
+#   - at the start of its step a body gets a half kick with its current acceleration
+#   - all bodies drift to the next tick where any step ends
+#   - bodies whose step ends there get new forces, the closing half kick and a new level
+# A body may only move to a coarser level at a tick that is a multiple of the coarser step,
+# and every body is synchronized again at the end of dt
+
+CRITERIA = {
+    "acceleration": 0,
+    "jerk": 1,
+}
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def choose_levels(active, accelerations, previous_accelerations, has_previous, criterion, eta, dt, max_level,
+                  tick, levels):
+    total_ticks = 1 << max_level
+
+    for a in prange(active.shape[0]):
+        i = active[a]
+        acceleration = math.sqrt(accelerations[i, 0] ** 2 + accelerations[i, 1] ** 2)
+
+        step = math.inf
+        if criterion == 1 and has_previous[a]:
+            # Jerk estimated from the change in acceleration over the step just taken
+            previous_step = dt / (1 << levels[i])
+            jerk = math.sqrt((accelerations[i, 0] - previous_accelerations[a, 0]) ** 2 +
+                             (accelerations[i, 1] - previous_accelerations[a, 1]) ** 2) / previous_step
+            if jerk > 0:
+                step = eta * acceleration / jerk
+        elif acceleration > 0:
+            step = math.sqrt(2 * eta * EPSILON / acceleration)
+
+        level = 0
+        if step < dt:
+            level = min(int(math.ceil(math.log2(dt / step))), max_level)
+
+        # Coarser steps have to start on a tick aligned with them
+        while level < levels[i] and tick % (total_ticks >> level) != 0:
+            level += 1
+
+        levels[i] = level
+
+
+class BlockTimesteps:
+    def __init__(self, max_level=BLOCK_MAX_LEVEL, eta=BLOCK_TIMESTEP_ETA, criterion=BLOCK_CRITERION):
+        self.max_level = max_level
+        self.eta = eta
+        self.criterion = CRITERIA[criterion]
+
+        # Totals since creation, force_evaluations counts bodies not calls
+        self.steps = 0
+        self.substeps = 0
+        self.force_evaluations = 0
+
+    def step(self, cosmos, dt, compute_forces):
+
+        # compute_forces(active) returns the net forces on the bodies listed in active,
+        # evaluated at the current positions of every body
+
+        total_ticks = 1 << self.max_level
+        tick_dt = dt / total_ticks
+
+        positions = cosmos.positions
+        velocities = cosmos.velocities
+        accelerations = cosmos.accelerations
+        masses = cosmos.masses
+        levels = cosmos.timestep_levels
+
+        # New bodies (and every body on the first step) need an acceleration to start from
+        new = np.flatnonzero(~cosmos.accelerations_computed)
+        if new.shape[0] > 0:
+            levels[new] = 0
+            self.evaluate(cosmos, new, compute_forces)
+            choose_levels(new, accelerations, accelerations[new], np.zeros(new.shape[0], dtype=np.bool_),
+                          self.criterion, self.eta, dt, self.max_level, 0, levels)
+            cosmos.accelerations_computed[new] = True
+
+        cosmos.record_trails()
+
+        tick = 0
+        while tick < total_ticks:
+            strides = total_ticks >> levels
+
+            starting = np.flatnonzero(tick % strides == 0)
+            velocities[starting] += 0.5 * accelerations[starting] * (strides[starting] * tick_dt)[:, np.newaxis]
+
+            stride = total_ticks >> int(levels.max())
+            next_tick = (tick // stride + 1) * stride
+            positions += velocities * ((next_tick - tick) * tick_dt)
+            tick = next_tick
+
+            ending = np.flatnonzero(tick % strides == 0)
+            previous_accelerations = accelerations[ending]
+            self.evaluate(cosmos, ending, compute_forces)
+            velocities[ending] += 0.5 * accelerations[ending] * (strides[ending] * tick_dt)[:, np.newaxis]
+
+            choose_levels(ending, accelerations, previous_accelerations, np.ones(ending.shape[0], dtype=np.bool_),
+                          self.criterion, self.eta, dt, self.max_level, tick, levels)
+
+            self.substeps += 1
+
+        self.steps += 1
+
+    def evaluate(self, cosmos, active, compute_forces):
+        forces = compute_forces(active)
+        cosmos.net_forces[active] = forces
+        cosmos.accelerations[active] = forces / cosmos.masses[active, np.newaxis]
+
+        self.force_evaluations += active.shape[0]
+
+    def level_counts(self, levels):
+        return np.bincount(levels, minlength=self.max_level + 1)
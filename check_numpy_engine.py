@@ -0,0 +1,60 @@
+import argparse
+import sys
+import time
+
+# Runs the "numpy" engine the way it runs on a machine without numba: numba is blocked
+# before anything imports it, so "import numba" raises ImportError. Checks that the
+# simulation modules import, that compute_forces_tiled matches the broadcasting direct
+# sum, and that every integrator steps the bodies through the tiled path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the numpy engine with numba unavailable")
+    parser.add_argument("--num-bodies", type=int, default=500)
+    parser.add_argument("--steps", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    sys.modules["numba"] = None
+
+    import numpy as np
+
+    import jit
+    from cosmos import Cosmos, ENGINES, compute_forces
+    from integrators import INTEGRATORS
+    from numpy_forces import ForceScratch, compute_forces_tiled
+    from simulation_setup import setup_multi
+
+    if jit.NUMBA_AVAILABLE:
+        raise SystemExit("numba was imported although it is blocked")
+
+    cosmos = Cosmos()
+    setup_multi(cosmos, 0, args.num_bodies)
+
+    # Tiles smaller than the body count, so several tiles and a partial one are summed
+    scratch = ForceScratch(tile_size=max(args.num_bodies // 3, 1))
+    tiled = compute_forces_tiled(cosmos.positions, cosmos.masses, scratch)
+    reference = compute_forces(cosmos.positions, cosmos.masses)
+    error = np.abs(tiled - reference).max() / np.abs(reference).max()
+    print(f"compute_forces_tiled max relative error {error:.3e}")
+    if not error < 1e-12:
+        raise SystemExit("compute_forces_tiled differs from compute_forces")
+
+    for name in sorted(INTEGRATORS):
+        cosmos = Cosmos(integrator=name)
+        _, _, dt = setup_multi(cosmos, 0, args.num_bodies)
+        start_positions = cosmos.positions.copy()
+
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            ENGINES["numpy"](cosmos, dt)
+        elapsed = time.perf_counter() - start
+
+        print(f"{name:>9} {args.steps} steps of {cosmos.num_bodies} bodies in {elapsed:.3f} s")
+        if not np.isfinite(cosmos.positions).all() or np.array_equal(cosmos.positions, start_positions):
+            raise SystemExit(f"the {name} integrator did not step the bodies")
+
+    print("numpy engine runs without numba")
+
+
+if __name__ == "__main__":
+    main()
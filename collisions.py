@@ -0,0 +1,145 @@
+import numpy as np
+from jit import njit, prange
+
+from constants import *
+
+# Overlap detection on a uniform grid of cells at least as wide as two radii, hashed into
+# a table of ~2 buckets per body so the grid never has to cover the (possibly huge)
+# bounding box. The few bodies too large for the cells are tested against every body
+
+
+@njit(nogil=True, cache=True)
+def cell_hash(cx, cy, mask):
+    return ((cx * 73856093) ^ (cy * 19349663)) & mask
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def find_overlaps(positions, radii, cells, sorted_bodies, bucket_start, mask, big, counts, offsets, pairs):
+
+    # Called twice: first with pairs empty to count the overlaps of each body, then to
+    # write them at offsets. A pair (i, j) is reported once, by the smaller row
+
+    n = positions.shape[0]
+    write = pairs.shape[0] > 0
+
+    for i in prange(n):
+        count = 0
+        x = positions[i, 0]
+        y = positions[i, 1]
+
+        if big[i]:
+            for j in range(n):
+                if j == i or (big[j] and j < i):
+                    continue
+                dx = positions[j, 0] - x
+                dy = positions[j, 1] - y
+                reach = radii[i] + radii[j]
+                if dx * dx + dy * dy < reach * reach:
+                    if write:
+                        pairs[offsets[i] + count, 0] = min(i, j)
+                        pairs[offsets[i] + count, 1] = max(i, j)
+                    count += 1
+        else:
+            visited = np.empty(9, dtype=np.int64)
+            num_visited = 0
+            for ox in range(-1, 2):
+                for oy in range(-1, 2):
+                    bucket = cell_hash(cells[i, 0] + ox, cells[i, 1] + oy, mask)
+
+                    # Neighbouring cells can share a bucket, which must only be scanned once
+                    seen = False
+                    for v in range(num_visited):
+                        if visited[v] == bucket:
+                            seen = True
+                    if seen:
+                        continue
+                    visited[num_visited] = bucket
+                    num_visited += 1
+
+                    for k in range(bucket_start[bucket], bucket_start[bucket + 1]):
+                        j = sorted_bodies[k]
+                        if j <= i:
+                            continue
+                        dx = positions[j, 0] - x
+                        dy = positions[j, 1] - y
+                        reach = radii[i] + radii[j]
+                        if dx * dx + dy * dy < reach * reach:
+                            if write:
+                                pairs[offsets[i] + count, 0] = i
+                                pairs[offsets[i] + count, 1] = j
+                            count += 1
+
+        counts[i] = count
+
+
+def collision_pairs(positions, radii, max_big=COLLISION_MAX_BIG):
+
+    # (k, 2) rows of overlapping bodies, i < j
+
+    n = positions.shape[0]
+    if n < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # Cells fit every body but the max_big largest, which are tested against all bodies
+    sorted_radii = np.sort(radii)
+    cell_size = max(2 * sorted_radii[max(n - 1 - max_big, 0)], 1e-300)
+    big = radii > cell_size / 2
+
+    cells = np.floor((positions - positions.min(axis=0)) / cell_size).astype(np.int64)
+
+    table_size = 1 << int(np.ceil(np.log2(2 * n)))
+    buckets = cell_hash(cells[:, 0], cells[:, 1], table_size - 1)
+    buckets[big] = table_size  # kept out of the table
+    sorted_bodies = np.argsort(buckets, kind="stable")
+    bucket_start = np.zeros(table_size + 2, dtype=np.int64)
+    bucket_start[1:] = np.cumsum(np.bincount(buckets, minlength=table_size + 1))
+
+    counts = np.zeros(n, dtype=np.int64)
+    offsets = np.zeros(n, dtype=np.int64)
+    empty = np.zeros((0, 2), dtype=np.int64)
+    find_overlaps(positions, radii, cells, sorted_bodies, bucket_start, table_size - 1, big, counts, offsets, empty)
+
+    offsets[1:] = np.cumsum(counts)[:-1]
+    pairs = np.empty((counts.sum(), 2), dtype=np.int64)
+    if pairs.shape[0] > 0:
+        find_overlaps(positions, radii, cells, sorted_bodies, bucket_start, table_size - 1, big, counts, offsets,
+                      pairs)
+
+    return pairs
+
+
+@njit(nogil=True, cache=True)
+def merge_targets(pairs, masses):
+
+    # Row each body merges into: groups of touching bodies (union-find over the pairs)
+    # all merge into their most massive member
+
+    n = masses.shape[0]
+    parent = np.arange(n)
+
+    for k in range(pairs.shape[0]):
+        a = pairs[k, 0]
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        b = pairs[k, 1]
+        while parent[b] != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    heaviest = np.full(n, -1, dtype=np.int64)
+    for i in range(n):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        parent[i] = root
+        if heaviest[root] == -1 or masses[i] > masses[heaviest[root]]:
+            heaviest[root] = i
+
+    targets = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        targets[i] = heaviest[parent[i]]
+
+    return targets
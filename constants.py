@@ -1,4 +1,11 @@
-from numba.cuda.libdevice import exp10
+import hashlib
+import os
+
+try:
+    import numba
+except ImportError:
+    # Only the NumPy code paths run without numba, see jit.py
+    numba = None
 
 # Screen Information
 WIDTH = 1000
@@ -18,9 +25,98 @@ EPSILON = 1e10
 
 USE_TAPERED_COLOR = True
 
+# Level of detail: once the visible bodies average more than DENSITY_MAP_THRESHOLD per
+# occupied pixel, render.draw_bodies draws a tone-mapped density map instead of every
+# body. Pixel brightness follows the "count", "mass" or "speed" of the bodies binned in it.
+# Binning and tone mapping cost about as much as drawing this many bodies one by one, below
+# it the density map is never tried
+DENSITY_MAP_THRESHOLD = 2.0
+DENSITY_MAP_MIN_BODIES = 100000
+DENSITY_MAP_WEIGHT = "count"
+
 THETA = 3
 
+# Accumulation blocks used by compute_forces_numba when bit-reproducible forces are requested
+DETERMINISTIC_FORCE_BLOCKS = 64
+
+# Fast multipole method: expansion order (terms with p + q < order are kept), most bodies
+# in a leaf box before it is split, the deepest level of the adaptive box tree (at most
+# 20), and the opening criterion: boxes interact through expansions once the radii of
+# their bodies add up to less than FMM_THETA times the distance between their centers
+FMM_ORDER = 8
+FMM_LEAF_SIZE = 64
+FMM_MAX_LEVELS = 16
+FMM_THETA = 0.6
+
+# Particle-mesh solver: grid points per side, mass assignment ("cic" or "tsc"), and for
+# the optional short-range correction the force split scale and direct-sum cutoff in
+# grid cells
+PM_GRID_SIZE = 256
+PM_ASSIGNMENT = "tsc"
+PM_SPLIT_CELLS = 2.0
+PM_CUTOFF_CELLS = 10.0
+
+# Integrator used by every force engine: "euler", "leapfrog", "yoshida4" or "rk4"
+INTEGRATOR = "leapfrog"
+
+# Block timesteps: bodies step with dt / 2^level for level <= BLOCK_MAX_LEVEL, chosen by
+# "jerk" (eta |a| / |da/dt|) or "acceleration" (sqrt(2 eta EPSILON / |a|))
+BLOCK_MAX_LEVEL = 8
+BLOCK_TIMESTEP_ETA = 0.02
+BLOCK_CRITERION = "jerk"
+
+# Python quad tree (update_qt) kept across steps: padding around the bodies as a fraction
+# of their extent, and the rebuild once the bodies span less than this fraction of the root
+QT_INCREMENTAL = True
+QT_BOUNDARY_MARGIN = 0.1
+QT_REBUILD_SHRINK = 0.5
+
+# Steps between sorting the body arrays by Morton key of position, 0 never reorders
+MORTON_REORDER_INTERVAL = 0
+
+# Merge overlapping bodies after every step. The spatial hash cells fit every body but
+# the COLLISION_MAX_BIG largest, which are tested against all bodies instead
+COLLISIONS = False
+COLLISION_MAX_BIG = 64
+
+# Energy and momentum monitor (diagnostics.EnergyMonitor): steps between samples, and the
+# potential summed "exact"ly over pairs or from a "tree" opened below this angle. The tree
+# error changes as the bodies move and hides drifts much below ~1e-3
+DIAGNOSTICS_INTERVAL = 10
+DIAGNOSTICS_POTENTIAL = "exact"
+DIAGNOSTICS_THETA = 0.3
+
+# Ensembles of small systems (ensemble.Ensemble): a member ends once a body that is
+# unbound from the rest is further from their center of mass than this many times the
+# member's initial radius, or once two bodies overlap. Steps per kernel call between
+# checks whether any member is still running
+ENSEMBLE_ESCAPE_FACTOR = 10.0
+ENSEMBLE_CHUNK_STEPS = 256
+
+# Per-phase timing of steps and frames (timing.PhaseTimers): samples kept for the rolling
+# statistics, and whether the game starts with the overlay shown (F3 toggles it)
+TIMING_WINDOW = 120
+TIMING_OVERLAY = False
+
+# Scratch memory (bytes) used by the tiled NumPy force path
+NUMPY_FORCE_MEMORY_BUDGET = 256 * 2 ** 20
+
 MAX_SPEED = 7e5
 MIN_SPEED = 0
 
 TRAIL_LENGTH = 0 # 100000
+
+# Older trail points kept at reduced resolution, one every TRAIL_HISTORY_STRIDE steps
+TRAIL_HISTORY_LENGTH = 0
+TRAIL_HISTORY_STRIDE = 10
+
+# Compiled kernels are cached on disk (cache=True). Numba only invalidates a cached kernel
+# when its own source file changes, but kernels freeze these constants when compiled, so
+# the cache is kept per version of this file unless NUMBA_CACHE_DIR chooses a directory
+with open(__file__, "rb") as constants_file:
+    CONSTANTS_HASH = hashlib.sha1(constants_file.read()).hexdigest()[:12]
+
+JIT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "numba", CONSTANTS_HASH)
+
+if numba is not None and not os.environ.get("NUMBA_CACHE_DIR"):
+    numba.config.CACHE_DIR = JIT_CACHE_DIR
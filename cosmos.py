@@ -1,21 +1,30 @@
 
 import math
+import time
 import numpy as np
-from numba import njit, prange
+from jit import njit, prange, get_num_threads
 
-from objects import *
 from constants import *
-from pygame.examples.go_over_there import MIN_SPEED
-
-
-@njit(fastmath=True)
+from barnes_hut import BarnesHutTree, morton_keys
+from parallel_barnes_hut import ParallelBarnesHut
+from fmm import FastMultipole
+from pm import ParticleMesh
+from mixed_precision import MixedPrecisionForces
+from block_timesteps import BlockTimesteps
+from integrators import INTEGRATORS
+from collisions import collision_pairs, merge_targets
+from timing import NULL_TIMERS
+from numpy_forces import ForceScratch, compute_forces_tiled
+
+
+@njit(fastmath=True, cache=True)
 def get_gui_position(position, scale, view_center):
     x = position[0] / scale * WIDTH - view_center[0]
     y = position[1] / scale * HEIGHT - view_center[1]
     return x, y
 
 
-@njit(fastmath=True)
+@njit(fastmath=True, cache=True)
 def taper_color(velocity):
     vx, vy = velocity
 
@@ -33,6 +42,7 @@ def taper_color(velocity):
 
 
 def draw_arrow(screen, start, angle, color, thickness, length):
+    import pygame
 
     y_length = math.sin(angle) * length
     x_length = math.cos(angle) * length
@@ -68,7 +78,30 @@ def draw_arrow(screen, start, angle, color, thickness, length):
     pygame.draw.polygon(screen, color, triangle, 0)  # Draw triangle
 
 
+def _stored_property(name, array_name):
+
+    # Reads and writes go straight to the owning Cosmos arrays once the body has been added,
+    # before that the initial state is kept on the body itself
+
+    def getter(self):
+        if self.cosmos is None:
+            return self.initial_state[name]
+        return getattr(self.cosmos, array_name)[self.index]
+
+    def setter(self, value):
+        if self.cosmos is None:
+            self.initial_state[name] = value
+        else:
+            getattr(self.cosmos, array_name)[self.index] = value
+
+    return property(getter, setter)
+
+
 class CelestialBody:
+
+    # Whether render.draw_bodies may draw this body in its batched pass
+    batch_drawn = True
+
     def __init__(self,
                  name: str,
                  mass: float,
@@ -77,75 +110,70 @@ class CelestialBody:
                  radius: float,
                  color: tuple[int, int, int]):
 
-        self.radius = radius
-        # print(name)
-
-        self.color = color
-
         self.name = name
-        self.mass = mass
-        self.position = position  # A tuple (x, y)
-        self.position_prev = position
-        self.velocity = velocity  # A tuple (vx, vy)
-        self.acceleration = (0, 0)
-        self.acceleration_computed = False
-
-        self.trail = []
-        self.net_force = (0, 0)
-
-    def update_position(self, dt):
-        self.trail.append(self.position)
-
-        self.position = (self.position[0] + self.velocity[0] * dt,
-                         self.position[1] + self.velocity[1] * dt)
 
-        if len(self.trail) > 5000:
-            self.trail.pop(0)
+        # Handle into the structure of arrays owned by a Cosmos. id is fixed when the body
+        # is added, the row (index) can change when the arrays are reordered
+        self.cosmos = None
+        self.id = -1
+
+        self.initial_state = {
+            "mass": mass,
+            "position": position,  # A tuple (x, y)
+            "velocity": velocity,  # A tuple (vx, vy)
+            "acceleration": (0, 0),
+            "net_force": (0, 0),
+            "radius": radius,
+            "color": color,
+        }
+
+    @property
+    def index(self):
+        if self.cosmos is None:
+            return -1
+        return self.cosmos.rows[self.id]
+
+    mass = _stored_property("mass", "masses")
+    position = _stored_property("position", "positions")
+    velocity = _stored_property("velocity", "velocities")
+    acceleration = _stored_property("acceleration", "accelerations")
+    net_force = _stored_property("net_force", "net_forces")
+    radius = _stored_property("radius", "radii")
+    color = _stored_property("color", "colors")
+
+    @property
+    def trail(self):
+        if self.cosmos is None:
+            return np.zeros((0, 2), dtype=np.float64)
+        return self.cosmos.ordered_trail(self.index)
 
-    def update_position_verlet(self, dt):
+    def draw(self, surface, scale, view_center):
+        draw_color = self.color
+        if USE_TAPERED_COLOR:
+            draw_color = taper_color(self.velocity)
 
-        self.trail.append(self.position)
+        self.draw_at(surface, self.position, self.radius, draw_color, scale, view_center)
 
-        self.position_prev = self.position
+    def draw_at(self, surface, position, radius, draw_color, scale, view_center):
 
-        self.position = (
-            self.position[0] + self.velocity[0] * dt + 0.5 * self.acceleration[0] * dt ** 2,
-            self.position[1] + self.velocity[1] * dt + 0.5 * self.acceleration[1] * dt ** 2,
-        )
+        # Draws the body with the given state instead of its live one, render.draw_bodies
+        # passes the rows of a Snapshot so it never reads arrays the simulation is writing
 
-        if len(self.trail) > TRAIL_LENGTH:
-            self.trail.pop(0)
+        import pygame
 
-    def draw(self, surface, scale, view_center):
-        g_radius = int(max((min(self.radius / scale * WIDTH, self.radius / scale * HEIGHT)), 1))
-        x, y = get_gui_position(self.position, scale, view_center)
+        g_radius = int(max((min(radius / scale * WIDTH, radius / scale * HEIGHT)), 1))
+        x, y = get_gui_position(position, scale, view_center)
         x = int(x)
         y = int(y)
 
         # print(self.name, g_radius, (x, y))
 
-        draw_color = self.color
-        if USE_TAPERED_COLOR:
-            draw_color = taper_color(self.velocity)
-
         if g_radius == 1:
             surface.set_at((x, y), draw_color)
         else:
             pygame.draw.circle(surface, draw_color,
                                 (x, y), g_radius, 0)
 
-    def draw_trail(self, surface, scale, view_center):
-
-        screen_size = surface.get_size()
-        for trail_position in self.trail:
-            tx, ty = get_gui_position(trail_position, scale, view_center)
-
-            if tx < 0 or tx >= screen_size[0] or ty < 0 or ty >= screen_size[1]:
-                continue
-
-            pygame.draw.circle(surface, (self.color[0] // 5 + 200, self.color[1] // 5 + 200, self.color[2] // 5 + 200),
-                               (tx, ty), 1, 0)
-
     def draw_velocity(self, surface, scale, view_center):
         magnitude = math.sqrt(self.velocity[0] ** 2 + self.velocity[1] ** 2)
         angle = math.atan(abs(self.velocity[1] / self.velocity[0]))
@@ -197,6 +225,9 @@ class CelestialBody:
 
 
 class BlackHole(CelestialBody):
+
+    batch_drawn = False
+
     def __init__(self,
                  name: str,
                  mass: float,
@@ -210,29 +241,36 @@ class BlackHole(CelestialBody):
         self.color2 = color2
 
     def draw(self, surface, scale, view_center):
-        g_radius = (min(self.radius / scale * WIDTH, self.radius / scale * HEIGHT) + 1)
+        self.draw_at(surface, self.position, self.radius, self.color, scale, view_center)
+
+    def draw_at(self, surface, position, radius, draw_color, scale, view_center):
+        import pygame
+
+        g_radius = (min(radius / scale * WIDTH, radius / scale * HEIGHT) + 1)
         o_radius = g_radius + 2  # border outline
 
-        x, y = get_gui_position(self.position, scale, view_center)
+        x, y = get_gui_position(position, scale, view_center)
 
         pygame.draw.circle(surface, self.color2, (x, y), o_radius, 0)
-        pygame.draw.circle(surface, self.color,(x, y), g_radius, 0)
+        pygame.draw.circle(surface, draw_color,(x, y), g_radius, 0)
 
 
 class BasicBody:
     def __init__(self, mass, position):
         self.mass = mass
         self.position = position
+        self.leaf = None  # QuadTreeNode currently holding this body
 
 
 class QuadTreeNode:
-    def __init__(self, boundary, depth=0):
+    def __init__(self, boundary, depth=0, parent=None):
         self.boundary = boundary  # (x_min, y_min, x_max, y_max)
         self.center_of_mass = (0, 0)
         self.total_mass = 0
         self.basic_body = None
         self.children = []
         self.depth = depth
+        self.parent = parent
 
     def is_leaf(self):
         return len(self.children) == 0
@@ -248,10 +286,10 @@ class QuadTreeNode:
         y_mid = (y_min + y_max) / 2
 
         self.children = [
-            QuadTreeNode((x_min, y_min, x_mid, y_mid), self.depth + 1),
-            QuadTreeNode((x_mid, y_min, x_max, y_mid), self.depth + 1),
-            QuadTreeNode((x_min, y_mid, x_mid, y_max), self.depth + 1),
-            QuadTreeNode((x_mid, y_mid, x_max, y_max), self.depth + 1)
+            QuadTreeNode((x_min, y_min, x_mid, y_mid), self.depth + 1, self),
+            QuadTreeNode((x_mid, y_min, x_max, y_mid), self.depth + 1, self),
+            QuadTreeNode((x_min, y_mid, x_mid, y_max), self.depth + 1, self),
+            QuadTreeNode((x_mid, y_mid, x_max, y_max), self.depth + 1, self)
         ]
 
     def update_center_of_mass(self):
@@ -283,6 +321,7 @@ class QuadTreeNode:
                 self.basic_body = basic_body
                 self.center_of_mass = basic_body.position
                 self.total_mass = basic_body.mass
+                basic_body.leaf = self
             else:  # Subdivide and redistribute bodies
                 self.subdivide()
                 self.insert(self.basic_body)
@@ -296,6 +335,49 @@ class QuadTreeNode:
         self.update_center_of_mass()
         return True
 
+    def refresh_moments(self):
+
+        # Recomputes mass and center of mass bottom up after bodies moved inside their leaves
+
+        if self.is_leaf():
+            if self.basic_body is None:
+                self.center_of_mass = (0, 0)
+                self.total_mass = 0
+            else:
+                self.center_of_mass = self.basic_body.position
+                self.total_mass = self.basic_body.mass
+            return
+
+        for child in self.children:
+            child.refresh_moments()
+
+        self.update_center_of_mass()
+
+    def collapse(self):
+
+        # Merges the ancestors of this node back into leaves while they hold at most one
+        # body, so the tree stays the one a fresh insertion would build
+
+        node = self
+        while node is not None:
+            if not node.is_leaf():
+                if not all(child.is_leaf() for child in node.children):
+                    break
+
+                remaining = [child.basic_body for child in node.children if child.basic_body is not None]
+                if len(remaining) > 1:
+                    break
+
+                for child in node.children:
+                    child.basic_body = None
+
+                node.children = []
+                node.basic_body = remaining[0] if remaining else None
+                if node.basic_body is not None:
+                    node.basic_body.leaf = node
+
+            node = node.parent
+
     def calculate_force(self, basic_body):
         if self.total_mass == 0 or (self.basic_body == basic_body):
             return 0, 0
@@ -325,75 +407,133 @@ class QuadTreeNode:
 
 
 class QuadTree:
-    def __init__(self, boundary):
+    def __init__(self, boundary, incremental=QT_INCREMENTAL):
         self.root = QuadTreeNode(boundary)
+        self.basic_bodies = []
+        self.incremental = incremental
 
+        # Bodies' positions, which BasicBody.position rows view, and their leaves' boundaries
+        self.positions = np.zeros((0, 2), dtype=np.float64)
+        self.masses = np.zeros(0, dtype=np.float64)
+        self.leaf_bounds = np.zeros((0, 4), dtype=np.float64)
 
-def compute_gravitational_force(body1: CelestialBody, body2: CelestialBody):
-    dx = body2.position[0] - body1.position[0]
-    dy = body2.position[1] - body1.position[1]
+        # Cost of the last update, for measuring incremental maintenance against rebuilds
+        self.build_time = 0.0
+        self.rebuilt = False
+        self.moved = 0
 
-    distance_squared = dx ** 2 + dy ** 2
-    softened_distance_squared = distance_squared + EPSILON ** 2
-    softened_distance = math.sqrt(softened_distance_squared)
+    def insert_bodies(self, positions, masses):
+        self.positions = positions.copy()
+        self.masses = masses.copy()
+        self.basic_bodies = [BasicBody(masses[i], self.positions[i]) for i in range(positions.shape[0])]
 
-    force = G_CONSTANT * body1.mass * body2.mass / softened_distance_squared
-    force_x = force * dx / softened_distance
-    force_y = force * dy / softened_distance
+        for basic_body in self.basic_bodies:
+            self.root.insert(basic_body)
 
-    return force_x, force_y
+        self.update_leaf_bounds()
 
+    def update_leaf_bounds(self):
+        self.leaf_bounds = np.array([basic_body.leaf.boundary for basic_body in self.basic_bodies],
+                                    dtype=np.float64).reshape(-1, 4)
 
-def update_velocity(body: CelestialBody, net_force: tuple[float, float], dt: int):
+    def rebuild(self, positions, masses):
+        low = positions.min(axis=0)
+        high = positions.max(axis=0)
 
-    ax = net_force[0] / body.mass
-    ay = net_force[1] / body.mass
+        # Incremental trees get room around the bodies so they can drift without a rebuild
+        margin = QT_BOUNDARY_MARGIN * max(high[0] - low[0], high[1] - low[1]) if self.incremental else 0
 
-    body.velocity = (body.velocity[0] + ax * dt, body.velocity[1] + ay * dt)
-    body.acceleration = (ax, ay)
+        self.root = QuadTreeNode((low[0] - margin, low[1] - margin, high[0] + margin, high[1] + margin))
+        self.insert_bodies(positions, masses)
 
+    def needs_rebuild(self, positions):
+        if not self.incremental or positions.shape[0] != len(self.basic_bodies):
+            return True
 
-def update_velocity_verlet(body: CelestialBody, net_force: tuple[float, float], dt: int):
+        x_min, y_min, x_max, y_max = self.root.boundary
+        low = positions.min(axis=0)
+        high = positions.max(axis=0)
+        if low[0] < x_min or low[1] < y_min or high[0] > x_max or high[1] > y_max:
+            return True
 
-    """
+        # Bodies gathered into a small part of the root waste levels on every walk
+        extent = max(high[0] - low[0], high[1] - low[1])
+        return bool(extent < QT_REBUILD_SHRINK * max(x_max - x_min, y_max - y_min))
 
-    Verlet Integration method
+    def update(self, positions, masses):
 
-    Error of O(dt^-3)
+        # Keeps the tree across steps: bodies still inside their leaf only need the moments
+        # refreshed, the others are reinserted from the nearest ancestor containing them
 
-    """
+        start_time = time.perf_counter()
 
-    ax = net_force[0] / body.mass
-    ay = net_force[1] / body.mass
+        self.rebuilt = self.needs_rebuild(positions)
+        self.moved = 0
 
-    body.velocity = (
-        body.velocity[0] + 0.5 * (body.acceleration[0] + ax) * dt,
-        body.velocity[1] + 0.5 * (body.acceleration[1] + ay) * dt,
-    )
+        if self.rebuilt:
+            self.rebuild(positions, masses)
+        else:
+            self.positions[:] = positions
+            if not np.array_equal(self.masses, masses):
+                self.masses[:] = masses
+                for basic_body, mass in zip(self.basic_bodies, masses):
+                    basic_body.mass = mass
+
+            outside = np.flatnonzero(np.any((positions < self.leaf_bounds[:, :2]) |
+                                            (positions > self.leaf_bounds[:, 2:]), axis=1))
+            self.move([self.basic_bodies[i] for i in outside])
+
+            if outside.shape[0] > 0:
+                self.update_leaf_bounds()
+
+            self.root.refresh_moments()
+            self.moved = outside.shape[0]
 
-    body.acceleration = (ax, ay)
+        self.build_time = time.perf_counter() - start_time
 
+    def move(self, basic_bodies):
 
-def update_velocity_rk4(body: CelestialBody, forces: list[tuple[float, float]], dt: int):
+        # Every body is taken out before any is reinserted, a leaf subdividing must not
+        # redistribute a body that has already left it. Emptied leaves are only collapsed
+        # at the end, so the old leaves are still attached while reinserting
 
-    """
+        old_leaves = []
+        for basic_body in basic_bodies:
+            old_leaves.append(basic_body.leaf)
+            basic_body.leaf.basic_body = None
+            basic_body.leaf = None
 
-    Runge Kutta 4 method
+        for basic_body, leaf in zip(basic_bodies, old_leaves):
+            node = leaf
+            while node.parent is not None and not node.in_boundary(basic_body.position):
+                node = node.parent
 
-    Error of O(dt^-5) and accumulated error across all steps that
-    scales as O(dt^-4)
+            node.insert(basic_body)
 
-    Runge Kutta 4 equations:
+        for leaf in old_leaves:
+            leaf.collapse()
 
-    k1 = dt * evaluate(t, y)
-    k2 = dt * evaluate(t + 0.5*dt, y + 0.5*k1)
-    k3 = dt * evaluate(t + 0.5*dt, y + 0.5*k2)
-    k4 = dt * evaluate(t + dt, y + k3)
+    def compute_forces(self):
+        net_forces = np.zeros((len(self.basic_bodies), 2), dtype=np.float64)
+        for i, basic_body in enumerate(self.basic_bodies):
+            net_forces[i] = self.root.calculate_force(basic_body)
 
-    """
+        return net_forces
 
-    ax = sum([f[0] for f in forces]) / body.mass
-    ay = sum([f[1] for f in forces]) / body.mass
+
+def compute_gravitational_force(body1: CelestialBody, body2: CelestialBody):
+    dx = body2.position[0] - body1.position[0]
+    dy = body2.position[1] - body1.position[1]
+
+    distance_squared = dx ** 2 + dy ** 2
+    softened_distance_squared = distance_squared + EPSILON ** 2
+    softened_distance = math.sqrt(softened_distance_squared)
+
+    force = G_CONSTANT * body1.mass * body2.mass / softened_distance_squared
+    force_x = force * dx / softened_distance
+    force_y = force * dy / softened_distance
+
+    return force_x, force_y
 
 
 def compute_forces(positions, masses):
@@ -418,42 +558,222 @@ def compute_forces(positions, masses):
     return net_forces
 
 
-@njit(parallel=True)
-def compute_forces_numba(positions, masses):
+def compute_forces_numba(positions, masses, num_blocks=0):
 
     # using numba jit compiling and parallelization,
     # ~10x faster than numpy matrix broadcasting
 
+    # num_blocks=0 uses one accumulation buffer per thread. The thread count is looked up
+    # here, reading it inside the kernel would keep numba from caching it
+    if num_blocks <= 0:
+        num_blocks = get_num_threads()
+
+    return compute_forces_blocked(positions, masses, num_blocks)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def compute_forces_blocked(positions, masses, num_blocks):
+
+    # Rows are dealt cyclically to num_blocks accumulation buffers so each pair is only
+    # evaluated once without threads racing on net_forces[j]. The buffers are reduced in
+    # a fixed order, so a fixed num_blocks gives bit-reproducible results for any
+    # NUMBA_NUM_THREADS
+
     n = positions.shape[0]
-    net_forces = np.zeros((n, 2), dtype=np.float64)
+    num_blocks = max(min(num_blocks, n), 1)
+
+    block_forces = np.zeros((num_blocks, n, 2), dtype=np.float64)
+
+    for b in prange(num_blocks):
+        for i in range(b, n, num_blocks):
+            fx_i = 0.0
+            fy_i = 0.0
+            for j in range(i + 1, n):
+                dx = positions[j, 0] - positions[i, 0]
+                dy = positions[j, 1] - positions[i, 1]
+                softened_distance_squared = dx * dx + dy * dy + EPSILON * EPSILON
+                softened_distance = np.sqrt(softened_distance_squared)
+                force = G_CONSTANT * masses[i] * masses[j] / softened_distance_squared
 
+                fx = force * dx / softened_distance
+                fy = force * dy / softened_distance
+
+                fx_i += fx
+                fy_i += fy
+
+                block_forces[b, j, 0] -= fx
+                block_forces[b, j, 1] -= fy
+
+            block_forces[b, i, 0] += fx_i
+            block_forces[b, i, 1] += fy_i
+
+    net_forces = np.zeros((n, 2), dtype=np.float64)
     for i in prange(n):
-        for j in range(i + 1, n):
-            dx = positions[j, 0] - positions[i, 0]
-            dy = positions[j, 1] - positions[i, 1]
-            softened_distance_squared = dx * dx + dy * dy + EPSILON * EPSILON
-            softened_distance = np.sqrt(softened_distance_squared)
-            force = G_CONSTANT * masses[i] * masses[j] / softened_distance_squared
+        for b in range(num_blocks):
+            net_forces[i, 0] += block_forces[b, i, 0]
+            net_forces[i, 1] += block_forces[b, i, 1]
+
+    return net_forces
+
+
+def compute_forces_numba_active(positions, masses, active, num_blocks=0):
+
+    # Forces on the listed bodies only, for individual timesteps, num_blocks as in
+    # compute_forces_numba
+
+    if num_blocks <= 0:
+        num_blocks = get_num_threads()
+
+    return compute_forces_active_blocked(positions, masses, active, num_blocks)
 
-            fx = force * dx / softened_distance
-            fy = force * dy / softened_distance
 
-            net_forces[i, 0] += fx
-            net_forces[i, 1] += fy
+@njit(parallel=True, nogil=True, cache=True)
+def compute_forces_active_blocked(positions, masses, active, num_blocks):
 
-            net_forces[j, 0] -= fx
-            net_forces[j, 1] -= fy
+    # A pair of active bodies is evaluated once, by the earlier of the two in active, and
+    # a pair with an inactive body once for the active end, so a active bodies out of n
+    # cost a n - a^2 / 2 pairs, never more than the n^2 / 2 of compute_forces_blocked.
+    # Rows are dealt cyclically to the accumulation buffers as in compute_forces_blocked
+
+    n = positions.shape[0]
+    m = active.shape[0]
+    num_blocks = max(min(num_blocks, m), 1)
+
+    # Index of each body in active, -1 for inactive bodies
+    slots = np.full(n, -1, dtype=np.int64)
+    for a in range(m):
+        slots[active[a]] = a
+
+    block_forces = np.zeros((num_blocks, m, 2), dtype=np.float64)
+
+    for b in prange(num_blocks):
+        for a in range(b, m, num_blocks):
+            i = active[a]
+            fx_i = 0.0
+            fy_i = 0.0
+            for j in range(n):
+                slot = slots[j]
+                if slot != -1 and slot <= a:
+                    continue
+
+                dx = positions[j, 0] - positions[i, 0]
+                dy = positions[j, 1] - positions[i, 1]
+                softened_distance_squared = dx * dx + dy * dy + EPSILON * EPSILON
+                softened_distance = np.sqrt(softened_distance_squared)
+                force = G_CONSTANT * masses[i] * masses[j] / softened_distance_squared
+
+                fx = force * dx / softened_distance
+                fy = force * dy / softened_distance
+
+                fx_i += fx
+                fy_i += fy
+
+                if slot != -1:
+                    block_forces[b, slot, 0] -= fx
+                    block_forces[b, slot, 1] -= fy
+
+            block_forces[b, a, 0] += fx_i
+            block_forces[b, a, 1] += fy_i
+
+    net_forces = np.zeros((m, 2), dtype=np.float64)
+    for a in prange(m):
+        for b in range(num_blocks):
+            net_forces[a, 0] += block_forces[b, a, 0]
+            net_forces[a, 1] += block_forces[b, a, 1]
 
     return net_forces
 
 
+# (name, per-body shape, dtype) of every array owned by a Cosmos
+BODY_ARRAYS = (
+    ("masses", (), np.float64),
+    ("positions", (2,), np.float64),
+    ("velocities", (2,), np.float64),
+    ("accelerations", (2,), np.float64),
+    ("net_forces", (2,), np.float64),
+    ("radii", (), np.float64),
+    ("colors", (3,), np.uint8),
+    ("accelerations_computed", (), np.bool_),  # accelerations match the current positions
+    ("timestep_levels", (), np.int64),  # block timestep of each body is dt / 2^level
+    ("ids", (), np.int64),  # stable id of the body in each row, rows[ids] == arange(num_bodies)
+    ("trails", (TRAIL_LENGTH, 2), np.float64),  # ring buffer of recent positions
+    ("trail_history", (TRAIL_HISTORY_LENGTH, 2), np.float64),  # older positions, every TRAIL_HISTORY_STRIDE steps
+)
+
+
 class Cosmos:
-    def __init__(self):
+    def __init__(self, capacity=16, deterministic=False, integrator=INTEGRATOR):
         self.bodies = []
+        self.custom_drawn_bodies = []
         self.boundary = (1e100, 1e100, -1e100, -1e100)
-        self.computed_forces = np.zeros((1, 2))
+
+        # Structure of arrays holding the state of every body, the public attributes
+        # (self.positions, self.masses, ...) are views of the first num_bodies rows
+        self.num_bodies = 0
+        self.capacity = 0
+        self.buffers = {}
+        self.row_buffer = np.zeros(capacity, dtype=np.int64)  # row of each body id, -1 once merged away
+        self.next_id = 0
+        self.reserve(capacity)
+
+        # Bumped whenever rows are added, removed or reordered
+        self.layout_version = 0
+
+        # Rows are periodically sorted by Morton key of position when reorder_interval > 0
+        self.reorder_interval = MORTON_REORDER_INTERVAL
+        self.steps = 0
+
+        # Merge overlapping bodies after every step
+        self.collisions = COLLISIONS
+
+        # timing.PhaseTimers to time the phases of every step, NULL_TIMERS costs nothing
+        self.timers = NULL_TIMERS
+
+        # diagnostics.EnergyMonitor sampling conservation every few steps, or None
+        self.diagnostics = None
+        self.sim_time = 0.0
+
+        # Every body records its trail on the same steps, so the rings share one write head
+        self.trail_steps = 0
+        self.trail_head = 0
+        self.trail_count = 0
+        self.trail_history_head = 0
+        self.trail_history_count = 0
 
         self.quad_tree = QuadTree(self.boundary)
+        self.bh_tree = BarnesHutTree()
+
+        # Bit-reproducible direct-sum forces regardless of NUMBA_NUM_THREADS
+        self.force_blocks = DETERMINISTIC_FORCE_BLOCKS if deterministic else 0
+
+        # Any force engine below is stepped with this integrator, see integrators.INTEGRATORS
+        self.integrator = INTEGRATORS[integrator]()
+
+        self.force_scratch = None
+        self.parallel_bh = None
+        self.parallel_bh_workers = None
+        self.fmm = None
+        self.particle_mesh = None
+        self.mixed_precision = None
+        self.block_timesteps = None
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+
+        for name, shape, dtype in BODY_ARRAYS:
+            buffer = np.zeros((capacity,) + shape, dtype=dtype)
+            if name in self.buffers:
+                buffer[:self.num_bodies] = self.buffers[name][:self.num_bodies]
+            self.buffers[name] = buffer
+
+        self.capacity = capacity
+        self.update_views()
+
+    def update_views(self):
+        for name, _, _ in BODY_ARRAYS:
+            setattr(self, name, self.buffers[name][:self.num_bodies])
+        self.rows = self.row_buffer[:self.next_id]
 
     def update_boundary(self, position):
         x_min = min(self.boundary[0], position[0])
@@ -464,47 +784,404 @@ class Cosmos:
         self.boundary = (x_min, y_min, x_max, y_max)
 
     def add_body(self, body):
+        if self.num_bodies == self.capacity:
+            self.reserve(2 * self.capacity)
+
+        index = self.num_bodies
+        state = body.initial_state
+
+        body_id = self.next_id
+        if body_id == self.row_buffer.shape[0]:
+            self.row_buffer = np.concatenate((self.row_buffer, np.zeros(max(body_id, 16), dtype=np.int64)))
+        self.next_id += 1
+
+        self.buffers["masses"][index] = state["mass"]
+        self.buffers["positions"][index] = state["position"]
+        self.buffers["velocities"][index] = state["velocity"]
+        self.buffers["accelerations"][index] = state["acceleration"]
+        self.buffers["net_forces"][index] = state["net_force"]
+        self.buffers["radii"][index] = state["radius"]
+        self.buffers["colors"][index] = state["color"]
+        self.buffers["trails"][index] = state["position"]
+        self.buffers["trail_history"][index] = state["position"]
+        self.buffers["accelerations_computed"][index] = False
+        self.buffers["timestep_levels"][index] = 0
+        self.buffers["ids"][index] = body_id
+        self.row_buffer[body_id] = index
+
+        body.cosmos = self
+        body.id = body_id
+        body.initial_state = None
+
         self.bodies.append(body)
-        self.update_boundary(body.position)
+        if not body.batch_drawn:
+            self.custom_drawn_bodies.append(body)
 
-    def update_numba(self, dt: int):
+        self.num_bodies += 1
+        self.layout_version += 1
+        self.update_views()
+
+        self.update_boundary(self.positions[index])
+
+    def add_bodies(self, masses, positions, velocities, radii, colors):
+
+        # Bulk version of add_body for bodies that need no CelestialBody handle, the arrays
+        # are copied straight into the body store. Returns the ids given to the new bodies
+
+        count = masses.shape[0]
+        if count == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        if self.num_bodies + count > self.capacity:
+            self.reserve(max(2 * self.capacity, self.num_bodies + count))
 
-        num_bodies = len(self.bodies)
+        start = self.num_bodies
+        end = start + count
 
-        positions = np.array([body.position for body in self.bodies])
-        masses = np.array([body.mass for body in self.bodies])
+        ids = np.arange(self.next_id, self.next_id + count)
+        if self.next_id + count > self.row_buffer.shape[0]:
+            row_buffer = np.zeros(max(2 * self.row_buffer.shape[0], self.next_id + count), dtype=np.int64)
+            row_buffer[:self.next_id] = self.row_buffer[:self.next_id]
+            self.row_buffer = row_buffer
+        self.next_id += count
 
-        self.computed_forces = compute_forces_numba(positions, masses)
-        for i in range(num_bodies):
-            self.bodies[i].net_force = tuple(self.computed_forces[i])
+        self.buffers["masses"][start:end] = masses
+        self.buffers["positions"][start:end] = positions
+        self.buffers["velocities"][start:end] = velocities
+        self.buffers["accelerations"][start:end] = 0
+        self.buffers["net_forces"][start:end] = 0
+        self.buffers["radii"][start:end] = radii
+        self.buffers["colors"][start:end] = colors
+        self.buffers["accelerations_computed"][start:end] = False
+        self.buffers["timestep_levels"][start:end] = 0
+        self.buffers["trails"][start:end] = self.buffers["positions"][start:end, np.newaxis]
+        self.buffers["trail_history"][start:end] = self.buffers["positions"][start:end, np.newaxis]
+        self.buffers["ids"][start:end] = ids
+        self.row_buffer[ids] = np.arange(start, end)
 
+        self.num_bodies = end
+        self.layout_version += 1
+        self.update_views()
+
+        self.update_boundary(self.positions[start:end].min(axis=0))
+        self.update_boundary(self.positions[start:end].max(axis=0))
+
+        return ids
+
+    def reorder(self):
+
+        # Sorts every per-body array by Morton key of position, so bodies close in space
+        # are close in memory for the force kernels and tree walks. Body ids and rows
+        # are kept in step, so handles and id lookups stay valid
+
+        if self.num_bodies == 0:
+            return
+
+        boundary = np.array([*self.positions.min(axis=0), *self.positions.max(axis=0)])
+        order = np.argsort(morton_keys(self.positions, boundary), kind="stable")
+
+        for name, _, _ in BODY_ARRAYS:
+            array = getattr(self, name)
+            array[:] = array[order]
+
+        self.rows[self.ids] = np.arange(self.num_bodies)
+        self.layout_changed()
+
+    def layout_changed(self):
+        self.layout_version += 1
+
+        # The persistent quad tree holds bodies by row
+        self.quad_tree = QuadTree(self.boundary, self.quad_tree.incremental)
+
+    def merge_collisions(self):
+
+        # Merges every group of overlapping bodies into its most massive member, keeping
+        # total mass, momentum and center of mass, with radii combined by volume. The
+        # arrays are then compacted in place. Returns the number of bodies removed
+
+        pairs = collision_pairs(self.positions, self.radii)
+        if pairs.shape[0] == 0:
+            return 0
+
+        targets = merge_targets(pairs, self.masses)
+        absorbed = np.flatnonzero(targets != np.arange(self.num_bodies))
+        survivors = np.unique(targets[absorbed])
+        into = targets[absorbed]
+
+        masses = self.masses
+        momentum = masses[:, np.newaxis] * self.velocities
+        weighted_positions = masses[:, np.newaxis] * self.positions
+        volumes = self.radii ** 3
+
+        np.add.at(momentum, into, momentum[absorbed])
+        np.add.at(weighted_positions, into, weighted_positions[absorbed])
+        np.add.at(volumes, into, volumes[absorbed])
+        np.add.at(masses, into, masses[absorbed])
+
+        self.velocities[survivors] = momentum[survivors] / masses[survivors, np.newaxis]
+        self.positions[survivors] = weighted_positions[survivors] / masses[survivors, np.newaxis]
+        self.radii[survivors] = np.cbrt(volumes[survivors])
+        self.accelerations_computed[survivors] = False
+        self.timestep_levels[survivors] = 0
+
+        self.remove_rows(absorbed)
+        return absorbed.shape[0]
+
+    def remove_rows(self, rows):
+
+        # Handles of removed bodies keep a copy of their final state and leave the cosmos
+
+        removed_ids = set(self.ids[rows].tolist())
         for body in self.bodies:
+            if body.id in removed_ids:
+                body.initial_state = {
+                    "mass": self.masses[body.index],
+                    "position": tuple(self.positions[body.index]),
+                    "velocity": tuple(self.velocities[body.index]),
+                    "acceleration": tuple(self.accelerations[body.index]),
+                    "net_force": tuple(self.net_forces[body.index]),
+                    "radius": self.radii[body.index],
+                    "color": tuple(self.colors[body.index]),
+                }
+                body.cosmos = None
+
+        self.bodies = [body for body in self.bodies if body.cosmos is self]
+        self.custom_drawn_bodies = [body for body in self.custom_drawn_bodies if body.cosmos is self]
+
+        self.rows[self.ids[rows]] = -1
+
+        keep = np.ones(self.num_bodies, dtype=np.bool_)
+        keep[rows] = False
+        count = int(keep.sum())
+
+        for name, _, _ in BODY_ARRAYS:
+            array = getattr(self, name)
+            array[:count] = array[keep]
+
+        self.num_bodies = count
+        self.update_views()
+        self.rows[self.ids] = np.arange(count)
+        self.layout_changed()
+
+    def finish_step(self, dt):
+        self.steps += 1
+        self.sim_time += dt
+        if self.collisions:
+            with self.timers.phase("collisions"):
+                self.merge_collisions()
+        if self.reorder_interval > 0 and self.steps % self.reorder_interval == 0:
+            with self.timers.phase("reorder"):
+                self.reorder()
+        if self.diagnostics is not None:
+            with self.timers.phase("diagnostics"):
+                self.diagnostics.observe(self)
+
+    def in_id_order(self, array):
+
+        # Copy of a per-body array indexed by body id instead of row, rows of bodies that
+        # were merged away are NaN
+
+        ordered = np.full((self.next_id,) + array.shape[1:], np.nan, dtype=np.float64)
+        ordered[self.ids] = array
+        return ordered
+
+    def record_trails(self):
+
+        # A point only moves into the history when it falls out of the recent ring, so the
+        # two never overlap and the history ends where the ring starts. leaving_step is the
+        # step the point about to be overwritten was recorded on (the current one without a ring)
+
+        leaving_step = self.trail_steps - TRAIL_LENGTH
+        if TRAIL_HISTORY_LENGTH > 0 and leaving_step >= 0 and leaving_step % TRAIL_HISTORY_STRIDE == 0:
+            leaving = self.trails[:, self.trail_head] if TRAIL_LENGTH > 0 else self.positions
+            self.trail_history[:, self.trail_history_head] = leaving
+            self.trail_history_head = (self.trail_history_head + 1) % TRAIL_HISTORY_LENGTH
+            self.trail_history_count = min(self.trail_history_count + 1, TRAIL_HISTORY_LENGTH)
+
+        if TRAIL_LENGTH > 0:
+            self.trails[:, self.trail_head] = self.positions
+            self.trail_head = (self.trail_head + 1) % TRAIL_LENGTH
+            self.trail_count = min(self.trail_count + 1, TRAIL_LENGTH)
+
+        self.trail_steps += 1
+
+    def ordered_trail(self, index):
+
+        # Oldest to newest positions of one body, the history points recorded before every
+        # point still in the recent ring
+
+        history = np.roll(self.trail_history[index], -self.trail_history_head, axis=0)
+        recent = np.roll(self.trails[index], -self.trail_head, axis=0)
+
+        return np.concatenate((history[TRAIL_HISTORY_LENGTH - self.trail_history_count:],
+                               recent[TRAIL_LENGTH - self.trail_count:]))
+
+    def integrate(self, dt: int, compute_forces):
+        timers = self.timers
+        with timers.phase("step"):
+            with timers.phase("integrate"):
+                self.integrator.step(self, dt, timers.wrap("forces", compute_forces))
+            self.finish_step(dt)
+        timers.commit()
+
+    def update_numba(self, dt: int):
+        self.integrate(dt, self.forces_numba)
+
+    def update_numba32(self, dt: int):
+        self.integrate(dt, self.forces_numba32)
 
-            update_velocity_verlet(body, body.net_force, dt)
-            body.update_position_verlet(dt)
+    def update_numpy(self, dt: int):
+        self.integrate(dt, self.forces_numpy)
 
+    def update_fmm(self, dt: int):
+        self.integrate(dt, self.forces_fmm)
+
+    def update_pm(self, dt: int):
+        self.integrate(dt, self.forces_pm)
+
+    def update_p3m(self, dt: int):
+        self.integrate(dt, self.forces_p3m)
 
     def update_qt(self, dt: int):
+        self.integrate(dt, self.forces_qt)
 
-        self.boundary = (1e100, 1e100, -1e100, -1e100)
-        for body in self.bodies:
-            self.update_boundary(body.position)
+    def update_bh(self, dt: int):
+        self.integrate(dt, self.forces_bh)
 
-        self.quad_tree = QuadTree(self.boundary)
+    def update_pbh(self, dt: int):
+        self.integrate(dt, self.forces_pbh)
 
-        for body in self.bodies:
-            self.quad_tree.root.insert(BasicBody(body.mass, body.position))
+    def forces_numba(self, positions, masses):
+        return compute_forces_numba(positions, masses, self.force_blocks)
 
-        for body in self.bodies:
-            body.net_force = self.quad_tree.root.calculate_force(body)
+    def forces_numba32(self, positions, masses):
 
-        for body in self.bodies:
-            if not body.acceleration_computed:
-                update_velocity(body, body.net_force, dt)
-                body.update_position(dt)
-                body.acceleration_computed = True
-            else:
-                update_velocity_verlet(body, body.net_force, dt)
-                body.update_position_verlet(dt)
+        # Direct sum in float32 on rescaled units with float64 accumulation, see mixed_precision.py
+
+        if self.mixed_precision is None:
+            self.mixed_precision = MixedPrecisionForces()
+
+        return self.mixed_precision.compute_forces(positions, masses)
+
+    def forces_numpy(self, positions, masses):
+
+        # Pure NumPy path for deployments without numba, memory bounded by NUMPY_FORCE_MEMORY_BUDGET
+
+        if self.force_scratch is None:
+            self.force_scratch = ForceScratch()
+
+        return compute_forces_tiled(positions, masses, self.force_scratch)
+
+    def forces_fmm(self, positions, masses):
+
+        # Fast multipole method, O(N) with accuracy set by FMM_ORDER
+
+        if self.fmm is None:
+            self.fmm = FastMultipole()
+
+        return self.fmm.compute_forces(positions, masses)
+
+    def forces_pm(self, positions, masses, short_range=False):
+
+        # Particle-mesh FFT solver, short_range adds the direct P3M correction below the grid scale
+
+        if self.particle_mesh is None or self.particle_mesh.short_range != short_range:
+            self.particle_mesh = ParticleMesh(short_range=short_range)
+
+        return self.particle_mesh.compute_forces(positions, masses)
+
+    def forces_p3m(self, positions, masses):
+        return self.forces_pm(positions, masses, short_range=True)
+
+    def forces_qt(self, positions, masses):
+        self.boundary = (*positions.min(axis=0), *positions.max(axis=0))
+
+        # The tree persists across steps, quad_tree.build_time is the cost of keeping it current
+        with self.timers.phase("tree_build"):
+            self.quad_tree.update(positions, masses)
+
+        return self.quad_tree.compute_forces()
+
+    def forces_bh(self, positions, masses):
+
+        # Compiled, array based replacement for forces_qt with the same THETA semantics
+
+        self.boundary = (*positions.min(axis=0), *positions.max(axis=0))
+
+        with self.timers.phase("tree_build"):
+            self.bh_tree.build(positions, masses, self.boundary)
+        return self.bh_tree.compute_forces(positions, masses, THETA)
+
+    def forces_pbh(self, positions, masses):
+
+        # Barnes-Hut domain-decomposed over a pool of worker processes sharing memory. The
+        # pool is sized by capacity and kept when bodies merge or are added
+
+        if self.parallel_bh is None:
+            self.parallel_bh = ParallelBarnesHut(max(self.capacity, positions.shape[0]), self.parallel_bh_workers)
+
+        return self.parallel_bh.compute_forces(positions, masses, THETA)
+
+    def close(self):
+
+        # Stops the worker processes of the parallel_barnes_hut engine, if any were started
+
+        if self.parallel_bh is not None:
+            self.parallel_bh.close()
+            self.parallel_bh = None
+
+    def update_block(self, dt: int, tree=False):
+
+        # Individual power-of-two timesteps, dt is the longest step any body takes. Only
+        # the bodies finishing a step on a substep have their forces recomputed
+
+        if self.block_timesteps is None:
+            self.block_timesteps = BlockTimesteps()
+
+        compute_forces = self.compute_active_forces_bh if tree else self.compute_active_forces_numba
+
+        timers = self.timers
+        with timers.phase("step"):
+            with timers.phase("integrate"):
+                if tree:
+                    self.boundary = (*self.positions.min(axis=0), *self.positions.max(axis=0))
+                    with timers.phase("tree_build"):
+                        self.bh_tree.build(self.positions, self.masses, self.boundary)
+
+                self.block_timesteps.step(self, dt, timers.wrap("forces", compute_forces))
+            self.finish_step(dt)
+        timers.commit()
+
+    def update_block_bh(self, dt: int):
+        self.update_block(dt, tree=True)
+
+    def compute_active_forces_numba(self, active):
+        return compute_forces_numba_active(self.positions, self.masses, active, self.force_blocks)
+
+    def compute_active_forces_bh(self, active):
+
+        # The tree is built once per step by update_block. Every body has been drifted to
+        # the current substep since, so only the node moments are refreshed, an O(n) pass
+        # instead of a rebuild, and the tree is walked for the active bodies. Cells keep
+        # their size for the opening criterion, bodies move far less than a cell within dt
+
+        with self.timers.phase("tree_build"):
+            self.bh_tree.refresh(self.positions, self.masses)
+
+        return self.bh_tree.compute_forces(self.positions, self.masses, THETA, active)
 
 
+# Force engines selectable by name, each advances a Cosmos by one step of dt
+ENGINES = {
+    "numpy": Cosmos.update_numpy,
+    "numba": Cosmos.update_numba,
+    "numba_float32": Cosmos.update_numba32,
+    "fmm": Cosmos.update_fmm,
+    "particle_mesh": Cosmos.update_pm,
+    "p3m": Cosmos.update_p3m,
+    "quadtree": Cosmos.update_qt,
+    "barnes_hut": Cosmos.update_bh,
+    "parallel_barnes_hut": Cosmos.update_pbh,
+    "block_numba": Cosmos.update_block,
+    "block_barnes_hut": Cosmos.update_block_bh,
+}
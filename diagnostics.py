@@ -0,0 +1,240 @@
+import numpy as np
+from jit import njit, prange, get_num_threads
+
+from constants import *
+from barnes_hut import BarnesHutTree, MAX_TREE_DEPTH
+
+# Conservation diagnostics: kinetic and (softened) potential energy, linear momentum and
+# angular momentum about the origin, in compiled parallel kernels. The potential is
+# -G m_i m_j / sqrt(r^2 + EPSILON^2) per pair, the one the softened forces derive from,
+# either summed exactly over all pairs or approximated by walking a Barnes-Hut tree with
+# its own (tighter) opening angle
+#
+# An EnergyMonitor attached to a Cosmos samples them every interval steps into a compact
+# time series, so the cost of the O(N^2) or O(N log N) potential is spread over the steps
+
+SERIES_FIELDS = np.dtype([
+    ("step", np.int64),
+    ("time", np.float64),
+    ("num_bodies", np.int64),
+    ("mass", np.float64),
+    ("kinetic", np.float64),
+    ("potential", np.float64),
+    ("total", np.float64),
+    ("momentum_x", np.float64),
+    ("momentum_y", np.float64),
+    ("angular_momentum", np.float64),
+])
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def kinetic_and_momenta(positions, velocities, masses):
+
+    # (kinetic energy, momentum x, momentum y, angular momentum about the origin)
+
+    kinetic = 0.0
+    momentum_x = 0.0
+    momentum_y = 0.0
+    angular_momentum = 0.0
+
+    for i in prange(positions.shape[0]):
+        m = masses[i]
+        vx = velocities[i, 0]
+        vy = velocities[i, 1]
+
+        kinetic += 0.5 * m * (vx * vx + vy * vy)
+        momentum_x += m * vx
+        momentum_y += m * vy
+        angular_momentum += m * (positions[i, 0] * vy - positions[i, 1] * vx)
+
+    return kinetic, momentum_x, momentum_y, angular_momentum
+
+
+def potential_energy(positions, masses, num_blocks=0):
+
+    # Exact sum over pairs i < j. num_blocks=0 uses one block of rows per thread, the
+    # thread count is looked up here so the kernel can be cached
+
+    if num_blocks <= 0:
+        num_blocks = get_num_threads()
+
+    return potential_energy_blocked(positions, masses, num_blocks)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def potential_energy_blocked(positions, masses, num_blocks):
+
+    # Row i has n - i - 1 pairs, so rows are dealt cyclically to the blocks as in
+    # cosmos.compute_forces_blocked, contiguous ranges would leave the first thread with
+    # most of the work
+
+    n = positions.shape[0]
+    num_blocks = max(min(num_blocks, n), 1)
+    energies = np.zeros(num_blocks, dtype=np.float64)
+
+    for b in prange(num_blocks):
+        for i in range(b, n, num_blocks):
+            for j in range(i + 1, n):
+                dx = positions[j, 0] - positions[i, 0]
+                dy = positions[j, 1] - positions[i, 1]
+                energies[b] -= G_CONSTANT * masses[i] * masses[j] / np.sqrt(dx * dx + dy * dy + EPSILON * EPSILON)
+
+    return energies.sum()
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def potential_energy_tree(positions, masses, children, bounds, leaf_body, next_body, node_mass, center_of_mass,
+                          theta):
+
+    # Half the sum of every body's potential from the tree, nodes are taken as point
+    # masses with the same criterion as barnes_hut.walk_tree
+
+    n = positions.shape[0]
+    energies = np.zeros(n, dtype=np.float64)
+
+    for i in prange(n):
+        stack = np.empty(3 * MAX_TREE_DEPTH + 4, dtype=np.int64)
+        stack[0] = 0
+        top = 0
+
+        x = positions[i, 0]
+        y = positions[i, 1]
+        potential = 0.0
+
+        while top >= 0:
+            node = stack[top]
+            top -= 1
+
+            if node_mass[node] == 0:
+                continue
+
+            if children[node, 0] == -1:
+                b = leaf_body[node]
+                while b != -1:
+                    if b != i:
+                        dx = positions[b, 0] - x
+                        dy = positions[b, 1] - y
+                        potential -= masses[b] / np.sqrt(dx * dx + dy * dy + EPSILON * EPSILON)
+                    b = next_body[b]
+                continue
+
+            dx = center_of_mass[node, 0] - x
+            dy = center_of_mass[node, 1] - y
+            softened_distance = np.sqrt(dx * dx + dy * dy + EPSILON * EPSILON)
+
+            size = max(bounds[node, 2] - bounds[node, 0], bounds[node, 3] - bounds[node, 1])
+
+            if size / softened_distance < theta:
+                potential -= node_mass[node] / softened_distance
+            else:
+                for q in range(4):
+                    top += 1
+                    stack[top] = children[node, q]
+
+        energies[i] = 0.5 * G_CONSTANT * masses[i] * potential
+
+    return energies.sum()
+
+
+def save_records(path, records):
+
+    # A structured array (one field per column) as .npz with one array per field, or as
+    # .csv with a header line, integer fields written as integers
+
+    fields = records.dtype
+    if path.endswith(".csv"):
+        formats = ["%d" if fields[name].kind == "i" else "%.17g" for name in fields.names]
+        np.savetxt(path, np.column_stack([records[name].astype(np.float64) for name in fields.names]),
+                   fmt=formats, delimiter=",", header=",".join(fields.names), comments="")
+    else:
+        np.savez(path, **{name: records[name] for name in fields.names})
+
+
+def total_energy(cosmos):
+    kinetic = kinetic_and_momenta(cosmos.positions, cosmos.velocities, cosmos.masses)[0]
+    return kinetic + potential_energy(cosmos.positions, cosmos.masses)
+
+
+class EnergyMonitor:
+    def __init__(self, interval=DIAGNOSTICS_INTERVAL, potential=DIAGNOSTICS_POTENTIAL, theta=DIAGNOSTICS_THETA,
+                 capacity=256):
+
+        # potential is "exact" or "tree", interval is in steps
+
+        if potential not in ("exact", "tree"):
+            raise ValueError(f"unknown potential {potential!r}, expected 'exact' or 'tree'")
+
+        self.interval = interval
+        self.potential = potential
+        self.theta = theta
+        self.tree = BarnesHutTree() if potential == "tree" else None
+
+        self.buffer = np.zeros(capacity, dtype=SERIES_FIELDS)
+        self.count = 0
+
+    @property
+    def series(self):
+        return self.buffer[:self.count]
+
+    def observe(self, cosmos):
+
+        # Called by Cosmos.finish_step after every step
+
+        if self.interval > 0 and cosmos.steps % self.interval == 0:
+            self.sample(cosmos)
+
+    def sample(self, cosmos):
+        if self.count == self.buffer.shape[0]:
+            buffer = np.zeros(2 * self.buffer.shape[0], dtype=SERIES_FIELDS)
+            buffer[:self.count] = self.buffer
+            self.buffer = buffer
+
+        positions = cosmos.positions
+        masses = cosmos.masses
+
+        kinetic, momentum_x, momentum_y, angular_momentum = kinetic_and_momenta(positions, cosmos.velocities,
+                                                                                masses)
+
+        if cosmos.num_bodies < 2:
+            potential = 0.0
+        elif self.tree is not None:
+            boundary = (*positions.min(axis=0), *positions.max(axis=0))
+            self.tree.build(positions, masses, boundary)
+            tree = self.tree
+            potential = potential_energy_tree(positions, masses, tree.children, tree.bounds, tree.leaf_body,
+                                              tree.next_body, tree.node_mass, tree.center_of_mass, self.theta)
+        else:
+            potential = potential_energy(positions, masses)
+
+        self.buffer[self.count] = (cosmos.steps, cosmos.sim_time, cosmos.num_bodies, masses.sum(), kinetic, potential,
+                                   kinetic + potential, momentum_x, momentum_y, angular_momentum)
+        self.count += 1
+
+        return self.buffer[self.count - 1]
+
+    def drift(self):
+
+        # Relative change of energy and angular momentum since the first sample, for every
+        # sample. The total momentum is often ~0, so its change is relative to sqrt(2 M K),
+        # the momentum the system would have with all its kinetic energy in one direction
+
+        series = self.series
+        if self.count == 0:
+            return {}
+
+        first = series[0]
+        momentum_scale = max(float(np.sqrt(2 * first["mass"] * first["kinetic"])), 1e-300)
+
+        return {
+            "energy": (series["total"] - first["total"]) / max(abs(first["total"]), 1e-300),
+            "angular_momentum": ((series["angular_momentum"] - first["angular_momentum"])
+                                 / max(abs(first["angular_momentum"]), 1e-300)),
+            "momentum": np.hypot(series["momentum_x"] - first["momentum_x"],
+                                 series["momentum_y"] - first["momentum_y"]) / momentum_scale,
+        }
+
+    def save(self, path):
+
+        # .npz with one array per field, or .csv with a header line
+
+        save_records(path, self.series)
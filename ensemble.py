@@ -0,0 +1,381 @@
+import argparse
+import time
+
+import numpy as np
+from jit import njit, prange
+
+from cosmos import *
+from simulation_setup import *
+from diagnostics import save_records
+
+# Many independent small systems (e.g. perturbed copies of setup_three) stepped together.
+# Members are stored in batched arrays, positions and velocities (M, n, 2), masses and
+# radii (M, n), and one parallel kernel advances every running member by a chunk of
+# leapfrog steps with the same softened direct sum as compute_forces_numba, so a member
+# follows the orbit a Cosmos with the numba engine would. No Python runs per member or
+# per step, a member costs its n^2 pair terms.
+#
+# After every step a member ends when two of its bodies overlap (collided) or a body
+# has escaped: it is unbound from the center of mass of the others and further from it
+# than escape_factor times the member's initial radius. Ended members are frozen at
+# that step and summary() reports every member in one structured array
+#
+#   python ensemble.py --members 10000 --steps 100000 --velocity-spread 0.05 --output three.csv
+
+RUNNING = 0
+ESCAPED = 1
+COLLIDED = 2
+STATUS_NAMES = ("running", "escaped", "collided")
+
+SUMMARY_FIELDS = np.dtype([
+    ("member", np.int64),
+    ("status", np.int8),
+    ("steps", np.int64),
+    ("time", np.float64),
+    ("body", np.int64),
+    ("other", np.int64),
+    ("min_separation", np.float64),
+    ("energy", np.float64),
+    ("energy_error", np.float64),
+])
+
+
+@njit(nogil=True, cache=True)
+def member_accelerations(positions, masses, accelerations):
+    n = positions.shape[0]
+
+    for i in range(n):
+        accelerations[i, 0] = 0.0
+        accelerations[i, 1] = 0.0
+
+    for i in range(n):
+        for j in range(i + 1, n):
+            dx = positions[j, 0] - positions[i, 0]
+            dy = positions[j, 1] - positions[i, 1]
+            softened_distance_squared = dx * dx + dy * dy + EPSILON * EPSILON
+            w = G_CONSTANT / (softened_distance_squared * np.sqrt(softened_distance_squared))
+
+            accelerations[i, 0] += w * masses[j] * dx
+            accelerations[i, 1] += w * masses[j] * dy
+            accelerations[j, 0] -= w * masses[i] * dx
+            accelerations[j, 1] -= w * masses[i] * dy
+
+
+@njit(nogil=True, cache=True)
+def member_energy(positions, velocities, masses):
+
+    # Kinetic plus softened potential energy, as diagnostics.total_energy
+
+    n = positions.shape[0]
+    energy = 0.0
+
+    for i in range(n):
+        energy += 0.5 * masses[i] * (velocities[i, 0] * velocities[i, 0] + velocities[i, 1] * velocities[i, 1])
+        for j in range(i + 1, n):
+            dx = positions[j, 0] - positions[i, 0]
+            dy = positions[j, 1] - positions[i, 1]
+            energy -= G_CONSTANT * masses[i] * masses[j] / np.sqrt(dx * dx + dy * dy + EPSILON * EPSILON)
+
+    return energy
+
+
+@njit(nogil=True, cache=True)
+def member_radius(positions, masses):
+
+    # Largest distance of a body from the center of mass
+
+    n = positions.shape[0]
+    total = 0.0
+    cx = 0.0
+    cy = 0.0
+    for i in range(n):
+        total += masses[i]
+        cx += masses[i] * positions[i, 0]
+        cy += masses[i] * positions[i, 1]
+    cx /= total
+    cy /= total
+
+    radius = 0.0
+    for i in range(n):
+        radius = max(radius, np.hypot(positions[i, 0] - cx, positions[i, 1] - cy))
+
+    return radius
+
+
+@njit(nogil=True, cache=True)
+def find_escape(positions, velocities, masses, escape_radius):
+
+    # First body further than escape_radius from the center of mass of the others and
+    # with positive energy in the two-body problem against them, -1 if none
+
+    n = positions.shape[0]
+    total = 0.0
+    px = 0.0
+    py = 0.0
+    vx = 0.0
+    vy = 0.0
+    for i in range(n):
+        total += masses[i]
+        px += masses[i] * positions[i, 0]
+        py += masses[i] * positions[i, 1]
+        vx += masses[i] * velocities[i, 0]
+        vy += masses[i] * velocities[i, 1]
+
+    for i in range(n):
+        rest = total - masses[i]
+        if rest <= 0:
+            continue
+
+        dx = positions[i, 0] - (px - masses[i] * positions[i, 0]) / rest
+        dy = positions[i, 1] - (py - masses[i] * positions[i, 1]) / rest
+        distance = np.sqrt(dx * dx + dy * dy)
+        if distance <= escape_radius:
+            continue
+
+        dvx = velocities[i, 0] - (vx - masses[i] * velocities[i, 0]) / rest
+        dvy = velocities[i, 1] - (vy - masses[i] * velocities[i, 1]) / rest
+        if 0.5 * (dvx * dvx + dvy * dvy) > G_CONSTANT * total / distance:
+            return i
+
+    return -1
+
+
+@njit(nogil=True, cache=True)
+def find_overlap(positions, radii, separation):
+
+    # First overlapping pair (i, j), (-1, -1) if none. separation[0] is lowered to the
+    # closest distance between two bodies
+
+    n = positions.shape[0]
+    for i in range(n):
+        for j in range(i + 1, n):
+            dx = positions[j, 0] - positions[i, 0]
+            dy = positions[j, 1] - positions[i, 1]
+            distance = np.sqrt(dx * dx + dy * dy)
+            separation[0] = min(separation[0], distance)
+            if distance < radii[i] + radii[j]:
+                return i, j
+
+    return -1, -1
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def step_members(positions, velocities, accelerations, masses, radii, escape_radii, status, steps, times, body,
+                 other, min_separation, dt, num_steps):
+
+    # Up to num_steps kick-drift-kick steps of every running member, accelerations hold
+    # the ones of the current positions on entry and exit. Returns the members still running
+
+    num_members = positions.shape[0]
+    n = positions.shape[1]
+    running = 0
+
+    for m in prange(num_members):
+        if status[m] != RUNNING:
+            continue
+
+        x = positions[m]
+        v = velocities[m]
+        a = accelerations[m]
+        separation = np.empty(1, dtype=np.float64)
+        separation[0] = min_separation[m]
+
+        for _ in range(num_steps):
+            for i in range(n):
+                v[i, 0] += 0.5 * dt * a[i, 0]
+                v[i, 1] += 0.5 * dt * a[i, 1]
+                x[i, 0] += dt * v[i, 0]
+                x[i, 1] += dt * v[i, 1]
+
+            member_accelerations(x, masses[m], a)
+
+            for i in range(n):
+                v[i, 0] += 0.5 * dt * a[i, 0]
+                v[i, 1] += 0.5 * dt * a[i, 1]
+
+            steps[m] += 1
+            times[m] += dt
+
+            i, j = find_overlap(x, radii[m], separation)
+            if i >= 0:
+                status[m] = COLLIDED
+                body[m] = i
+                other[m] = j
+                break
+
+            i = find_escape(x, v, masses[m], escape_radii[m])
+            if i >= 0:
+                status[m] = ESCAPED
+                body[m] = i
+                break
+
+        min_separation[m] = separation[0]
+        if status[m] == RUNNING:
+            running += 1
+
+    return running
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def prepare_members(positions, velocities, masses, escape_factor, accelerations, energies, escape_radii):
+    for m in prange(positions.shape[0]):
+        member_accelerations(positions[m], masses[m], accelerations[m])
+        energies[m] = member_energy(positions[m], velocities[m], masses[m])
+        escape_radii[m] = escape_factor * member_radius(positions[m], masses[m])
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def member_energies(positions, velocities, masses, energies):
+    for m in prange(positions.shape[0]):
+        energies[m] = member_energy(positions[m], velocities[m], masses[m])
+
+
+class Ensemble:
+    def __init__(self, masses, positions, velocities, radii, escape_factor=ENSEMBLE_ESCAPE_FACTOR):
+
+        # masses and radii (M, n), positions and velocities (M, n, 2), all copied
+
+        self.masses = np.array(masses, dtype=np.float64)
+        self.positions = np.array(positions, dtype=np.float64)
+        self.velocities = np.array(velocities, dtype=np.float64)
+        self.radii = np.array(radii, dtype=np.float64)
+
+        num_members, n = self.masses.shape
+        if self.positions.shape != (num_members, n, 2) or self.velocities.shape != (num_members, n, 2):
+            raise ValueError(f"positions and velocities must have shape {(num_members, n, 2)}")
+        if self.radii.shape != (num_members, n):
+            raise ValueError(f"radii must have shape {(num_members, n)}")
+
+        self.num_members = num_members
+        self.num_bodies = n
+        self.escape_factor = escape_factor
+
+        self.accelerations = np.empty_like(self.positions)
+        self.initial_energies = np.empty(num_members, dtype=np.float64)
+        self.escape_radii = np.empty(num_members, dtype=np.float64)
+        prepare_members(self.positions, self.velocities, self.masses, escape_factor, self.accelerations,
+                        self.initial_energies, self.escape_radii)
+
+        self.status = np.zeros(num_members, dtype=np.int8)
+        self.steps = np.zeros(num_members, dtype=np.int64)
+        self.times = np.zeros(num_members, dtype=np.float64)
+        self.body = np.full(num_members, -1, dtype=np.int64)
+        self.other = np.full(num_members, -1, dtype=np.int64)
+        self.min_separation = np.full(num_members, np.inf, dtype=np.float64)
+        self.running = num_members
+
+    @classmethod
+    def from_cosmos(cls, cosmos, num_members, rng=None, mass_spread=0.0, velocity_spread=0.0,
+                    escape_factor=ENSEMBLE_ESCAPE_FACTOR):
+
+        # num_members copies of a Cosmos' bodies, with masses and velocity components
+        # scaled by independent normal factors 1 + spread * N(0, 1). Member 0 is kept
+        # unperturbed as the reference
+
+        rng = np.random.default_rng(rng)
+        n = cosmos.num_bodies
+
+        masses = np.broadcast_to(cosmos.masses, (num_members, n)).copy()
+        positions = np.broadcast_to(cosmos.positions, (num_members, n, 2))
+        velocities = np.broadcast_to(cosmos.velocities, (num_members, n, 2)).copy()
+        radii = np.broadcast_to(cosmos.radii, (num_members, n))
+
+        masses[1:] *= 1 + mass_spread * rng.standard_normal((num_members - 1, n))
+        velocities[1:] *= 1 + velocity_spread * rng.standard_normal((num_members - 1, n, 2))
+        np.maximum(masses, 0, out=masses)
+
+        return cls(masses, positions, velocities, radii, escape_factor)
+
+    def run(self, dt, num_steps, chunk_steps=ENSEMBLE_CHUNK_STEPS):
+
+        # Steps every running member by up to num_steps, returning early once none is
+        # left running. Returns the members still running
+
+        remaining = num_steps
+        while remaining > 0 and self.running > 0:
+            chunk = min(chunk_steps, remaining)
+            self.running = step_members(self.positions, self.velocities, self.accelerations, self.masses,
+                                        self.radii, self.escape_radii, self.status, self.steps, self.times,
+                                        self.body, self.other, self.min_separation, dt, chunk)
+            remaining -= chunk
+
+        return self.running
+
+    def counts(self):
+        return {name: int(np.count_nonzero(self.status == status)) for status, name in enumerate(STATUS_NAMES)}
+
+    def summary(self):
+
+        # One SUMMARY_FIELDS record per member, energy_error is the relative change of
+        # its energy since the start, up to the step it ended at
+
+        energies = np.empty(self.num_members, dtype=np.float64)
+        member_energies(self.positions, self.velocities, self.masses, energies)
+
+        summary = np.zeros(self.num_members, dtype=SUMMARY_FIELDS)
+        summary["member"] = np.arange(self.num_members)
+        summary["status"] = self.status
+        summary["steps"] = self.steps
+        summary["time"] = self.times
+        summary["body"] = self.body
+        summary["other"] = self.other
+        summary["min_separation"] = self.min_separation
+        summary["energy"] = self.initial_energies
+        summary["energy_error"] = (energies - self.initial_energies) / np.maximum(np.abs(self.initial_energies),
+                                                                                   1e-300)
+        return summary
+
+    def save(self, path):
+
+        # .npz with one array per field, or .csv with a header line
+
+        summary = self.summary()
+        save_records(path, summary)
+
+        return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run many perturbed copies of a small scenario together")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="three")
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--steps", type=int, default=10000, help="largest number of steps of a member")
+    parser.add_argument("--dt", type=float, help="timestep in seconds, defaults to the scenario's")
+    parser.add_argument("--mass-spread", type=float, default=0.0, help="relative spread of the masses")
+    parser.add_argument("--velocity-spread", type=float, default=0.01,
+                        help="relative spread of the velocity components")
+    parser.add_argument("--escape-factor", type=float, default=ENSEMBLE_ESCAPE_FACTOR)
+    parser.add_argument("--seed", type=int, help="seed for the scenario and the perturbations")
+    parser.add_argument("--output", metavar="PATH", help="save the summary of every member as .npz or .csv")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    cosmos = Cosmos()
+    _, _, dt = SCENARIOS[args.scenario](cosmos, rng)
+    dt = args.dt or dt
+
+    ensemble = Ensemble.from_cosmos(cosmos, args.members, rng, args.mass_spread, args.velocity_spread,
+                                    args.escape_factor)
+
+    start = time.perf_counter()
+    ensemble.run(dt, args.steps)
+    elapsed = time.perf_counter() - start
+
+    summary = ensemble.save(args.output) if args.output else ensemble.summary()
+    member_steps = int(summary["steps"].sum())
+    print(f"{args.members} members of {ensemble.num_bodies} bodies, {member_steps} member steps in {elapsed:.2f} s "
+          f"({member_steps / max(elapsed, 1e-9):.3g} member steps/s)")
+    print(", ".join(f"{name} {count}" for name, count in ensemble.counts().items()))
+
+    for status in (ESCAPED, COLLIDED):
+        ended = summary[summary["status"] == status]
+        if ended.shape[0] > 0:
+            print(f"{STATUS_NAMES[status]} after median {np.median(ended['time']):.4g} s "
+                  f"(min {ended['time'].min():.4g} s)")
+
+    if args.output:
+        print(f"wrote {summary.shape[0]} members to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
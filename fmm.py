@@ -0,0 +1,500 @@
+import math
+import numpy as np
+from jit import njit, prange
+
+from constants import *
+from barnes_hut import morton_keys
+
+# 2D fast multipole method for the softened kernel used everywhere else,
+# phi(z) = -G m / sqrt(|z - w|^2 + EPSILON^2), with positions as complex numbers z = x + iy.
+#
+# The kernel is not analytic in z, so expansions are double series in t and conj(t):
+#   multipole  M[p, q] = sum m u^p conj(u)^q                  (u = body - box center)
+#   local      phi(c + t) = sum L[k, l] t^k conj(t)^l
+# and translations use the mixed derivatives D[a, b] = d^a/dz^a d^b/dconj(z)^b of
+# (z conj(z) + EPSILON^2)^(-1/2). Only terms with p + q < order are kept.
+#
+# Expansions of a box are stored in units of that box's size, which keeps every
+# coefficient near 1 instead of overflowing/underflowing at high orders
+#
+# Boxes form an adaptive quad tree: a box is split while it holds more than leaf_size
+# bodies, so clustered bodies get deep small boxes and sparse regions stay shallow. The
+# interaction lists come from a dual tree traversal, two boxes interact through their
+# expansions (M2L) once (r_a + r_b) < FMM_THETA * distance, r being the radius of a box's
+# bodies around its center, and leaves too close for that interact directly (P2P)
+
+
+@njit(nogil=True, cache=True)
+def binomial_table(size):
+    table = np.zeros((size, size), dtype=np.float64)
+    for n in range(size):
+        table[n, 0] = 1.0
+        for k in range(1, n + 1):
+            table[n, k] = table[n - 1, k - 1] + table[n - 1, k]
+    return table
+
+
+@njit(nogil=True, cache=True)
+def kernel_derivatives(rx, ry, epsilon, binomial, f, z_powers, z_conj_powers, derivatives):
+
+    # D[a, b] for a + b < derivatives.shape[0] at z = rx + i ry, softened by epsilon. The
+    # other arrays are scratch of the same length, binomial a table at least that large
+
+    size = derivatives.shape[0]
+    z = complex(rx, ry)
+    z_conj = complex(rx, -ry)
+    s = rx * rx + ry * ry + epsilon * epsilon
+
+    # f^(k)(s) for f(s) = s^(-1/2)
+    f[0] = 1.0 / math.sqrt(s)
+    for k in range(1, size):
+        f[k] = f[k - 1] * -(2 * k - 1) / (2 * s)
+
+    z_powers[0] = 1.0
+    z_conj_powers[0] = 1.0
+    for k in range(1, size):
+        z_powers[k] = z_powers[k - 1] * z
+        z_conj_powers[k] = z_conj_powers[k - 1] * z_conj
+
+    # The kernel is real, so D[b, a] = conj(D[a, b])
+    for a in range(size):
+        for b in range(a, size - a):
+            total = 0.0 + 0.0j
+            falling = 1.0  # a! / (a - j)!
+            for j in range(a + 1):
+                total += binomial[b, j] * falling * f[a + b - j] * z_powers[b - j] * z_conj_powers[a - j]
+                falling *= a - j
+            derivatives[a, b] = total
+            derivatives[b, a] = total.conjugate()
+
+
+@njit(nogil=True, cache=True)
+def is_leaf(children, box):
+    return children[box, 0] == -1 and children[box, 1] == -1 and children[box, 2] == -1 and children[box, 3] == -1
+
+
+@njit(nogil=True, cache=True)
+def build_boxes(keys, leaf_size, max_levels, origin, size, box_start, box_end, box_level, box_center, children):
+
+    # Boxes over the bodies sorted by Morton key, breadth first so every level is a
+    # contiguous run of boxes after the previous one. Only non-empty children are created
+    # (-1 otherwise). Returns the number of boxes, or -1 if the box arrays are too small
+
+    max_boxes = box_start.shape[0]
+
+    box_start[0] = 0
+    box_end[0] = keys.shape[0]
+    box_level[0] = 0
+    box_center[0, 0] = origin[0] + size / 2
+    box_center[0, 1] = origin[1] + size / 2
+    num_boxes = 1
+
+    box = 0
+    while box < num_boxes:
+        children[box, :] = -1
+        level = box_level[box]
+
+        if box_end[box] - box_start[box] > leaf_size and level < max_levels:
+            # Quadrant of a body at the next level, morton_keys spreads the bits of each axis
+            # three apart with x in the low bit
+            shift = 3 * (20 - level)
+            quarter = size / 2.0 ** (level + 2)
+
+            i = box_start[box]
+            while i < box_end[box]:
+                q = (keys[i] >> shift) & 3
+                j = i + 1
+                while j < box_end[box] and (keys[j] >> shift) & 3 == q:
+                    j += 1
+
+                if num_boxes == max_boxes:
+                    return -1
+
+                child = num_boxes
+                children[box, q] = child
+                box_start[child] = i
+                box_end[child] = j
+                box_level[child] = level + 1
+                box_center[child, 0] = box_center[box, 0] + (quarter if q & 1 else -quarter)
+                box_center[child, 1] = box_center[box, 1] + (quarter if q & 2 else -quarter)
+                num_boxes += 1
+                i = j
+
+        box += 1
+
+    return num_boxes
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def upward_pass(sorted_positions, sorted_masses, box_start, box_end, box_center, box_size, children, level_start,
+                order, multipoles, radii):
+
+    num_levels = level_start.shape[0] - 1
+    binomial = binomial_table(order)
+
+    # From the deepest level up, P2M at leaves and M2M from the children elsewhere
+    for level in range(num_levels - 1, -1, -1):
+        for box in prange(level_start[level], level_start[level + 1]):
+            cx = box_center[box, 0]
+            cy = box_center[box, 1]
+            size = box_size[box]
+
+            if is_leaf(children, box):
+                radius = 0.0
+                for i in range(box_start[box], box_end[box]):
+                    u = complex(sorted_positions[i, 0] - cx, sorted_positions[i, 1] - cy) / size
+                    radius = max(radius, abs(u) * size)
+                    u_conj = u.conjugate()
+                    u_p = 1.0 + 0.0j
+                    for p in range(order):
+                        term = sorted_masses[i] * u_p
+                        for q in range(order - p):
+                            multipoles[box, p, q] += term
+                            term *= u_conj
+                        u_p *= u
+                radii[box] = radius
+                continue
+
+            d_powers = np.empty(order, dtype=np.complex128)
+            d_conj_powers = np.empty(order, dtype=np.complex128)
+            radius = 0.0
+
+            for c in range(4):
+                child = children[box, c]
+                if child == -1:
+                    continue
+
+                # child center minus parent center in parent units, child units are half as large
+                d = complex(0.25 if c & 1 else -0.25, 0.25 if c >> 1 else -0.25)
+                radius = max(radius, radii[child] + abs(d) * size)
+
+                d_powers[0] = 1.0
+                d_conj_powers[0] = 1.0
+                for k in range(1, order):
+                    d_powers[k] = d_powers[k - 1] * d
+                    d_conj_powers[k] = d_conj_powers[k - 1] * d.conjugate()
+
+                for p in range(order):
+                    for q in range(order - p):
+                        total = 0.0 + 0.0j
+                        for a in range(p + 1):
+                            for b in range(q + 1):
+                                total += (binomial[p, a] * binomial[q, b] * d_powers[p - a]
+                                          * d_conj_powers[q - b] * multipoles[child, a, b] / 2.0 ** (a + b))
+                        multipoles[box, p, q] += total
+
+            radii[box] = radius
+
+
+@njit(nogil=True, cache=True)
+def interaction_lists(children, box_center, box_size, radii, theta, max_levels, m2l, p2p):
+
+    # Dual tree traversal from (root, root). A pair of boxes that is well separated gets
+    # an M2L entry (target, source), two leaves that are not get a P2P entry, otherwise
+    # the larger box (or the one that is not a leaf) is split. Pairs are ordered, each box
+    # collects what acts on it. Returns (M2L count, P2P count), -1 if an array is too small
+
+    stack = np.empty((64 * (max_levels + 2), 2), dtype=np.int64)
+    stack[0, 0] = 0
+    stack[0, 1] = 0
+    top = 0
+
+    num_m2l = 0
+    num_p2p = 0
+
+    while top >= 0:
+        a = stack[top, 0]
+        b = stack[top, 1]
+        top -= 1
+
+        a_leaf = is_leaf(children, a)
+        b_leaf = is_leaf(children, b)
+
+        if a == b:
+            if a_leaf:
+                if num_p2p == p2p.shape[0]:
+                    return -1, -1
+                p2p[num_p2p, 0] = a
+                p2p[num_p2p, 1] = a
+                num_p2p += 1
+            else:
+                for ca in range(4):
+                    for cb in range(4):
+                        if children[a, ca] != -1 and children[a, cb] != -1:
+                            top += 1
+                            stack[top, 0] = children[a, ca]
+                            stack[top, 1] = children[a, cb]
+            continue
+
+        dx = box_center[a, 0] - box_center[b, 0]
+        dy = box_center[a, 1] - box_center[b, 1]
+        if radii[a] + radii[b] < theta * math.sqrt(dx * dx + dy * dy):
+            if num_m2l == m2l.shape[0]:
+                return -1, -1
+            m2l[num_m2l, 0] = a
+            m2l[num_m2l, 1] = b
+            num_m2l += 1
+            continue
+
+        if a_leaf and b_leaf:
+            if num_p2p == p2p.shape[0]:
+                return -1, -1
+            p2p[num_p2p, 0] = a
+            p2p[num_p2p, 1] = b
+            num_p2p += 1
+        elif b_leaf or (not a_leaf and box_size[a] >= box_size[b]):
+            for c in range(4):
+                if children[a, c] != -1:
+                    top += 1
+                    stack[top, 0] = children[a, c]
+                    stack[top, 1] = b
+        else:
+            for c in range(4):
+                if children[b, c] != -1:
+                    top += 1
+                    stack[top, 0] = a
+                    stack[top, 1] = children[b, c]
+
+    return num_m2l, num_p2p
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def m2l_pass(box_center, box_size, m2l_start, m2l_sources, order, multipoles, locals_):
+
+    # Each box's local expansion from the multipoles in its M2L list. Derivatives are
+    # taken in units of h, the larger of the two box sizes, so both rescalings are <= 1
+
+    size = 2 * order - 1
+    binomial = binomial_table(size)
+    num_boxes = box_center.shape[0]
+
+    factorial = np.ones(order, dtype=np.float64)
+    for k in range(1, order):
+        factorial[k] = factorial[k - 1] * k
+
+    # (-1)^(p + q) M[p, q] / (p! q!), the part of a source's contribution shared by every target
+    weighted = np.empty((num_boxes, order, order), dtype=np.complex128)
+    for box in prange(num_boxes):
+        for p in range(order):
+            for q in range(order - p):
+                sign = -1.0 if (p + q) & 1 else 1.0
+                weighted[box, p, q] = sign / (factorial[p] * factorial[q]) * multipoles[box, p, q]
+
+    for box in prange(num_boxes):
+        if m2l_start[box] == m2l_start[box + 1]:
+            continue
+
+        f = np.empty(size, dtype=np.float64)
+        z_powers = np.empty(size, dtype=np.complex128)
+        z_conj_powers = np.empty(size, dtype=np.complex128)
+        table = np.empty((size, size), dtype=np.complex128)
+        source = np.empty((order, order), dtype=np.complex128)
+        power = np.empty(order, dtype=np.float64)
+
+        for entry in range(m2l_start[box], m2l_start[box + 1]):
+            other = m2l_sources[entry]
+            h = max(box_size[box], box_size[other])
+            kernel_derivatives((box_center[box, 0] - box_center[other, 0]) / h,
+                               (box_center[box, 1] - box_center[other, 1]) / h, EPSILON / h, binomial, f,
+                               z_powers, z_conj_powers, table)
+
+            power[0] = 1.0
+            for k in range(1, order):
+                power[k] = power[k - 1] * box_size[other] / h
+            for p in range(order):
+                for q in range(order - p):
+                    source[p, q] = power[p + q] * weighted[other, p, q]
+
+            power[0] = -G_CONSTANT / h
+            for k in range(1, order):
+                power[k] = power[k - 1] * box_size[box] / h
+
+            for k in range(order):
+                for l in range(order - k):
+                    total = 0.0 + 0.0j
+                    for p in range(order):
+                        for q in range(order - p):
+                            total += source[p, q] * table[p + k, q + l]
+                    locals_[box, k, l] += power[k + l] / (factorial[k] * factorial[l]) * total
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def downward_pass(children, level_start, order, locals_):
+
+    # L2L from every box to its children, level by level from the root, so a box's
+    # local already holds everything acting on its ancestors when it is passed down
+
+    binomial = binomial_table(order)
+
+    for level in range(level_start.shape[0] - 1):
+        for box in prange(level_start[level], level_start[level + 1]):
+            e_powers = np.empty(order, dtype=np.complex128)
+            e_conj_powers = np.empty(order, dtype=np.complex128)
+
+            for c in range(4):
+                child = children[box, c]
+                if child == -1:
+                    continue
+
+                e = complex(0.25 if c & 1 else -0.25, 0.25 if c >> 1 else -0.25)
+                e_powers[0] = 1.0
+                e_conj_powers[0] = 1.0
+                for k in range(1, order):
+                    e_powers[k] = e_powers[k - 1] * e
+                    e_conj_powers[k] = e_conj_powers[k - 1] * e.conjugate()
+
+                for a in range(order):
+                    for b in range(order - a):
+                        total = 0.0 + 0.0j
+                        for k in range(a, order):
+                            for l in range(b, order - k):
+                                total += (locals_[box, k, l] * binomial[k, a] * binomial[l, b]
+                                          * e_powers[k - a] * e_conj_powers[l - b])
+                        locals_[child, a, b] += total / 2.0 ** (a + b)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def evaluate_forces(sorted_positions, sorted_masses, leaves, box_start, box_end, box_center, box_size, order,
+                    locals_, p2p_start, p2p_sources, net_forces):
+
+    # L2P for the far field plus direct sums with the leaves in each leaf's P2P list
+
+    for k in prange(leaves.shape[0]):
+        leaf = leaves[k]
+        cx = box_center[leaf, 0]
+        cy = box_center[leaf, 1]
+        size = box_size[leaf]
+
+        for i in range(box_start[leaf], box_end[leaf]):
+            x = sorted_positions[i, 0]
+            y = sorted_positions[i, 1]
+
+            # F = -2 m dphi/dconj(t)
+            t = complex(x - cx, y - cy) / size
+            t_conj = t.conjugate()
+            gradient = 0.0 + 0.0j
+            t_k = 1.0 + 0.0j
+            for a in range(order):
+                t_conj_l = 1.0 + 0.0j
+                for l in range(1, order - a):
+                    gradient += l * locals_[leaf, a, l] * t_k * t_conj_l
+                    t_conj_l *= t_conj
+                t_k *= t
+
+            force = -2.0 * sorted_masses[i] * gradient / size
+            fx = force.real
+            fy = force.imag
+
+            for entry in range(p2p_start[leaf], p2p_start[leaf + 1]):
+                source = p2p_sources[entry]
+                for j in range(box_start[source], box_end[source]):
+                    if j == i:
+                        continue
+                    dx = sorted_positions[j, 0] - x
+                    dy = sorted_positions[j, 1] - y
+                    softened_distance_squared = dx * dx + dy * dy + EPSILON * EPSILON
+                    softened_distance = np.sqrt(softened_distance_squared)
+                    f = G_CONSTANT * sorted_masses[i] * sorted_masses[j] / softened_distance_squared
+                    fx += f * dx / softened_distance
+                    fy += f * dy / softened_distance
+
+            net_forces[i, 0] = fx
+            net_forces[i, 1] = fy
+
+
+def list_offsets(entries, count, num_boxes):
+
+    # Sorts (target, source) entries by target, returning the start of every target's run
+    # and the sources in that order
+
+    entries = entries[:count]
+    targets = entries[:, 0]
+    order = np.argsort(targets, kind="stable")
+    start = np.zeros(num_boxes + 1, dtype=np.int64)
+    start[1:] = np.cumsum(np.bincount(targets, minlength=num_boxes))
+    return start, np.ascontiguousarray(entries[order, 1])
+
+
+class FastMultipole:
+    def __init__(self, order=FMM_ORDER, leaf_size=FMM_LEAF_SIZE, max_levels=FMM_MAX_LEVELS, theta=FMM_THETA):
+        self.order = order
+        self.leaf_size = leaf_size
+
+        # Morton keys hold 21 levels
+        self.max_levels = min(max_levels, 20)
+        self.theta = theta
+
+        self.max_boxes = 0
+        self.max_m2l = 0
+        self.max_p2p = 0
+
+    def compute_forces(self, positions, masses):
+        n = positions.shape[0]
+        order = self.order
+
+        # Square domain slightly larger than the bodies so none lands on the far edge
+        low = positions.min(axis=0)
+        high = positions.max(axis=0)
+        size = max(high[0] - low[0], high[1] - low[1], 1.0) * (1 + 1e-9)
+        center = (low + high) / 2
+        origin = center - size / 2
+
+        keys = morton_keys(positions, np.array([origin[0], origin[1], origin[0] + size, origin[1] + size]))
+        permutation = np.argsort(keys, kind="stable")
+        keys = keys[permutation]
+        sorted_positions = np.ascontiguousarray(positions[permutation])
+        sorted_masses = np.ascontiguousarray(masses[permutation])
+
+        self.max_boxes = max(self.max_boxes, 8 * (n // max(self.leaf_size, 1)) + 64)
+        while True:
+            box_start = np.empty(self.max_boxes, dtype=np.int64)
+            box_end = np.empty(self.max_boxes, dtype=np.int64)
+            box_level = np.empty(self.max_boxes, dtype=np.int64)
+            box_center = np.empty((self.max_boxes, 2), dtype=np.float64)
+            children = np.empty((self.max_boxes, 4), dtype=np.int64)
+            num_boxes = build_boxes(keys, self.leaf_size, self.max_levels, origin, size, box_start, box_end,
+                                    box_level, box_center, children)
+            if num_boxes != -1:
+                break
+            self.max_boxes *= 2
+
+        box_start = box_start[:num_boxes]
+        box_end = box_end[:num_boxes]
+        box_center = box_center[:num_boxes]
+        children = children[:num_boxes]
+        box_size = size / 2.0 ** box_level[:num_boxes]
+        level_start = np.searchsorted(box_level[:num_boxes], np.arange(box_level[num_boxes - 1] + 2))
+
+        multipoles = np.zeros((num_boxes, order, order), dtype=np.complex128)
+        locals_ = np.zeros((num_boxes, order, order), dtype=np.complex128)
+        radii = np.empty(num_boxes, dtype=np.float64)
+
+        upward_pass(sorted_positions, sorted_masses, box_start, box_end, box_center, box_size, children,
+                    level_start, order, multipoles, radii)
+
+        self.max_m2l = max(self.max_m2l, 32 * num_boxes)
+        self.max_p2p = max(self.max_p2p, 16 * num_boxes)
+        while True:
+            m2l = np.empty((self.max_m2l, 2), dtype=np.int64)
+            p2p = np.empty((self.max_p2p, 2), dtype=np.int64)
+            num_m2l, num_p2p = interaction_lists(children, box_center, box_size, radii, self.theta,
+                                                 self.max_levels, m2l, p2p)
+            if num_m2l != -1:
+                break
+            self.max_m2l *= 2
+            self.max_p2p *= 2
+
+        m2l_start, m2l_sources = list_offsets(m2l, num_m2l, num_boxes)
+        p2p_start, p2p_sources = list_offsets(p2p, num_p2p, num_boxes)
+
+        m2l_pass(box_center, box_size, m2l_start, m2l_sources, order, multipoles, locals_)
+        downward_pass(children, level_start, order, locals_)
+
+        leaves = np.flatnonzero((children == -1).all(axis=1))
+        sorted_forces = np.empty((n, 2), dtype=np.float64)
+        evaluate_forces(sorted_positions, sorted_masses, leaves, box_start, box_end, box_center, box_size, order,
+                        locals_, p2p_start, p2p_sources, sorted_forces)
+
+        net_forces = np.empty((n, 2), dtype=np.float64)
+        net_forces[permutation] = sorted_forces
+        return net_forces
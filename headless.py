@@ -0,0 +1,213 @@
+import argparse
+import math
+import sys
+import time
+
+# Startup is reported split into imports, scenario setup, warm-up and the first step
+IMPORT_START = time.perf_counter()
+
+import numpy as np
+
+from cosmos import *
+from simulation_setup import *
+from recorder import TrajectoryRecorder
+from warmup import warm_up
+from timing import PhaseTimers, format_stats, write_stats
+from diagnostics import EnergyMonitor
+
+IMPORT_TIME = time.perf_counter() - IMPORT_START
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a simulation without rendering")
+
+    scenario = parser.add_mutually_exclusive_group()
+    scenario.add_argument("--scenario", choices=sorted(SCENARIOS), default="multi")
+    scenario.add_argument("--scenario-file", metavar="PATH", help="load the bodies from a .npz or .csv file")
+    parser.add_argument("--num-bodies", type=int,
+                        help=f"number of bodies for the {' and '.join(SIZED_SCENARIOS)} scenarios")
+    parser.add_argument("--save-scenario", metavar="PATH", help="save the initial bodies to a .npz file")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="numba")
+    parser.add_argument("--integrator", choices=sorted(INTEGRATORS), default=INTEGRATOR)
+
+    length = parser.add_mutually_exclusive_group()
+    length.add_argument("--steps", type=int, default=1000, help="number of steps to run")
+    length.add_argument("--duration", type=float, help="simulated time to run, in seconds")
+
+    parser.add_argument("--dt", type=float, help="timestep in seconds, defaults to the scenario's")
+    parser.add_argument("--reorder-interval", type=int, default=MORTON_REORDER_INTERVAL,
+                        help="steps between sorting the bodies by Morton key, 0 never reorders")
+    parser.add_argument("--collisions", action="store_true", default=COLLISIONS,
+                        help="merge bodies that overlap after each step")
+    parser.add_argument("--warm-up", action="store_true",
+                        help="compile (or load from the cache) the kernels before the first step")
+    parser.add_argument("--seed", type=int, help="seed for the scenario's random generators")
+    parser.add_argument("--record", metavar="PATH", help="stream positions and velocities to a trajectory file")
+    parser.add_argument("--record-interval", type=int, default=1, help="steps between recorded frames")
+    parser.add_argument("--timing", metavar="PATH",
+                        help="time the phases of every step and dump rolling stats to a .json or .csv file")
+    parser.add_argument("--timing-interval", type=float, default=10.0,
+                        help="seconds of wall time between timing dumps")
+    parser.add_argument("--diagnostics", metavar="PATH",
+                        help="sample energy and momenta into a .npz or .csv time series")
+    parser.add_argument("--diagnostics-interval", type=int, default=DIAGNOSTICS_INTERVAL,
+                        help="steps between diagnostics samples")
+    parser.add_argument("--potential", choices=("exact", "tree"), default=DIAGNOSTICS_POTENTIAL,
+                        help="potential energy summed over all pairs or approximated with a tree")
+    parser.add_argument("--progress-interval", type=float, default=5.0,
+                        help="seconds of wall time between progress reports")
+
+    args = parser.parse_args(argv)
+
+    if args.num_bodies is not None:
+        if args.scenario_file is not None:
+            parser.error("--num-bodies cannot be used with --scenario-file")
+        if args.scenario not in SIZED_SCENARIOS:
+            parser.error(f"--num-bodies is only supported by the {', '.join(SIZED_SCENARIOS)} scenarios, "
+                         f"{args.scenario} has a fixed set of bodies")
+
+    return args
+
+
+def report(label, step, sim_time, steps_per_second, num_bodies):
+    # Direct-sum equivalent body-body interactions, so engines can be compared
+    interactions_per_second = steps_per_second * num_bodies * (num_bodies - 1)
+
+    print(f"{label} step {step}  sim time {sim_time:.4g} s  "
+          f"{steps_per_second:.2f} steps/s  {interactions_per_second:.4g} interactions/s")
+    sys.stdout.flush()
+
+
+def record_frame(recorder, cosmos, step, sim_time):
+
+    # Frames are stored in id order, the copies are only gathered on the steps the
+    # recorder keeps so a record_interval above 1 costs nothing in between
+
+    if step % recorder.interval == 0:
+        recorder.record(step, sim_time, cosmos.in_id_order(cosmos.positions), cosmos.in_id_order(cosmos.velocities))
+
+
+def run(scenario, engine, steps=None, duration=None, dt=None, progress_interval=5.0,
+        record=None, record_interval=1, integrator=INTEGRATOR, reorder_interval=MORTON_REORDER_INTERVAL,
+        collisions=COLLISIONS, seed=None, num_bodies=None, scenario_file=None, save_scenario=None,
+        warm=False, timing=None, timing_interval=10.0, diagnostics=None,
+        diagnostics_interval=DIAGNOSTICS_INTERVAL, potential=DIAGNOSTICS_POTENTIAL):
+    setup_start = time.perf_counter()
+    cosmos = Cosmos(integrator=integrator)
+    cosmos.reorder_interval = reorder_interval
+    cosmos.collisions = collisions
+
+    if scenario_file is not None:
+        scenario = scenario_file
+        _, scale, scenario_dt = load_scenario_file(cosmos, scenario_file)
+    elif num_bodies is not None:
+        if scenario not in SIZED_SCENARIOS:
+            raise ValueError(f"{scenario} has a fixed set of bodies, num_bodies cannot be given")
+        _, scale, scenario_dt = SCENARIOS[scenario](cosmos, seed, num_bodies)
+    else:
+        _, scale, scenario_dt = SCENARIOS[scenario](cosmos, seed)
+
+    if dt is None:
+        dt = scenario_dt
+    if dt is None:
+        raise ValueError(f"{scenario} has no timestep, one has to be given")
+
+    if save_scenario is not None:
+        save_scenario_file(cosmos, save_scenario, dt, scale)
+
+    if duration is not None:
+        steps = math.ceil(duration / dt)
+
+    update = ENGINES[engine]
+    setup_time = time.perf_counter() - setup_start
+
+    print(f"{scenario}: {cosmos.num_bodies} bodies, engine {engine}, integrator {integrator}, dt {dt} s, "
+          f"{steps} steps")
+
+    if steps <= 0:
+        return cosmos
+
+    recorder = None
+    if record is not None:
+        recorder = TrajectoryRecorder(record, cosmos.num_bodies, steps // record_interval + 1, record_interval, dt)
+        record_frame(recorder, cosmos, 0, 0.0)
+
+    if diagnostics is not None:
+        cosmos.diagnostics = EnergyMonitor(diagnostics_interval, potential)
+        cosmos.diagnostics.sample(cosmos)
+
+    warm_up_time = warm_up((engine,), (integrator,), collisions) if warm else 0.0
+
+    # The first step is timed on its own since it includes JIT compilation (or loading the
+    # cached kernels) unless warmed up
+    start_time = time.perf_counter()
+    update(cosmos, dt)
+    first_step_time = time.perf_counter() - start_time
+    print(f"first step {first_step_time:.3f} s")
+    print(f"startup {IMPORT_TIME + setup_time + warm_up_time + first_step_time:.3f} s  (imports {IMPORT_TIME:.3f} s, "
+          f"setup {setup_time:.3f} s, warm-up {warm_up_time:.3f} s, first step {first_step_time:.3f} s)")
+
+    if recorder is not None:
+        record_frame(recorder, cosmos, 1, dt)
+
+    # Timed from the second step on, the first is dominated by compilation
+    if timing is not None:
+        cosmos.timers = PhaseTimers()
+
+    start_time = time.perf_counter()
+    last_report = start_time
+    last_dump = start_time
+
+    for step in range(2, steps + 1):
+        update(cosmos, dt)
+
+        if recorder is not None:
+            with cosmos.timers.phase("record"):
+                record_frame(recorder, cosmos, step, step * dt)
+
+        now = time.perf_counter()
+        if now - last_report >= progress_interval:
+            report("progress", step, step * dt, (step - 1) / (now - start_time), cosmos.num_bodies)
+            last_report = now
+
+        if timing is not None and now - last_dump >= timing_interval:
+            write_stats(timing, {"physics": cosmos.timers}, step=step, sim_time=step * dt)
+            last_dump = now
+
+    elapsed = time.perf_counter() - start_time
+    report("done", steps, steps * dt, (steps - 1) / elapsed if elapsed > 0 else 0.0, cosmos.num_bodies)
+
+    if timing is not None:
+        stats = write_stats(timing, {"physics": cosmos.timers}, step=steps, sim_time=steps * dt)["physics"]
+        for line in format_stats(stats):
+            print("  " + line)
+        print(f"timing written to {timing}")
+
+    if diagnostics is not None:
+        cosmos.diagnostics.save(diagnostics)
+        drift = cosmos.diagnostics.drift()
+        print(f"energy drift {drift['energy'][-1]:.3e} (max {np.abs(drift['energy']).max():.3e})  "
+              f"angular momentum drift {drift['angular_momentum'][-1]:.3e}  "
+              f"momentum drift {drift['momentum'][-1]:.3e}  "
+              f"{cosmos.diagnostics.count} samples written to {diagnostics}")
+
+    if recorder is not None:
+        recorder.close()
+        print(f"recorded {recorder.num_frames} frames to {record}")
+
+    return cosmos
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    cosmos = run(args.scenario, args.engine, None if args.duration is not None else args.steps, args.duration,
+                 args.dt, args.progress_interval, args.record, args.record_interval, args.integrator,
+                 args.reorder_interval, args.collisions, args.seed, args.num_bodies, args.scenario_file,
+                 args.save_scenario, args.warm_up, args.timing, args.timing_interval, args.diagnostics,
+                 args.diagnostics_interval, args.potential)
+    cosmos.close()
+
+
+if __name__ == "__main__":
+    main()
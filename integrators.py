@@ -0,0 +1,218 @@
+import numpy as np
+from jit import NUMBA_AVAILABLE, njit, prange
+
+from constants import *
+
+# Integrators advance a Cosmos by dt with any force engine, given as a function
+# compute_forces(positions, masses) -> net forces. They work on the whole body arrays in
+# compiled kernels, so switching integrator never changes how forces are evaluated.
+#
+# cosmos.accelerations_computed marks bodies whose stored acceleration belongs to their
+# current position, integrators that end on a force evaluation (leapfrog, Yoshida) reuse
+# it for the next step instead of evaluating forces twice
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def kick(velocities, accelerations, dt):
+    for i in prange(velocities.shape[0]):
+        velocities[i, 0] += accelerations[i, 0] * dt
+        velocities[i, 1] += accelerations[i, 1] * dt
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def drift(positions, velocities, dt):
+    for i in prange(positions.shape[0]):
+        positions[i, 0] += velocities[i, 0] * dt
+        positions[i, 1] += velocities[i, 1] * dt
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def accelerate(accelerations, net_forces, masses):
+    for i in prange(accelerations.shape[0]):
+        accelerations[i, 0] = net_forces[i, 0] / masses[i]
+        accelerations[i, 1] = net_forces[i, 1] / masses[i]
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def rk4_stage(positions, velocities, stage_velocities, stage_accelerations, h, out_positions, out_velocities):
+
+    # y + h k for the state y = (position, velocity) and slope k = (velocity, acceleration)
+
+    for i in prange(positions.shape[0]):
+        for d in range(2):
+            out_positions[i, d] = positions[i, d] + h * stage_velocities[i, d]
+            out_velocities[i, d] = velocities[i, d] + h * stage_accelerations[i, d]
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def rk4_combine(positions, velocities, slope_velocities, slope_accelerations, dt):
+    for i in prange(positions.shape[0]):
+        for d in range(2):
+            positions[i, d] += dt / 6 * (slope_velocities[0, i, d] + 2 * slope_velocities[1, i, d] +
+                                         2 * slope_velocities[2, i, d] + slope_velocities[3, i, d])
+            velocities[i, d] += dt / 6 * (slope_accelerations[0, i, d] + 2 * slope_accelerations[1, i, d] +
+                                          2 * slope_accelerations[2, i, d] + slope_accelerations[3, i, d])
+
+
+if not NUMBA_AVAILABLE:
+    # The kernels above would run as Python loops over the bodies, the same updates as
+    # whole array operations keep the "numpy" engine usable without numba
+
+    def kick(velocities, accelerations, dt):
+        velocities += accelerations * dt
+
+    def drift(positions, velocities, dt):
+        positions += velocities * dt
+
+    def accelerate(accelerations, net_forces, masses):
+        np.divide(net_forces, masses[:, np.newaxis], out=accelerations)
+
+    def rk4_stage(positions, velocities, stage_velocities, stage_accelerations, h, out_positions, out_velocities):
+        np.add(positions, h * stage_velocities, out=out_positions)
+        np.add(velocities, h * stage_accelerations, out=out_velocities)
+
+    def rk4_combine(positions, velocities, slope_velocities, slope_accelerations, dt):
+        for state, slopes in ((positions, slope_velocities), (velocities, slope_accelerations)):
+            state += dt / 6 * (slopes[0] + 2 * slopes[1] + 2 * slopes[2] + slopes[3])
+
+
+class Integrator:
+    def step(self, cosmos, dt, compute_forces):
+        raise NotImplementedError
+
+    def evaluate(self, cosmos, compute_forces):
+        cosmos.net_forces[:] = compute_forces(cosmos.positions, cosmos.masses)
+        accelerate(cosmos.accelerations, cosmos.net_forces, cosmos.masses)
+        cosmos.accelerations_computed[:] = True
+
+    def ensure_accelerations(self, cosmos, compute_forces):
+        if not cosmos.accelerations_computed.all():
+            self.evaluate(cosmos, compute_forces)
+
+
+class Euler(Integrator):
+
+    """
+
+    Semi-implicit (symplectic) Euler method, one force evaluation per step
+
+    Error of O(dt^2) per step
+
+    """
+
+    def step(self, cosmos, dt, compute_forces):
+        self.ensure_accelerations(cosmos, compute_forces)
+
+        kick(cosmos.velocities, cosmos.accelerations, dt)
+
+        cosmos.record_trails()
+        drift(cosmos.positions, cosmos.velocities, dt)
+
+        cosmos.accelerations_computed[:] = False
+
+
+class Leapfrog(Integrator):
+
+    """
+
+    Velocity Verlet / kick-drift-kick leapfrog, one force evaluation per step
+    since the closing kick's acceleration opens the next step
+
+    Error of O(dt^3) per step
+
+    """
+
+    def step(self, cosmos, dt, compute_forces):
+        self.ensure_accelerations(cosmos, compute_forces)
+        cosmos.record_trails()
+        self.kick_drift_kick(cosmos, dt, compute_forces)
+
+    def kick_drift_kick(self, cosmos, dt, compute_forces):
+        kick(cosmos.velocities, cosmos.accelerations, 0.5 * dt)
+        drift(cosmos.positions, cosmos.velocities, dt)
+        self.evaluate(cosmos, compute_forces)
+        kick(cosmos.velocities, cosmos.accelerations, 0.5 * dt)
+
+
+class Yoshida4(Leapfrog):
+
+    """
+
+    Yoshida's 4th order symplectic composition of three leapfrog steps
+    of w1 dt, w0 dt and w1 dt, three force evaluations per step
+
+    Error of O(dt^5) per step
+
+    """
+
+    W1 = 1 / (2 - 2 ** (1 / 3))
+    W0 = -2 ** (1 / 3) * W1
+
+    def step(self, cosmos, dt, compute_forces):
+        self.ensure_accelerations(cosmos, compute_forces)
+        cosmos.record_trails()
+
+        for weight in (self.W1, self.W0, self.W1):
+            self.kick_drift_kick(cosmos, weight * dt, compute_forces)
+
+
+class RK4(Integrator):
+
+    """
+
+    Runge Kutta 4 method, four force evaluations per step
+
+    Error of O(dt^5) and accumulated error across all steps that
+    scales as O(dt^4)
+
+    Runge Kutta 4 equations:
+
+    k1 = dt * evaluate(t, y)
+    k2 = dt * evaluate(t + 0.5*dt, y + 0.5*k1)
+    k3 = dt * evaluate(t + 0.5*dt, y + 0.5*k2)
+    k4 = dt * evaluate(t + dt, y + k3)
+
+    """
+
+    def __init__(self):
+        self.scratch_size = -1
+
+    def reserve(self, n):
+        if self.scratch_size != n:
+            self.slope_velocities = np.empty((4, n, 2), dtype=np.float64)
+            self.slope_accelerations = np.empty((4, n, 2), dtype=np.float64)
+            self.stage_positions = np.empty((n, 2), dtype=np.float64)
+            self.stage_velocities = np.empty((n, 2), dtype=np.float64)
+            self.scratch_size = n
+
+    def step(self, cosmos, dt, compute_forces):
+        self.ensure_accelerations(cosmos, compute_forces)
+        self.reserve(cosmos.num_bodies)
+
+        masses = cosmos.masses
+        slope_velocities = self.slope_velocities
+        slope_accelerations = self.slope_accelerations
+
+        slope_velocities[0] = cosmos.velocities
+        slope_accelerations[0] = cosmos.accelerations
+
+        for stage, h in ((1, 0.5 * dt), (2, 0.5 * dt), (3, dt)):
+            rk4_stage(cosmos.positions, cosmos.velocities, slope_velocities[stage - 1],
+                      slope_accelerations[stage - 1], h, self.stage_positions, self.stage_velocities)
+
+            slope_velocities[stage] = self.stage_velocities
+            accelerate(slope_accelerations[stage], compute_forces(self.stage_positions, masses), masses)
+
+        cosmos.record_trails()
+        rk4_combine(cosmos.positions, cosmos.velocities, slope_velocities, slope_accelerations, dt)
+
+        # The last evaluation was at y + k3, not at the new positions
+        cosmos.accelerations_computed[:] = False
+
+
+INTEGRATORS = {
+    "euler": Euler,
+    "leapfrog": Leapfrog,
+    "yoshida4": Yoshida4,
+    "rk4": RK4,
+}
@@ -0,0 +1,21 @@
+# numba's decorators and helpers when it is installed. Without numba the kernels stay
+# plain Python functions (prange is range, one thread), so every module still imports and
+# the "numpy" engine runs, integrators.py switching to whole array operations
+
+try:
+    from numba import njit, prange, get_num_threads
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    prange = range
+
+    def njit(*args, **options):
+        # Both @njit and @njit(...) leave the function as it is
+        if len(args) == 1 and callable(args[0]) and not options:
+            return args[0]
+        return lambda function: function
+
+    def get_num_threads():
+        return 1
@@ -2,12 +2,20 @@
 from cosmos import *
 from constants import *
 from simulation_setup import *
+from render import *
+from simulation_worker import *
+from warmup import warm_up
+from timing import PhaseTimers, NULL_TIMERS
 
 import pygame
 import time
 
 MAX_FPS = 120
 
+# Step the physics on its own thread and draw interpolated snapshots, instead of
+# one step per rendered frame
+USE_SIMULATION_WORKER = True
+
 
 def main():
     # ----------------- Initializing Pygame Variables -----------------
@@ -24,12 +32,30 @@ def main():
     cosmos = Cosmos()
 
     view_object, scale, dt = setup_multi_grid(cosmos)
+
+    # Kernels compile (or load from the on-disk cache) before the first frame, not during it
+    warm_up(("numba",), render=True)
+
     zoom_scale = scale
     zoom_min = max(scale / 1e2, 1)
     zoom_max = scale * 1e3
 
     celestial_bodies = cosmos.bodies
 
+    # Phase timing of frames and steps, shown in the overlay (F3) and free while hidden
+    show_timing = TIMING_OVERLAY
+    render_timers = PhaseTimers() if show_timing else NULL_TIMERS
+    cosmos.timers = PhaseTimers() if show_timing else NULL_TIMERS
+    timing_overlay = TimingOverlay()
+
+    # Dense views are drawn as a tone-mapped density map instead of body by body
+    density_map = DensityMap()
+
+    worker = None
+    if USE_SIMULATION_WORKER:
+        worker = SimulationWorker(cosmos, dt, "numba")
+        worker.start()
+
     past_stable_center = [(screen_size[0] // 2), (screen_size[1] // 2)]
     curr_stable_center = [(screen_size[0] // 2), (screen_size[1] // 2)]
 
@@ -43,6 +69,7 @@ def main():
 
     running = True
     while running:
+        frame_start = time.perf_counter()
 
         # ----------------- Looping through Pygame Events -----------------
         for event in pygame.event.get():
@@ -82,6 +109,12 @@ def main():
 
                 holding = False
 
+            # ----------------- Timing Overlay -----------------
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                show_timing = not show_timing
+                render_timers = PhaseTimers() if show_timing else NULL_TIMERS
+                cosmos.timers = PhaseTimers() if show_timing else NULL_TIMERS
+
             # ----------------- Mouse Scroll -----------------
             if event.type == pygame.MOUSEWHEEL:
                 y_comp = event.y
@@ -91,6 +124,8 @@ def main():
                 zoom_scale = min(zoom_scale, zoom_max)
                 zoom_scale = max(zoom_scale, zoom_min)
 
+        render_timers.add("events", time.perf_counter() - frame_start)
+
         if holding:
             mouse_pos = pygame.mouse.get_pos()
             curr_stable_center = [(mouse_pos[0] - start_hold[0]) * HOLD_SCALAR + past_stable_center[0],
@@ -101,30 +136,46 @@ def main():
         hold_velocity[0] *= HOLD_VELOCITY_SCALAR
         hold_velocity[1] *= HOLD_VELOCITY_SCALAR
 
-        cosmos.update_numba(dt)
+        with render_timers.phase("state"):
+            if worker is None:
+                cosmos.update_numba(dt)
+                state = cosmos
+            else:
+                state = worker.interpolated()
 
         # print(curr_stable_center)
 
         if view_object is not None:
-            view_center = get_gui_position(view_object.position, zoom_scale,
+            view_center = get_gui_position(state.positions[state.rows[view_object.id]], zoom_scale,
                                            curr_stable_center)
 
         else:
             view_center = get_gui_position((0, 0), zoom_scale, curr_stable_center)
 
         screen.fill(SCREEN_COLOR)
-        # draw_body_trails(screen, celestial_bodies, zoom_scale, view_center)
+        # draw_trails(screen, cosmos, zoom_scale, view_center)
         # draw_body_velocities(screen, celestial_bodies, zoom_scale, view_center)
         # draw_body_forces(screen, celestial_bodies, zoom_scale, view_center)
         # draw_boundaries(screen, cosmos, zoom_scale, view_center)
 
-        draw_celestial_bodies(screen, celestial_bodies, zoom_scale, view_center)
+        with render_timers.phase("draw"):
+            draw_bodies(screen, state, zoom_scale, view_center, density_map)
 
-        clock.tick(MAX_FPS)
+        if show_timing:
+            timing_overlay.draw(screen, {"render": render_timers, "physics": cosmos.timers}, frame_start)
 
-        print("FPS:", clock.get_fps())
+        with render_timers.phase("wait"):
+            clock.tick(MAX_FPS)
 
-        pygame.display.update()
+        with render_timers.phase("display"):
+            pygame.display.update()
+
+        render_timers.add("frame", time.perf_counter() - frame_start)
+        render_timers.commit()
+
+    if worker is not None:
+        worker.stop()
+    cosmos.close()
 
     pygame.quit()
 
@@ -156,16 +207,6 @@ def draw_boundaries(surface, cosmos, scale, view_center):
             queue.append(child)
 
 
-def draw_celestial_bodies(surface, celestial_bodies, scale, view_center):
-    for celestial_body in celestial_bodies:
-        celestial_body.draw(surface, scale, view_center)
-
-
-def draw_body_trails(surface, celestial_bodies, scale, view_center):
-    for celestial_body in celestial_bodies:
-        celestial_body.draw_trail(surface, scale, view_center)
-
-
 def draw_body_velocities(surface, celestial_bodies, scale, view_center):
     for celestial_body in celestial_bodies:
         celestial_body.draw_velocity(surface, scale, view_center)
@@ -0,0 +1,75 @@
+import math
+import numpy as np
+
+from constants import *
+
+# Direct sum in NumPy only, for machines without numba: the "numpy" engine. Pairs are
+# taken in target x source tiles so memory stays bounded by NUMPY_FORCE_MEMORY_BUDGET
+
+
+class ForceScratch:
+
+    # Preallocated (tile x tile) work buffers reused by compute_forces_tiled
+
+    def __init__(self, memory_budget=NUMPY_FORCE_MEMORY_BUDGET, tile_size=None):
+        if tile_size is None:
+            tile_size = int(math.sqrt(memory_budget / (4 * 8)))
+
+        self.tile_size = max(tile_size, 1)
+        self.buffers = np.empty((4, 0), dtype=np.float64)
+        self.peak_bytes = 0
+
+    def reserve(self, tile_size):
+        if self.buffers.shape[1] < tile_size * tile_size:
+            self.buffers = np.empty((4, tile_size * tile_size), dtype=np.float64)
+
+    def tiles(self, rows, cols):
+        size = rows * cols
+        return [buffer[:size].reshape(rows, cols) for buffer in self.buffers]
+
+
+def compute_forces_tiled(positions, masses, scratch=None):
+
+    # Same result as cosmos.compute_forces, but target/source tiles are processed one at a time
+    # so memory stays bounded by the scratch buffers instead of growing as (n, n, 2)
+
+    if scratch is None:
+        scratch = ForceScratch()
+
+    n = positions.shape[0]
+    tile_size = max(min(scratch.tile_size, n), 1)
+    scratch.reserve(tile_size)
+
+    x = np.ascontiguousarray(positions[:, 0])
+    y = np.ascontiguousarray(positions[:, 1])
+    net_forces = np.zeros((n, 2), dtype=np.float64)
+
+    scratch.peak_bytes = scratch.buffers.nbytes + net_forces.nbytes + x.nbytes + y.nbytes
+
+    for t_start in range(0, n, tile_size):
+        t_end = min(t_start + tile_size, n)
+
+        for s_start in range(0, n, tile_size):
+            s_end = min(s_start + tile_size, n)
+            dx, dy, softened_distance, weights = scratch.tiles(t_end - t_start, s_end - s_start)
+
+            np.subtract(x[np.newaxis, s_start:s_end], x[t_start:t_end, np.newaxis], out=dx)
+            np.subtract(y[np.newaxis, s_start:s_end], y[t_start:t_end, np.newaxis], out=dy)
+
+            np.multiply(dx, dx, out=softened_distance)
+            np.multiply(dy, dy, out=weights)
+            softened_distance += weights
+            np.sqrt(softened_distance, out=softened_distance)
+            softened_distance += EPSILON
+
+            # m_j / d^3, the unit direction is folded into dx and dy
+            np.multiply(softened_distance, softened_distance, out=weights)
+            weights *= softened_distance
+            np.divide(masses[np.newaxis, s_start:s_end], weights, out=weights)
+
+            net_forces[t_start:t_end, 0] += np.einsum("ij,ij->i", weights, dx)
+            net_forces[t_start:t_end, 1] += np.einsum("ij,ij->i", weights, dy)
+
+    net_forces *= G_CONSTANT * masses[:, np.newaxis]
+
+    return net_forces
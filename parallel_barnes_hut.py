@@ -0,0 +1,289 @@
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from constants import *
+from barnes_hut import *
+
+# Every domain owns a shared memory segment holding its bodies (gathered in Morton
+# order) and the quad tree built over them. Other processes attach to it read only,
+# so a step only exchanges small command messages and the segment names. Segments are
+# sized by capacity and only replaced when they have to grow, so the same workers serve
+# any number of bodies
+
+
+def segment_layout(body_capacity, node_capacity):
+    return (
+        ("positions", (body_capacity, 2), np.float64),
+        ("masses", (body_capacity,), np.float64),
+        ("global_index", (body_capacity,), np.int64),
+        ("next_body", (body_capacity,), np.int64),
+        ("children", (node_capacity, 4), np.int64),
+        ("bounds", (node_capacity, 4), np.float64),
+        ("depths", (node_capacity,), np.int64),
+        ("leaf_body", (node_capacity,), np.int64),
+        ("node_mass", (node_capacity,), np.float64),
+        ("center_of_mass", (node_capacity, 2), np.float64),
+    )
+
+
+def layout_size(layout):
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in layout)
+
+
+def layout_arrays(buffer, layout):
+    arrays = {}
+    offset = 0
+    for name, shape, dtype in layout:
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return arrays
+
+
+class DomainSegment:
+    def __init__(self, body_capacity, node_capacity, name=None):
+        self.layout = segment_layout(body_capacity, node_capacity)
+        self.body_capacity = body_capacity
+        self.node_capacity = node_capacity
+
+        if name is None:
+            self.segment = shared_memory.SharedMemory(create=True, size=max(layout_size(self.layout), 1))
+            self.owner = True
+        else:
+            self.segment = shared_memory.SharedMemory(name=name)
+            self.owner = False
+
+        self.name = self.segment.name
+        self.arrays = layout_arrays(self.segment.buf, self.layout)
+
+    def close(self):
+        self.arrays = None
+        self.segment.close()
+        if self.owner:
+            self.segment.unlink()
+
+
+def build_domain(own, bodies, start, end):
+
+    # Gathers the domain's bodies into its segment and builds their tree, moving to a
+    # larger segment if the bodies or the tree do not fit. Returns the (possibly new) segment
+
+    count = end - start
+    indices = bodies["order"][start:end]
+
+    if count > own.body_capacity:
+        body_capacity = max(count, 2 * own.body_capacity)
+        grown = DomainSegment(body_capacity, max(own.node_capacity, node_capacity_for(body_capacity)))
+        own.close()
+        own = grown
+
+    while True:
+        local = own.arrays
+        local["global_index"][:count] = indices
+        local["positions"][:count] = bodies["positions"][indices]
+        local["masses"][:count] = bodies["masses"][indices]
+
+        positions = local["positions"][:count]
+        boundary = np.zeros(4)
+        if count > 0:
+            boundary = np.array([*positions.min(axis=0), *positions.max(axis=0)])
+
+        num_nodes = build_tree(positions, boundary, local["children"], local["bounds"], local["depths"],
+                               local["leaf_body"], local["next_body"])
+        if num_nodes != -1:
+            break
+
+        # Views of the old segment must be released before it can be closed
+        local = positions = None
+        grown = DomainSegment(own.body_capacity, 2 * own.node_capacity)
+        own.close()
+        own = grown
+
+    compute_moments(num_nodes, positions, local["masses"], local["children"], local["leaf_body"],
+                    local["next_body"], local["node_mass"], local["center_of_mass"])
+
+    return own
+
+
+def node_capacity_for(body_capacity):
+    return 4 * body_capacity + 4 * MAX_TREE_DEPTH + 1
+
+
+def walk_domains(own, attached, bodies, domains, count, theta):
+    local = own.arrays
+    net_forces = np.zeros((count, 2), dtype=np.float64)
+
+    for name, body_capacity, node_capacity in domains:
+        if name == own.name:
+            tree = local
+        else:
+            if name not in attached:
+                attached[name] = DomainSegment(body_capacity, node_capacity, name)
+            tree = attached[name].arrays
+
+        accumulate_tree_forces(local["positions"][:count], local["masses"][:count], name == own.name,
+                               net_forces, tree["positions"], tree["masses"], tree["children"], tree["bounds"],
+                               tree["leaf_body"], tree["next_body"], tree["node_mass"], tree["center_of_mass"],
+                               theta)
+
+    bodies["net_forces"][local["global_index"][:count]] = net_forces
+
+
+def domain_worker(connection, bodies_name, capacity, body_capacity):
+    bodies_segment = shared_memory.SharedMemory(name=bodies_name)
+    bodies = layout_arrays(bodies_segment.buf, body_layout(capacity))
+
+    own = DomainSegment(body_capacity, node_capacity_for(body_capacity))
+    attached = {}
+    count = 0
+
+    while True:
+        command = connection.recv()
+
+        if command[0] == "build":
+            _, start, end = command
+            count = end - start
+
+            own = build_domain(own, bodies, start, end)
+            connection.send((own.name, own.body_capacity, own.node_capacity))
+
+        elif command[0] == "walk":
+            _, domains, theta = command
+
+            # Drop attachments to segments that were replaced after growing
+            names = {name for name, _, _ in domains}
+            for name in list(attached):
+                if name not in names:
+                    attached.pop(name).close()
+
+            walk_domains(own, attached, bodies, domains, count, theta)
+            connection.send("done")
+
+        elif command[0] == "attach":
+            # The shared body arrays moved to a larger segment
+            _, bodies_name, capacity = command
+            bodies = None
+            bodies_segment.close()
+            bodies_segment = shared_memory.SharedMemory(name=bodies_name)
+            bodies = layout_arrays(bodies_segment.buf, body_layout(capacity))
+            connection.send("done")
+
+        elif command[0] == "stop":
+            break
+
+    for segment in attached.values():
+        segment.close()
+    own.close()
+
+    bodies = None
+    bodies_segment.close()
+    connection.close()
+
+
+def body_layout(capacity):
+    return (
+        ("positions", (capacity, 2), np.float64),
+        ("masses", (capacity,), np.float64),
+        ("net_forces", (capacity, 2), np.float64),
+        ("order", (capacity,), np.int64),
+    )
+
+
+class ParallelBarnesHut:
+
+    # Barnes-Hut split over a pool of processes: bodies are sorted by Morton key and cut
+    # into one contiguous range (a compact spatial domain) per worker, each worker builds
+    # the tree of its domain, then walks every domain's tree for its own bodies.
+    #
+    # The pool is started once for up to capacity bodies, any smaller count reuses it and a
+    # larger one moves the shared arrays to a bigger segment, so merging or adding bodies
+    # never respawns the workers
+
+    def __init__(self, capacity, num_workers=None):
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        self.capacity = max(capacity, 1)
+        self.num_workers = max(min(num_workers, self.capacity), 1)
+        self.bodies_segment, self.bodies = self.allocate_bodies(self.capacity)
+
+        body_capacity = -(-self.capacity // self.num_workers)
+
+        # Spawned workers avoid forking a process whose numba thread pool is running
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.workers = []
+        for _ in range(self.num_workers):
+            parent, child = context.Pipe()
+            worker = context.Process(target=domain_worker,
+                                     args=(child, self.bodies_segment.name, self.capacity, body_capacity),
+                                     daemon=True)
+            worker.start()
+            self.connections.append(parent)
+            self.workers.append(worker)
+
+        atexit.register(self.close)
+
+    @staticmethod
+    def allocate_bodies(capacity):
+        layout = body_layout(capacity)
+        segment = shared_memory.SharedMemory(create=True, size=max(layout_size(layout), 1))
+        return segment, layout_arrays(segment.buf, layout)
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+
+        capacity = max(capacity, 2 * self.capacity)
+        segment, bodies = self.allocate_bodies(capacity)
+
+        for connection in self.connections:
+            connection.send(("attach", segment.name, capacity))
+        for connection in self.connections:
+            connection.recv()
+
+        self.bodies = None
+        self.bodies_segment.close()
+        self.bodies_segment.unlink()
+        self.bodies_segment, self.bodies = segment, bodies
+        self.capacity = capacity
+
+    def compute_forces(self, positions, masses, theta=THETA):
+        n = positions.shape[0]
+        self.reserve(n)
+
+        self.bodies["positions"][:n] = positions
+        self.bodies["masses"][:n] = masses
+
+        boundary = np.array([*positions.min(axis=0), *positions.max(axis=0)])
+        self.bodies["order"][:n] = np.argsort(morton_keys(positions, boundary), kind="stable")
+
+        ranges = np.linspace(0, n, self.num_workers + 1).astype(np.int64)
+        for connection, start, end in zip(self.connections, ranges[:-1], ranges[1:]):
+            connection.send(("build", int(start), int(end)))
+        domains = [connection.recv() for connection in self.connections]
+
+        for connection in self.connections:
+            connection.send(("walk", domains, theta))
+        for connection in self.connections:
+            connection.recv()
+
+        return self.bodies["net_forces"][:n].copy()
+
+    def close(self):
+        if self.workers is None:
+            return
+
+        for connection in self.connections:
+            connection.send(("stop",))
+        for worker in self.workers:
+            worker.join()
+
+        self.workers = None
+        self.bodies = None
+        self.bodies_segment.close()
+        self.bodies_segment.unlink()
+
+        atexit.unregister(self.close)
@@ -0,0 +1,185 @@
+import queue
+import threading
+
+import numpy as np
+
+# File layout: a fixed size header, a frame index of (step, time) pairs for every
+# preallocated frame, then max_frames frames of float64 [positions (n, 2), velocities (n, 2)]
+
+TRAJECTORY_MAGIC = b"CBTRAJ01"
+HEADER_SIZE = 64
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("num_bodies", "<u8"),
+    ("max_frames", "<u8"),
+    ("num_frames", "<u8"),
+    ("interval", "<u8"),
+    ("dt", "<f8"),
+])
+
+INDEX_DTYPE = np.dtype([
+    ("step", "<i8"),
+    ("time", "<f8"),
+])
+
+
+def trajectory_memmaps(path, mode, num_bodies=None, max_frames=None):
+    header = np.memmap(path, dtype=HEADER_DTYPE, mode=mode, shape=(1,))
+
+    if num_bodies is None:
+        num_bodies = int(header["num_bodies"][0])
+        max_frames = int(header["max_frames"][0])
+
+    index = np.memmap(path, dtype=INDEX_DTYPE, mode=mode, offset=HEADER_SIZE, shape=(max_frames,))
+    frames = np.memmap(path, dtype=np.float64, mode=mode, offset=HEADER_SIZE + INDEX_DTYPE.itemsize * max_frames,
+                       shape=(max_frames, 2, num_bodies, 2))
+
+    return header, index, frames
+
+
+class TrajectoryRecorder:
+    def __init__(self, path, num_bodies, max_frames, interval=1, dt=0.0, chunk_frames=16, num_chunks=3):
+        self.path = path
+        self.num_bodies = num_bodies
+        self.max_frames = max_frames
+        self.interval = interval
+
+        file_size = HEADER_SIZE + INDEX_DTYPE.itemsize * max_frames + 2 * num_bodies * 2 * 8 * max_frames
+        with open(path, "wb") as file:
+            file.truncate(file_size)
+
+        self.header, self.index, self.frames = trajectory_memmaps(path, "r+", num_bodies, max_frames)
+        self.header["magic"] = TRAJECTORY_MAGIC
+        self.header["num_bodies"] = num_bodies
+        self.header["max_frames"] = max_frames
+        self.header["num_frames"] = 0
+        self.header["interval"] = interval
+        self.header["dt"] = dt
+
+        # Snapshots are staged into chunk buffers on the simulation thread and written to
+        # the file in bulk by the writer thread, so stepping only pays for a memory copy
+        self.chunk_frames = chunk_frames
+        self.chunks = [(np.empty((chunk_frames, 2, num_bodies, 2), dtype=np.float64),
+                        np.empty(chunk_frames, dtype=INDEX_DTYPE)) for _ in range(num_chunks)]
+
+        self.free_chunks = queue.Queue()
+        for chunk in range(num_chunks):
+            self.free_chunks.put(chunk)
+
+        # Exception raised by the writer thread, raised again by record() and close()
+        self.error = None
+
+        self.pending = queue.Queue()
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+        self.num_frames = 0
+        self.chunk = self.free_chunks.get()
+        self.chunk_start = 0
+        self.chunk_count = 0
+
+    def record(self, step, time, positions, velocities):
+        if step % self.interval != 0:
+            return
+
+        self.raise_writer_error()
+
+        if self.num_frames >= self.max_frames:
+            raise RuntimeError(f"trajectory {self.path} is full ({self.max_frames} frames)")
+
+        data, index = self.chunks[self.chunk]
+        data[self.chunk_count, 0] = positions
+        data[self.chunk_count, 1] = velocities
+        index[self.chunk_count] = (step, time)
+
+        self.chunk_count += 1
+        self.num_frames += 1
+
+        if self.chunk_count == self.chunk_frames:
+            self.submit_chunk()
+
+    def submit_chunk(self):
+        if self.chunk_count == 0:
+            return
+
+        self.pending.put((self.chunk, self.chunk_start, self.chunk_count))
+
+        chunk = self.free_chunks.get()
+        if chunk is None:
+            # Left in the queue so every later wait wakes up too
+            self.free_chunks.put(None)
+            self.raise_writer_error()
+
+        self.chunk = chunk
+        self.chunk_start = self.num_frames
+        self.chunk_count = 0
+
+    def write_chunks(self):
+
+        # On an error the writer stops and hands out None instead of a free chunk, so the
+        # simulation thread never waits forever for a chunk that will not come back
+
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+
+            chunk, start, count = item
+            data, index = self.chunks[chunk]
+
+            try:
+                self.frames[start:start + count] = data[:count]
+                self.index[start:start + count] = index[:count]
+                self.header["num_frames"] = start + count
+            except Exception as error:
+                self.error = error
+                self.free_chunks.put(None)
+                break
+
+            self.free_chunks.put(chunk)
+
+    def raise_writer_error(self):
+        if self.error is not None:
+            raise RuntimeError(f"writing trajectory {self.path} failed") from self.error
+
+    def close(self):
+        if self.writer is None:
+            return
+
+        try:
+            self.submit_chunk()
+        finally:
+            self.pending.put(None)
+            self.writer.join()
+            self.writer = None
+
+        self.raise_writer_error()
+
+        self.frames.flush()
+        self.index.flush()
+        self.header.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Trajectory:
+    def __init__(self, path):
+        header, index, frames = trajectory_memmaps(path, "r")
+
+        if header["magic"][0] != TRAJECTORY_MAGIC:
+            raise ValueError(f"{path} is not a trajectory file")
+
+        self.num_bodies = int(header["num_bodies"][0])
+        self.num_frames = int(header["num_frames"][0])
+        self.interval = int(header["interval"][0])
+        self.dt = float(header["dt"][0])
+
+        self.steps = index["step"][:self.num_frames]
+        self.times = index["time"][:self.num_frames]
+        self.positions = frames[:self.num_frames, 0]  # (frames, n, 2)
+        self.velocities = frames[:self.num_frames, 1]  # (frames, n, 2)
@@ -0,0 +1,312 @@
+import math
+import numpy as np
+import pygame
+from jit import njit, prange
+
+from constants import *
+from timing import format_stats
+
+
+def project_positions(positions, scale, view_center):
+
+    # Vectorized get_gui_position for an array of positions (..., 2)
+
+    x = positions[..., 0] / scale * WIDTH - view_center[0]
+    y = positions[..., 1] / scale * HEIGHT - view_center[1]
+    return x, y
+
+
+def write_pixels(surface, x, y, colors):
+
+    # Points are culled to the surface and written in one bulk assignment
+
+    width, height = surface.get_size()
+    visible = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+
+    pixels = pygame.surfarray.pixels3d(surface)
+    pixels[x[visible].astype(np.intp), y[visible].astype(np.intp)] = colors[visible]
+    del pixels  # unlocks the surface
+
+
+def draw_trails(surface, cosmos, scale, view_center):
+    trail_colors = cosmos.colors // 5 + 200
+
+    for trails, count in ((cosmos.trails, cosmos.trail_count),
+                          (cosmos.trail_history, cosmos.trail_history_count)):
+        if count == 0 or cosmos.num_bodies == 0:
+            continue
+
+        # Before a ring wraps around only its first count slots hold recorded positions
+        x, y = project_positions(trails[:, :count], scale, view_center)
+        colors = np.broadcast_to(trail_colors[:, np.newaxis, :], x.shape + (3,))
+
+        write_pixels(surface, x, y, colors)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def prepare_bodies(positions, velocities, radii, colors, scale, view_center, width, height, tapered):
+
+    # One pass projecting every body, computing its screen radius and (tapered) color
+    # and culling it against the surface, same formulas as CelestialBody.draw
+
+    n = positions.shape[0]
+    x = np.empty(n, dtype=np.int64)
+    y = np.empty(n, dtype=np.int64)
+    g_radius = np.empty(n, dtype=np.int64)
+    draw_colors = np.empty((n, 3), dtype=np.uint8)
+    visible = np.empty(n, dtype=np.bool_)
+
+    for i in prange(n):
+        x[i] = int(positions[i, 0] / scale * WIDTH - view_center[0])
+        y[i] = int(positions[i, 1] / scale * HEIGHT - view_center[1])
+        g_radius[i] = int(max(min(radii[i] / scale * WIDTH, radii[i] / scale * HEIGHT), 1))
+
+        r = g_radius[i] if g_radius[i] > 1 else 0
+        visible[i] = x[i] + r >= 0 and x[i] - r < width and y[i] + r >= 0 and y[i] - r < height
+
+        if tapered:
+            speed = math.sqrt(velocities[i, 0] * velocities[i, 0] + velocities[i, 1] * velocities[i, 1])
+            speed = max(min(speed, MAX_SPEED), MIN_SPEED)
+            t_speed = (speed - MIN_SPEED) / (MAX_SPEED - MIN_SPEED)
+
+            draw_colors[i, 0] = int(50 - (50 * t_speed))
+            draw_colors[i, 1] = int(80 + (240 - 80) * t_speed)
+            draw_colors[i, 2] = int(250 - (30 * t_speed))
+        else:
+            draw_colors[i, 0] = colors[i, 0]
+            draw_colors[i, 1] = colors[i, 1]
+            draw_colors[i, 2] = colors[i, 2]
+
+    return x, y, g_radius, draw_colors, visible
+
+
+@njit(nogil=True, cache=True)
+def bin_bodies(x, y, visible, weights, weight_unit, colors, counts, weight_sum, color_sum):
+
+    # 2D histogram of the visible bodies' pixels, with their weights (divided by weight_unit
+    # so the float32 sums stay O(1) per body) and weighted colors. Only counts has to be
+    # zeroed, the sums of a pixel are set by its first body. Serial, scattering from several
+    # threads would race on shared pixels. Returns the number of bodies binned and of pixels
+    # they occupy
+
+    width, height = counts.shape
+    binned = 0
+    occupied = 0
+
+    for i in range(x.shape[0]):
+        px = x[i]
+        py = y[i]
+        if not visible[i] or px < 0 or px >= width or py < 0 or py >= height:
+            continue
+
+        w = weights[i] / weight_unit
+        if counts[px, py] == 0:
+            occupied += 1
+            weight_sum[px, py] = w
+            color_sum[px, py, 0] = w * colors[i, 0]
+            color_sum[px, py, 1] = w * colors[i, 1]
+            color_sum[px, py, 2] = w * colors[i, 2]
+        else:
+            weight_sum[px, py] += w
+            color_sum[px, py, 0] += w * colors[i, 0]
+            color_sum[px, py, 1] += w * colors[i, 1]
+            color_sum[px, py, 2] += w * colors[i, 2]
+        counts[px, py] += 1
+        binned += 1
+
+    return binned, occupied
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def tone_map(counts, weight_sum, color_sum, binned, background, image):
+
+    # Logarithmic tone mapping: a pixel's weight, in units of the average body's, sets how
+    # far its mean color is blended in over the background, reaching it at the peak
+
+    width, height = counts.shape
+
+    total = 0.0
+    highest = 0.0
+    for px in prange(width):
+        column_total = 0.0
+        column_highest = 0.0
+        for py in range(height):
+            if counts[px, py] > 0:
+                column_total += weight_sum[px, py]
+                column_highest = max(column_highest, weight_sum[px, py])
+        total += column_total
+        highest = max(highest, column_highest)
+
+    unit = max(total / binned, 1e-300)
+    peak = math.log1p(highest / unit)
+
+    for px in prange(width):
+        for py in range(height):
+            w = weight_sum[px, py]
+            if counts[px, py] == 0 or w <= 0 or peak <= 0:
+                for c in range(3):
+                    image[px, py, c] = background[c]
+                continue
+
+            intensity = math.log1p(w / unit) / peak
+            for c in range(3):
+                color = color_sum[px, py, c] / w
+                image[px, py, c] = int(background[c] + (color - background[c]) * intensity)
+
+
+class DensityMap:
+
+    # Level of detail for draw_bodies: above threshold bodies per occupied pixel the bodies
+    # are binned and the tone-mapped histogram is blitted as one image, so the cost follows
+    # the number of pixels rather than bodies. Colors are the same (tapered) ones the bodies
+    # are drawn with, averaged with the weights
+
+    def __init__(self, threshold=DENSITY_MAP_THRESHOLD, weight=DENSITY_MAP_WEIGHT, min_bodies=DENSITY_MAP_MIN_BODIES):
+        if weight not in ("count", "mass", "speed"):
+            raise ValueError(f"unknown density map weight {weight!r}, expected 'count', 'mass' or 'speed'")
+
+        self.threshold = threshold
+        self.min_bodies = min_bodies
+        self.weight = weight
+        self.background = np.array(SCREEN_COLOR, dtype=np.float64)
+        self.size = (-1, -1)
+        self.ones = np.ones(0, dtype=np.float64)
+
+        # Whether the last draw_bodies call used the density map
+        self.active = False
+
+    def reserve(self, width, height):
+        if self.size != (width, height):
+            self.counts = np.empty((width, height), dtype=np.int32)
+            self.weight_sum = np.empty((width, height), dtype=np.float32)
+            self.color_sum = np.empty((width, height, 3), dtype=np.float32)
+            self.image = np.empty((width, height, 3), dtype=np.uint8)
+            self.size = (width, height)
+
+    def weights(self, state, visible):
+
+        # (weights, unit), the unit is the largest weight. All zero weights (bodies at rest)
+        # fall back to counting the bodies
+
+        if self.weight != "count":
+            if self.weight == "mass":
+                weights = state.masses
+            else:
+                weights = np.hypot(state.velocities[:, 0], state.velocities[:, 1])
+
+            unit = float(weights.max())
+            if unit > 0:
+                return weights, unit
+
+        if self.ones.shape[0] != visible.shape[0]:
+            self.ones = np.ones(visible.shape[0], dtype=np.float64)
+        return self.ones, 1.0
+
+    def draw(self, surface, state, x, y, visible, colors):
+
+        # Returns False without drawing when the bodies are too few or sparse for the density map
+
+        if x.shape[0] < self.min_bodies:
+            self.active = False
+            return False
+
+        width, height = surface.get_size()
+        self.reserve(width, height)
+
+        self.counts.fill(0)
+
+        weights, unit = self.weights(state, visible)
+        binned, occupied = bin_bodies(x, y, visible, weights, unit, colors, self.counts, self.weight_sum,
+                                      self.color_sum)
+
+        self.active = occupied > 0 and binned / occupied >= self.threshold
+        if not self.active:
+            return False
+
+        tone_map(self.counts, self.weight_sum, self.color_sum, binned, self.background, self.image)
+        pygame.surfarray.blit_array(surface, self.image)
+
+        return True
+
+
+def draw_bodies(surface, state, scale, view_center, density_map=None):
+
+    # state is a Cosmos or a simulation_worker.Snapshot, with a DensityMap dense views are
+    # drawn as a density map
+
+    if state.num_bodies == 0:
+        return
+
+    width, height = surface.get_size()
+    x, y, g_radius, colors, visible = prepare_bodies(state.positions, state.velocities, state.radii,
+                                                     state.colors, scale, np.asarray(view_center, dtype=np.float64),
+                                                     width, height, USE_TAPERED_COLOR)
+
+    # Bodies with their own draw method (e.g. BlackHole) are drawn individually
+    for body in state.custom_drawn_bodies:
+        visible[state.rows[body.id]] = False
+
+    if density_map is not None and density_map.draw(surface, state, x, y, visible, colors):
+        draw_custom_bodies(surface, state, scale, view_center)
+        return
+
+    pixels = visible & (g_radius == 1)
+    pixel_array = pygame.surfarray.pixels3d(surface)
+    pixel_array[x[pixels], y[pixels]] = colors[pixels]
+    del pixel_array  # unlocks the surface
+
+    for i in np.flatnonzero(visible & (g_radius > 1)):
+        pygame.draw.circle(surface, colors[i], (x[i], y[i]), g_radius[i], 0)
+
+    draw_custom_bodies(surface, state, scale, view_center)
+
+
+def draw_custom_bodies(surface, state, scale, view_center):
+
+    # From the rows of state rather than the bodies' live attributes, which the
+    # simulation thread may be updating while a Snapshot is drawn
+
+    for body in state.custom_drawn_bodies:
+        row = state.rows[body.id]
+        body.draw_at(surface, state.positions[row], state.radii[row], tuple(state.colors[row]), scale, view_center)
+
+
+class TimingOverlay:
+
+    # Panel of rolling phase statistics from named groups of timing.PhaseTimers, the text
+    # is only re-rendered every refresh seconds
+
+    def __init__(self, refresh=0.5, lines_per_group=8):
+        self.refresh = refresh
+        self.lines_per_group = lines_per_group
+        self.font = None
+        self.panel = None
+        self.rendered_at = -math.inf
+
+    def draw(self, surface, groups, now):
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+
+        if now - self.rendered_at >= self.refresh:
+            lines = []
+            for name, timers in groups.items():
+                stats = timers.stats()
+                if not stats:
+                    continue
+                lines.append(f"{name}  {stats['rate']:.1f} /s")
+                lines.extend("  " + line for line in format_stats(stats, self.lines_per_group))
+
+            texts = [self.font.render(line, True, (230, 230, 230)) for line in lines]
+            width = max((text.get_width() for text in texts), default=0) + 12
+            height = sum(text.get_height() for text in texts) + 12
+
+            self.panel = pygame.Surface((width, height), pygame.SRCALPHA)
+            self.panel.fill((0, 0, 0, 160))
+            y = 6
+            for text in texts:
+                self.panel.blit(text, (6, y))
+                y += text.get_height()
+
+            self.rendered_at = now
+
+        surface.blit(self.panel, (8, 8))
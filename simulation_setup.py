@@ -2,20 +2,17 @@
 
 from cosmos import *
 from constants import *
-import random
 import numpy as np
-import pygame
-import time
 import math
 
 
-def weighted_random(lower_bound, upper_bound, weight):
-    r = np.random.power(weight)
+def weighted_random(lower_bound, upper_bound, weight, rng=np.random, size=None):
+    r = rng.power(weight, size)
     rand = lower_bound + r * (upper_bound - lower_bound)
     return rand
 
 
-def setup_solar_system(cosmos):
+def setup_solar_system(cosmos, rng=None):
     sun = CelestialBody("Sun", 1.989e30, (0, 0), (0, 0), 6.96e8, (255, 255, 0))
     earth = CelestialBody("Earth", 5.972e24, (1.496e11, 0), (0, 29780), 6.371e6, (0, 100, 200))
     moon = CelestialBody("Moon", 7.3e22, (1.49984e11, 0), (0, 30780), 1.738e6, (100, 100, 100))
@@ -35,7 +32,7 @@ def setup_solar_system(cosmos):
     return view_object, scale, dt
 
 
-def setup_three(cosmos):
+def setup_three(cosmos, rng=None):
     body1 = CelestialBody("A", 5e28, (-2e9, 0), (0, -20000), 6e8, (200, 10, 10))
     body2 = CelestialBody("B", 1e28, (4e9, 0), (5100, -1930), 3e8, (10, 10, 200))
     body3 = CelestialBody("C", 2e28, (0, 5e9), (-10200, 3000), 4e8, (200, 200, 50))
@@ -49,39 +46,38 @@ def setup_three(cosmos):
     return view_object, scale, dt
 
 
-def setup_multi(cosmos):
-    num_bodies = 10000
+# Scenarios take a numpy Generator (or a seed for one, None for fresh entropy) and build
+# their bodies as whole arrays added with cosmos.add_bodies, so they scale to millions
+# of bodies. Only bodies that need a handle (the view object) go through add_body
+
+
+def setup_multi(cosmos, rng=None, num_bodies=10000):
+    rng = np.random.default_rng(rng)
 
     black_hole = BlackHole("SMBH", 1e33, (0, 0), (1e5, 0), 2e9,
                            (10, 10, 10), (240, 240, 220))
     cosmos.add_body(black_hole)
 
-    bodies = []
     max_radius = 1e11
     min_radius = 9e9
 
-    for i in range(num_bodies):
+    r = weighted_random(min_radius, max_radius, 0.2, rng, num_bodies)
+    theta = rng.uniform(0, 2 * math.pi, num_bodies)
 
-        r = weighted_random(min_radius, max_radius, 0.2)
-        theta = random.uniform(0, 2 * math.pi)
+    positions = np.column_stack((r * np.cos(theta), r * np.sin(theta)))
 
-        x = r * math.cos(theta)
-        y = r * math.sin(theta)
+    masses = rng.uniform(1e26, 1e29, num_bodies)
+    radii = rng.uniform(1e7, 2e8, num_bodies)
 
-        mass = random.uniform(1e26, 1e29)
-        radius = random.uniform(1e7, 2e8)
+    velocity_magnitude = np.sqrt(G_CONSTANT * black_hole.mass / r)
+    velocity_angle = theta + math.pi / 2
 
-        velocity_magnitude = math.sqrt(G_CONSTANT * black_hole.mass / r)
-        velocity_angle = theta + math.pi / 2
+    velocities = np.column_stack((velocity_magnitude * np.cos(velocity_angle),
+                                  velocity_magnitude * np.sin(velocity_angle)))
 
-        vx = velocity_magnitude * math.cos(velocity_angle)
-        vy = velocity_magnitude * math.sin(velocity_angle)
+    colors = rng.integers(230, 256, (num_bodies, 3))
 
-        color = (random.randint(230, 255), random.randint(230, 255), random.randint(230, 255))
-
-        body = CelestialBody(f"star_{i + 1}", mass, (x, y), (vx, vy), radius, color)
-        bodies.append(body)
-        cosmos.add_body(body)
+    cosmos.add_bodies(masses, positions, velocities, radii, colors)
 
     view_object = black_hole
     dt = 60 * 3
@@ -90,33 +86,29 @@ def setup_multi(cosmos):
     return view_object, scale, dt
 
 
-def setup_multi_grid(cosmos):
+def setup_multi_grid(cosmos, rng=None, num_bodies=20000):
+    rng = np.random.default_rng(rng)
 
-    num_bodies = 20000
     rows = int(math.sqrt(num_bodies))
     cols = num_bodies // rows
 
-    bodies = []
-
     d = 3e10
 
-    for i in range(num_bodies):
-        r = i / rows
-        c = i % cols
+    i = np.arange(num_bodies)
+    r = i / rows
+    c = i % cols
 
-        mass = random.uniform(1e25, 1e30)
-        radius = random.uniform(1e7, 2e8)
+    masses = rng.uniform(1e25, 1e30, num_bodies)
+    radii = rng.uniform(1e7, 2e8, num_bodies)
 
-        # radius = 1e9
+    # radii = np.full(num_bodies, 1e9)
 
-        y = (r - rows / 2) * d
-        x = (c - cols / 2) * d
+    positions = np.column_stack(((c - cols / 2) * d, (r - rows / 2) * d))
+    velocities = np.zeros((num_bodies, 2))
 
-        color = (80, 150, 230)
+    colors = np.broadcast_to((80, 150, 230), (num_bodies, 3))
 
-        body = CelestialBody(f"star_{i + 1}", mass, (x, y), (0, 0), radius, color)
-        bodies.append(body)
-        cosmos.add_body(body)
+    cosmos.add_bodies(masses, positions, velocities, radii, colors)
 
     view_object = None
     dt = 60 * 24 * 20
@@ -125,3 +117,83 @@ def setup_multi_grid(cosmos):
     # scale = 1e14
 
     return view_object, scale, dt
+
+
+SCENARIOS = {
+    "three": setup_three,
+    "solar_system": setup_solar_system,
+    "multi": setup_multi,
+    "multi_grid": setup_multi_grid,
+}
+
+# Scenarios taking a num_bodies argument, the others have a fixed set of bodies
+SIZED_SCENARIOS = ("multi", "multi_grid")
+
+
+# Bodies stored in files, loaded in bulk into the body store:
+#   .npz  arrays masses (n,), positions (n, 2), velocities (n, 2), radii (n,) and optionally
+#         colors (n, 3), plus optional scalars dt and scale
+#   .csv  a header line naming the columns mass, x, y, vx, vy, radius and optionally r, g, b
+
+CSV_COLUMNS = ("mass", "x", "y", "vx", "vy", "radius")
+DEFAULT_BODY_COLOR = (255, 255, 255)
+
+
+def read_bodies(path):
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+    elif path.endswith(".csv"):
+        with open(path) as file:
+            header = [name.strip() for name in file.readline().split(",")]
+        missing = [name for name in CSV_COLUMNS if name not in header]
+        if missing:
+            raise ValueError(f"{path} is missing the columns {', '.join(missing)}")
+
+        table = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+        column = {name: table[:, i] for i, name in enumerate(header)}
+
+        arrays = {
+            "masses": column["mass"],
+            "positions": np.column_stack((column["x"], column["y"])),
+            "velocities": np.column_stack((column["vx"], column["vy"])),
+            "radii": column["radius"],
+        }
+        if all(name in column for name in ("r", "g", "b")):
+            arrays["colors"] = np.column_stack((column["r"], column["g"], column["b"]))
+    else:
+        raise ValueError(f"{path} is not a .npz or .csv file")
+
+    n = arrays["masses"].shape[0]
+    if "colors" not in arrays:
+        arrays["colors"] = np.broadcast_to(DEFAULT_BODY_COLOR, (n, 3))
+
+    return arrays
+
+
+def load_scenario_file(cosmos, path):
+
+    # Scenario from a file, (view_object, scale, dt) with dt None when the file has none
+
+    arrays = read_bodies(path)
+    cosmos.add_bodies(arrays["masses"], arrays["positions"], arrays["velocities"], arrays["radii"],
+                      np.clip(arrays["colors"], 0, 255))
+
+    dt = float(arrays["dt"]) if "dt" in arrays else None
+    if "scale" in arrays:
+        scale = float(arrays["scale"])
+    else:
+        scale = float(np.abs(cosmos.positions).max()) if cosmos.num_bodies > 0 else 1.0
+
+    return None, scale, dt
+
+
+def save_scenario_file(cosmos, path, dt=None, scale=None):
+    extra = {}
+    if dt is not None:
+        extra["dt"] = dt
+    if scale is not None:
+        extra["scale"] = scale
+
+    np.savez(path, masses=cosmos.masses, positions=cosmos.positions, velocities=cosmos.velocities,
+             radii=cosmos.radii, colors=cosmos.colors, **extra)
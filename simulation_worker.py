@@ -0,0 +1,175 @@
+import threading
+import time
+
+import numpy as np
+
+from cosmos import *
+
+
+class Snapshot:
+
+    # Copy of the drawable state of a Cosmos, accepted by render.draw_bodies in place of one.
+    # Rows follow the cosmos at capture time, ids and rows are copied along so snapshots
+    # taken either side of a reorder or merge can still be matched body by body
+
+    def __init__(self, num_bodies):
+        self.num_bodies = num_bodies
+        self.ids = np.arange(num_bodies)
+        self.rows = np.arange(num_bodies)
+        self.layout_version = -1
+        self.positions = np.empty((num_bodies, 2), dtype=np.float64)
+        self.masses = np.empty(num_bodies, dtype=np.float64)
+        self.velocities = np.empty((num_bodies, 2), dtype=np.float64)
+        self.radii = np.empty(num_bodies, dtype=np.float64)
+        self.colors = np.empty((num_bodies, 3), dtype=np.uint8)
+        self.custom_drawn_bodies = []
+
+        self.step = 0
+        self.sim_time = 0.0
+        self.wall_time = 0.0
+
+    def capture(self, cosmos, step, sim_time):
+        if self.num_bodies != cosmos.num_bodies:
+            self.__init__(cosmos.num_bodies)
+
+        if self.layout_version != cosmos.layout_version:
+            self.ids = cosmos.ids.copy()
+            self.rows = cosmos.rows.copy()
+            self.layout_version = cosmos.layout_version
+
+        self.positions[:] = cosmos.positions
+        self.masses[:] = cosmos.masses
+        self.velocities[:] = cosmos.velocities
+        self.radii[:] = cosmos.radii
+        self.colors[:] = cosmos.colors
+        self.custom_drawn_bodies = list(cosmos.custom_drawn_bodies)
+
+        self.step = step
+        self.sim_time = sim_time
+        self.wall_time = time.perf_counter()
+
+    def copy(self):
+        snapshot = Snapshot(self.num_bodies)
+        snapshot.capture(self, self.step, self.sim_time)
+        snapshot.wall_time = self.wall_time
+        return snapshot
+
+
+class SimulationWorker:
+
+    # Steps a Cosmos on its own thread (the numba kernels release the GIL) and publishes
+    # snapshots the render loop can read and interpolate without waiting on the physics
+
+    def __init__(self, cosmos, dt, engine="numba", max_steps_per_second=None):
+        self.cosmos = cosmos
+        self.dt = dt
+        self.update = ENGINES[engine]
+        self.max_steps_per_second = max_steps_per_second
+
+        # previous and current are published, the third slot is written by the worker
+        self.snapshots = [Snapshot(cosmos.num_bodies) for _ in range(3)]
+        self.previous = 0
+        self.current = 1
+        self.snapshots[self.previous].capture(cosmos, 0, 0.0)
+        self.snapshots[self.current].capture(cosmos, 0, 0.0)
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        # Exception that ended the worker thread, raised again by interpolated() and stop()
+        self.error = None
+
+        self.step = 0
+        self.start_time = 0.0
+
+    def start(self):
+        self.stop_event.clear()
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        self.raise_worker_error()
+
+    def run(self):
+
+        # An error stops the thread and is kept for the render loop, which would otherwise
+        # keep drawing the last snapshot as if the simulation had frozen
+
+        try:
+            while not self.stop_event.is_set():
+                step_start = time.perf_counter()
+
+                self.update(self.cosmos, self.dt)
+                self.step += 1
+                self.publish()
+
+                if self.max_steps_per_second:
+                    remaining = 1 / self.max_steps_per_second - (time.perf_counter() - step_start)
+                    if remaining > 0:
+                        time.sleep(remaining)
+        except Exception as error:
+            self.error = error
+
+    def raise_worker_error(self):
+        if self.error is not None:
+            raise RuntimeError(f"simulation worker failed at step {self.step}") from self.error
+
+    def publish(self):
+        writing = 3 - self.previous - self.current
+
+        # Timed after the step was committed, so it counts towards the next step's sample
+        with self.cosmos.timers.phase("snapshot"):
+            self.snapshots[writing].capture(self.cosmos, self.step, self.step * self.dt)
+
+        with self.lock:
+            self.previous = self.current
+            self.current = writing
+
+    def steps_per_second(self):
+        elapsed = time.perf_counter() - self.start_time
+        return self.step / elapsed if elapsed > 0 else 0.0
+
+    def interpolated(self, now=None):
+
+        # State between the two latest snapshots, lagging one step behind so motion
+        # stays smooth when frames and steps are not in sync
+
+        self.raise_worker_error()
+
+        if now is None:
+            now = time.perf_counter()
+
+        with self.lock:
+            previous = self.snapshots[self.previous]
+            current = self.snapshots[self.current]
+
+            snapshot = current.copy()
+
+            step_wall_time = current.wall_time - previous.wall_time
+            if step_wall_time <= 0:
+                return snapshot
+
+            alpha = min((now - current.wall_time) / step_wall_time, 1.0)
+
+            if previous.layout_version == current.layout_version:
+                previous_positions = previous.positions
+            else:
+                # Bodies moved rows (or merged) between the two steps, match them by id
+                previous_rows = np.full(current.num_bodies, -1, dtype=np.int64)
+                known = current.ids < previous.rows.shape[0]
+                previous_rows[known] = previous.rows[current.ids[known]]
+                previous_positions = current.positions.copy()
+                found = previous_rows >= 0
+                previous_positions[found] = previous.positions[previous_rows[found]]
+
+            snapshot.positions[:] = previous_positions + alpha * (current.positions - previous_positions)
+            snapshot.sim_time = previous.sim_time + alpha * (current.sim_time - previous.sim_time)
+
+        return snapshot
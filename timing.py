@@ -0,0 +1,178 @@
+import csv
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from constants import *
+
+# Named wall clock timers for the phases of a step or frame. Phase times are added up
+# over the step (forces evaluated four times by RK4 count as one sample) and commit()
+# closes the step, keeping the last TIMING_WINDOW samples of every phase for rolling
+# statistics. Phases nest and each is timed inclusively, "forces" contains "tree_build".
+#
+# Code always calls through a timers object, which is NULL_TIMERS when timing is off:
+# its phases are a shared no-op context and wrap() returns the function unchanged, so
+# disabled timing adds no work to the hot paths
+
+
+class NullTimers:
+    enabled = False
+
+    def __init__(self):
+        self.null_phase = NullPhase()
+
+    def phase(self, name):
+        return self.null_phase
+
+    def wrap(self, name, function):
+        return function
+
+    def add(self, name, seconds):
+        pass
+
+    def commit(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Phase:
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timers.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class PhaseTimers:
+    enabled = True
+
+    def __init__(self, window=TIMING_WINDOW):
+        self.window = window
+        self.phases = {}
+        self.pending = {}
+        self.history = {}
+        self.commit_times = deque(maxlen=window + 1)
+        self.commits = 0
+
+        # Steps are committed from the simulation thread while the overlay reads stats
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(self, name)
+        return phase
+
+    def wrap(self, name, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.add(name, time.perf_counter() - start)
+            return result
+
+        return timed
+
+    def add(self, name, seconds):
+        self.pending[name] = self.pending.get(name, 0.0) + seconds
+
+    def commit(self):
+        with self.lock:
+            for name, seconds in self.pending.items():
+                samples = self.history.get(name)
+                if samples is None:
+                    samples = self.history[name] = deque(maxlen=self.window)
+                samples.append(seconds)
+
+            self.commit_times.append(time.perf_counter())
+            self.commits += 1
+
+        self.pending = {}
+
+    def stats(self):
+
+        # {phase: {count, last_ms, mean_ms, min_ms, max_ms, p95_ms}} over the window, plus
+        # "rate", the committed steps or frames per second
+
+        with self.lock:
+            history = {name: np.array(samples) for name, samples in self.history.items()}
+            commit_times = list(self.commit_times)
+
+        stats = {}
+        for name, samples in history.items():
+            if samples.shape[0] == 0:
+                continue
+            milliseconds = samples * 1e3
+            stats[name] = {
+                "count": int(samples.shape[0]),
+                "last_ms": float(milliseconds[-1]),
+                "mean_ms": float(milliseconds.mean()),
+                "min_ms": float(milliseconds.min()),
+                "max_ms": float(milliseconds.max()),
+                "p95_ms": float(np.percentile(milliseconds, 95)),
+            }
+
+        rate = 0.0
+        if len(commit_times) > 1 and commit_times[-1] > commit_times[0]:
+            rate = (len(commit_times) - 1) / (commit_times[-1] - commit_times[0])
+
+        return {"rate": rate, "phases": stats}
+
+
+NULL_TIMERS = NullTimers()
+
+
+def write_stats(path, groups, **fields):
+
+    # Dumps the stats of every named group of timers. A .json file is rewritten with the
+    # latest stats, a .csv file gets one row per phase appended on every call
+
+    snapshot = {name: timers.stats() for name, timers in groups.items()}
+
+    if path.endswith(".csv"):
+        columns = list(fields) + ["group", "rate", "phase", "count", "last_ms", "mean_ms", "min_ms", "max_ms",
+                                  "p95_ms"]
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+
+        with open(path, "a", newline="") as file:
+            writer = csv.DictWriter(file, columns)
+            if new_file:
+                writer.writeheader()
+            for group, stats in snapshot.items():
+                for phase, phase_stats in stats["phases"].items():
+                    writer.writerow({**fields, "group": group, "rate": stats["rate"], "phase": phase, **phase_stats})
+    else:
+        # Written aside and renamed so readers never see a partial file
+        with open(path + ".tmp", "w") as file:
+            json.dump({**fields, "wall_time": time.time(), "groups": snapshot}, file, indent=2)
+        os.replace(path + ".tmp", path)
+
+    return snapshot
+
+
+def format_stats(stats, limit=None):
+
+    # Lines of "phase  mean  p95" ordered by mean time, for the overlay and console
+
+    phases = sorted(stats["phases"].items(), key=lambda item: -item[1]["mean_ms"])[:limit]
+    return [f"{name:<12} {phase['mean_ms']:8.2f} ms  p95 {phase['p95_ms']:8.2f} ms" for name, phase in phases]
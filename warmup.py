@@ -0,0 +1,64 @@
+import argparse
+import time
+
+from cosmos import *
+from simulation_setup import *
+
+# Compiles every kernel a run needs on a handful of bodies, so the cost is paid before the
+# first step or frame. Kernels are cached on disk (see JIT_CACHE_DIR in constants.py), so
+# once the cache is filled this only loads them. Running this file fills the cache ahead
+# of time for every engine and integrator:
+#   python warmup.py
+
+
+def warm_up(engines=("numba",), integrators=(INTEGRATOR,), collisions=False, render=False, num_bodies=64):
+
+    # Returns the seconds spent, ~0 beyond loading when the cache is already filled
+
+    start = time.perf_counter()
+
+    for engine in engines:
+        for integrator in integrators:
+            cosmos = Cosmos(integrator=integrator)
+            _, scale, dt = setup_multi(cosmos, 0, num_bodies)
+            cosmos.collisions = collisions
+            if collisions:
+                # A pair that has to merge, so the merging kernels compile too
+                cosmos.positions[2] = cosmos.positions[1] + cosmos.radii[1] / 2
+
+            # Two steps, integrators reuse the accelerations from the first
+            ENGINES[engine](cosmos, dt)
+            ENGINES[engine](cosmos, dt)
+            cosmos.close()
+
+    if render:
+        # Imported here so headless runs never load pygame
+        import pygame
+        from render import draw_bodies, DensityMap
+
+        cosmos = Cosmos()
+        _, scale, _ = setup_multi(cosmos, 0, num_bodies)
+        draw_bodies(pygame.Surface((16, 16)), cosmos, float(scale), (0.0, 0.0))
+        density_map = DensityMap(threshold=0, min_bodies=0)
+        draw_bodies(pygame.Surface((16, 16)), cosmos, float(scale), (0.0, 0.0), density_map)
+
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile and cache the simulation kernels ahead of time")
+    parser.add_argument("--engines", nargs="+", choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument("--integrators", nargs="+", choices=sorted(INTEGRATORS), default=sorted(INTEGRATORS))
+    parser.add_argument("--render", action="store_true", help="also compile the rendering kernels (imports pygame)")
+    args = parser.parse_args(argv)
+
+    # Imported here, headless.py imports warm_up on machines without numba too
+    import numba
+
+    elapsed = warm_up(args.engines, args.integrators, True, args.render)
+    print(f"warmed up {len(args.engines)} engines x {len(args.integrators)} integrators in {elapsed:.2f} s, "
+          f"cache in {numba.config.CACHE_DIR}")
+
+
+if __name__ == "__main__":
+    main()